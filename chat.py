@@ -11,27 +11,43 @@ import os
 import random
 import threading
 import ssl
+import select
+import errno
 import html
 import base64
 import struct
+import itertools
+import functools
+import hashlib
 import uuid
 import re
+import queue
+import asyncio
+import sqlite3
+import shutil
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from datetime import datetime
-from zeroconf import ServiceInfo, Zeroconf, ServiceBrowser
+from zeroconf import ServiceInfo, Zeroconf, ServiceStateChange, IPVersion
+from zeroconf.asyncio import AsyncServiceBrowser, AsyncServiceInfo
 import subprocess
+import ifaddr
 
 from PySide6.QtWidgets import (
     QApplication, QMainWindow, QWidget, QHBoxLayout, QVBoxLayout,
     QListWidget, QListWidgetItem, QTextBrowser, QLineEdit, QPushButton, QStackedWidget,
     QLabel, QFileDialog, QProgressBar, QMenu, QMessageBox, QSizePolicy, QSpacerItem,
-    QScrollArea, QSystemTrayIcon, QMenu as QTrayMenu, QDialog, QTabWidget, QGridLayout,
-    QStyleFactory
+    QSystemTrayIcon, QMenu as QTrayMenu, QDialog, QTabWidget, QGridLayout,
+    QStyleFactory, QListView, QStyledItemDelegate, QDialogButtonBox
+)
+from PySide6.QtCore import (
+    QThread, Signal, QObject, Qt, QUrl, QTimer, QSize, QRect, QPointF, QEvent,
+    QAbstractListModel, QModelIndex
 )
-from PySide6.QtCore import QThread, Signal, QObject, Qt, QUrl, QTimer, QSize
 from PySide6.QtGui import (
     QIcon, QFont, QDesktopServices, QAction, QPalette, QPixmap, QPainter, QColor,
-    QPainterPath
+    QPainterPath, QTextDocument, QFontMetrics
 )
 from PySide6.QtMultimedia import QSoundEffect
 from PySide6.QtSvg import QSvgRenderer
@@ -54,15 +70,239 @@ ICONS = {
     "send": """<svg viewBox="0 0 24 24" height="24" width="24"><path fill="currentColor" d="M1.101,21.757L23.8,12.028L1.101,2.3l0.011,7.912l13.623,1.816L1.112,13.845 L1.101,21.757z"></path></svg>""",
     "ping": """<svg xmlns="http://www.w3.org/2000/svg" width="24" height="24" viewBox="0 0 24 24" fill="none" stroke="currentColor" stroke-width="2" stroke-linecap="round" stroke-linejoin="round"><path d="M18 8A6 6 0 0 0 6 8c0 7-3 9-3 9h18s-3-2-3-9"></path><path d="M13.73 21a2 2 0 0 1-3.46 0"></path></svg>""",
     "attach": """<svg xmlns="http://www.w3.org/2000/svg" width="24" height="24" viewBox="0 0 24 24" fill="none" stroke="currentColor" stroke-width="2" stroke-linecap="round" stroke-linejoin="round"><path d="M21.44 11.05l-9.19 9.19a6 6 0 0 1-8.49-8.49l9.19-9.19a4 4 0 0 1 5.66 5.66l-9.2 9.19a2 2 0 0 1-2.83-2.83l8.49-8.48"></path></svg>""",
-    "file": """<svg xmlns="http://www.w3.org/2000/svg" width="24" height="24" viewBox="0 0 24 24" fill="none" stroke="currentColor" stroke-width="2" stroke-linecap="round" stroke-linejoin="round"><path d="M14 2H6a2 2 0 0 0-2 2v16a2 2 0 0 0 2 2h12a2 2 0 0 0 2-2V8z"></path><polyline points="14 2 14 8 20 8"></polyline><line x1="16" y1="13" x2="8" y2="13"></line><line x1="16" y1="17" x2="8" y2="17"></line><polyline points="10 9 9 9 8 9"></polyline></svg>"""
+    "file": """<svg xmlns="http://www.w3.org/2000/svg" width="24" height="24" viewBox="0 0 24 24" fill="none" stroke="currentColor" stroke-width="2" stroke-linecap="round" stroke-linejoin="round"><path d="M14 2H6a2 2 0 0 0-2 2v16a2 2 0 0 0 2 2h12a2 2 0 0 0 2-2V8z"></path><polyline points="14 2 14 8 20 8"></polyline><line x1="16" y1="13" x2="8" y2="13"></line><line x1="16" y1="17" x2="8" y2="17"></line><polyline points="10 9 9 9 8 9"></polyline></svg>""",
+    "group": """<svg xmlns="http://www.w3.org/2000/svg" width="24" height="24" viewBox="0 0 24 24" fill="none" stroke="currentColor" stroke-width="2" stroke-linecap="round" stroke-linejoin="round"><path d="M17 21v-2a4 4 0 0 0-4-4H5a4 4 0 0 0-4 4v2"></path><circle cx="9" cy="7" r="4"></circle><path d="M23 21v-2a4 4 0 0 0-3-3.87"></path><path d="M16 3.13a4 4 0 0 1 0 7.75"></path></svg>""",
+}
+
+ICON_CACHE_SIZE = 64            # rasterized (icon, colour, size, pixel ratio) variants
+AVATAR_CACHE_SIZE = 256         # rounded avatars kept per (path, size)
+
+# --- Chat History ---
+HISTORY_MAX_ROWS = 5000         # older messages are dropped from the view beyond this
+BUBBLE_MAX_WIDTH = 0.75         # fraction of the view width a bubble may take
+HISTORY_FLUSH_INTERVAL = 16     # ms; queued messages are inserted once per frame
+HISTORY_SCROLL_DELAY = 50       # ms; scroll-to-bottom requests are coalesced
+AUTOSCROLL_SLACK = 24           # px from the bottom that still counts as following
+HISTORY_DB_PATH = os.path.join(APP_DATA_DIR, "history.db")
+HISTORY_PAGE_SIZE = 50          # messages loaded when a chat opens or scrolls to the top
+HISTORY_PREFETCH_PX = 200       # load the previous page this close to the top
+HISTORY_WRITE_BATCH = 256       # queued writes committed in one transaction
+MAX_CHAT_PAGES = 12             # chat pages kept built; least recently used are dropped
+CHAT_PAGE_IDLE_TIMEOUT = 600    # seconds before an unused chat page is dropped
+CHAT_PAGE_EVICT_INTERVAL = 60000  # ms between idle page sweeps
+SEARCH_RESULT_LIMIT = 50
+SEARCH_DEBOUNCE = 150           # ms after the last keystroke before searching
+RENDER_CACHE_SIZE = 1024        # rendered message HTML kept for repeated texts
+EMOJI_FONT_FAMILIES = ("Segoe UI Emoji", "Noto Color Emoji", "Apple Color Emoji")
+MESSAGE_STATUS = {
+    "pending": ("🕓", "timestamp"),
+    "queued": ("🕓 Waiting for peer", "timestamp"),
+    "sent": ("✓", "primary_green"),
+    "failed": ("✗ Not delivered", "ping_color"),
 }
 
 SERVICE_TYPE = "_b-messenger._tcp.local."
+DISCOVERY_RESOLVE_TIMEOUT = 3000  # ms to wait for a discovered peer to answer
+ROSTER_DEBOUNCE = 250           # ms; discovery events are applied to the chat list in batches
+ROSTER_OFFLINE_GRACE = 15       # seconds a vanished peer keeps its chat before removal
 CERTFILE = os.path.join(APP_DATA_DIR, "cert.pem")
 KEYFILE = os.path.join(APP_DATA_DIR, "key.pem")
-CHUNK_SIZE = 4096
+MAX_FRAME_SIZE = 10 * 1024 * 1024  # 10MB limit per frame
+
+# --- File Transfer ---
+DOWNLOAD_DIR = os.path.join(HOME_DIR, "Downloads")
+TRANSFER_STATE_DIR = os.path.join(APP_DATA_DIR, "transfers")
+FILE_CHUNK_MIN = 64 * 1024          # first chunk size; grows on fast links
+FILE_CHUNK_MAX = 1024 * 1024        # largest chunk, also the send buffer size
+FILE_CHUNK_FAST = 0.05              # seconds; faster chunks double the size
+FILE_CHUNK_SLOW = 0.5               # seconds; slower chunks halve it
+FILE_ACK_BYTES = 4 * 1024 * 1024    # receiver syncs and acks this often
+FILE_DONE_TIMEOUT = 30.0
+FILE_OFFER_TIMEOUT = 120.0          # seconds the receiver's user has to accept a file
+FILE_OFFER_POLL = 2.0               # seconds between asks while the receiver's user decides
+FILE_MAX_SIZE = 64 * 1024 ** 3      # larger offers are refused outright
+FILE_FREE_SPACE_MARGIN = 512 * 1024 * 1024  # disk kept free after preallocating a download
+TRANSFER_STATE_MAX_AGE = 7 * 24 * 3600  # seconds before an abandoned partial download is deleted
+FILE_RETRY_LIMIT = 5
+FILE_TRANSFER_WORKERS = 2
+FILE_PARALLEL_STREAMS = min(4, os.cpu_count() or 1)  # TLS connections per large file
+FILE_PARALLEL_MIN_RANGE = 16 * 1024 * 1024  # never split a file into ranges smaller than this
+
+# --- Deduplication ---
+CHUNK_STORE_DIR = os.path.join(APP_DATA_DIR, "chunks")
+CHUNK_STORE_MAX_BYTES = 2 * 1024 * 1024 * 1024  # oldest chunks are evicted beyond this
+DEDUP_MIN_SIZE = 1024 * 1024        # smaller files are always sent whole
+CDC_MIN_SIZE = 16 * 1024
+CDC_MAX_SIZE = 256 * 1024
+CDC_WINDOW = 14                     # boundary run length; ~64KB average chunks
+CDC_READ_SIZE = 8 * 1024 * 1024
+MANIFEST_CACHE_SIZE = 8
+PROGRESS_INTERVAL = 0.1             # seconds between progress signals
+
+# --- TLS Server Tuning ---
+SERVER_BACKLOG = 128          # listen() backlog for pending connections
+SERVER_MAX_WORKERS = 64       # concurrent connections handled at once
+SERVER_READ_TIMEOUT = 10.0    # seconds allowed for a handshake or a full frame
+SERVER_IDLE_TIMEOUT = 60.0    # close inbound connections idle this long
+
+# --- Outbound Connection Pool ---
+CONNECT_TIMEOUT = 5
+CONNECT_ATTEMPT_DELAY = 0.25  # seconds before racing a peer's next address (Happy Eyeballs)
+CONNECT_MIN_TIMEOUT = 1.0     # floor for connect timeouts derived from measured RTT
+POOL_IDLE_TIMEOUT = 30.0      # close outbound connections idle this long
+POOL_REAP_INTERVAL = 5.0
+POOL_HELD_ACKS = 64           # msg_ack replies the health monitor read, kept for the sender
+SEND_WORKERS = 8              # background threads draining outbound queues
+MAX_BATCH_MESSAGES = 64       # queued messages coalesced into a single write
+
+# --- Outbox ---
+OUTBOX_DB_PATH = os.path.join(APP_DATA_DIR, "outbox.db")
+OUTBOX_RETRY_BASE = 5.0       # seconds before the first retry; doubles per attempt
+OUTBOX_RETRY_MAX = 300.0
+OUTBOX_MAX_AGE = 7 * 24 * 3600  # undelivered messages are given up after a week
+OUTBOX_IDLE_CHECK = 60.0      # seconds between checks when nothing is due
+OUTBOX_DISPATCH_BATCH = 500   # due messages handled per pass, so add() never waits long
+RECEIVED_ID_CACHE = 4096      # recent message ids remembered to drop redeliveries
+
+# --- Inbound Limits ---
+INBOUND_MESSAGE_RATE = 20     # chat messages per second per peer; more are left unacked for a retry
+INBOUND_MESSAGE_BURST = 100
+INBOUND_PING_RATE = 0.5       # pings per second per peer; more are dropped
+INBOUND_PING_BURST = 3
+RATE_LIMIT_CACHE = 1024       # peers with a rate limit bucket; the least recently seen are dropped
+INBOUND_QUEUE_SIZE = 1000     # received messages waiting for the GUI
+INBOUND_BATCH = 50            # messages the GUI handles per event loop pass
+MAX_MESSAGE_SIZE = 256 * 1024  # text and ping frames; larger ones are dropped
+PING_COALESCE_WINDOW = 10     # seconds; repeated pings from a peer add to one counter
+
+# --- Group Chat ---
+GROUPS_PATH = os.path.join(APP_DATA_DIR, "groups.json")
+GROUP_CHAT_PREFIX = "group:"  # chat keys of group conversations
+GROUP_RELAY = True            # ask a member that got a group message to forward it to one we cannot reach
+ENCODED_CACHE_SIZE = 64       # group messages kept encoded for the fan-out
+
+# --- Peer Health ---
+HEALTH_PROBE_INTERVAL = 5.0   # seconds between probes of pooled connections
+HEALTH_PROBE_TIMEOUT = 2.0    # a probe unanswered this long counts as lost
+HEALTH_PROBE_POLL = 0.1       # seconds between checks for probe replies a sender read for us
+HEALTH_RTT_GAIN = 1 / 8       # EWMA weights, as in RFC 6298
+HEALTH_RTTVAR_GAIN = 1 / 4
+HEALTH_LOSS_GAIN = 1 / 8
+HEALTH_DOWN_AFTER = 3         # lost probes in a row before a peer counts as down
+HEALTH_FORGET_AFTER = 300.0   # stop probing a peer that has been down this long
+HEALTH_PROBE_WORKERS = 4      # concurrent reconnect probes to down peers
+
+# --- Wire Protocol ---
+# v1: 4-byte big-endian length + one UTF-8 JSON object (one frame per connection
+#     on old peers). v2 is negotiated with a v1 "hello" frame and then switches
+#     the connection to typed, multiplexed frames.
+PROTOCOL_VERSION = 2
+FRAME_HEADER = struct.Struct('>BBII')  # version, frame type, stream id, payload length
+FRAME_TEXT = 1
+FRAME_PING = 2
+FRAME_FILE_CHUNK = 3
+FRAME_ACK = 4
+FRAME_CONTROL = 5
+CHAT_STREAM_ID = 0
+HELLO_TIMEOUT = 2.0
+CODEC_PREFERENCE = ("compact", "json")  # payload codecs we offer, best first
+PROTOCOL_FEATURES = ("probe", "ack")  # optional control frames we answer, announced in hello
+MAX_DECODE_DEPTH = 32  # nesting allowed in a decoded payload; deeper ones are malformed
 PING_SOUND_FILE = os.path.join(APP_DATA_DIR, "ping.wav")
 
+# --- Shared Styles ---
+# Set once on the chat area and inherited by every chat page, so Qt parses it a
+# single time instead of once per widget per page.
+CHAT_PAGE_STYLESHEET = f"""
+    QWidget#chatHeader {{
+        background-color: {APP_COLORS['header_bg']};
+        border-bottom: 1px solid {APP_COLORS['input_border']};
+        padding: 0 10px;
+    }}
+    QLabel#chatTitle {{
+        background-color: {APP_COLORS['header_bg']};
+        color: {APP_COLORS['text_primary']};
+        padding: 0 10px;
+    }}
+    QPushButton#pingButton, QPushButton#attachButton {{
+        background-color: transparent;
+        border-radius: 20px;
+        border: none;
+    }}
+    QPushButton#pingButton:hover {{
+        background-color: #E0E0E0;
+    }}
+    QPushButton#attachButton:hover {{
+        background-color: #E9EDEF;
+    }}
+    QListView#chatHistory {{
+        border: none;
+        background-color: {APP_COLORS['chat_bg']};
+    }}
+    QListView#chatHistory QScrollBar:vertical {{
+        width: 8px;
+        background: #F0F2F5;
+        margin: 0px;
+        border-radius: 4px;
+    }}
+    QListView#chatHistory QScrollBar::handle:vertical {{
+        background: #d1d7db;
+        min-height: 24px;
+        border-radius: 4px;
+    }}
+    QListView#chatHistory QScrollBar::add-line:vertical,
+    QListView#chatHistory QScrollBar::sub-line:vertical {{
+        height: 0px;
+        background: none;
+        border: none;
+    }}
+    QListView#chatHistory QScrollBar::add-page:vertical,
+    QListView#chatHistory QScrollBar::sub-page:vertical {{
+        background: none;
+    }}
+    QWidget#inputToolbar {{
+        background-color: {APP_COLORS['header_bg']};
+        border-top: 1px solid {APP_COLORS['input_border']};
+        padding: 0px 16px;
+    }}
+    QPushButton#emojiButton {{
+        background-color: transparent;
+        border-radius: 24px;
+        border: none;
+        font-size: 28px;
+        padding: 2px;
+    }}
+    QPushButton#emojiButton:hover {{
+        background-color: #E9EDEF;
+    }}
+    QLineEdit#messageInput {{
+        background-color: {APP_COLORS['incoming_bg']};
+        border: 1.5px solid {APP_COLORS['input_border']};
+        border-radius: 24px;
+        padding-left: 20px;
+        padding-right: 20px;
+        padding-top: 14px;
+        padding-bottom: 14px;
+        color: {APP_COLORS['text_primary']};
+        font-size: 15px;
+    }}
+    QLineEdit#messageInput:focus {{
+        border: 1.5px solid {APP_COLORS['primary_green']};
+        background-color: #fff;
+    }}
+    QLineEdit#messageInput:hover {{
+        border: 1.5px solid {APP_COLORS['secondary_green']};
+    }}
+    QPushButton#sendButton {{
+        background-color: #e8f5e9;
+        border-radius: 20px;
+        border: none;
+    }}
+    QPushButton#sendButton:hover {{
+        background-color: #c8e6c9;
+    }}
+"""
+
 # --- Helper Functions ---
 def make_circular_pixmap(source_pixmap):
     """Create a circular pixmap from the source pixmap"""
@@ -87,20 +327,52 @@ def make_circular_pixmap(source_pixmap):
     
     return result
 
-def create_icon_from_svg(svg_string, color="currentColor", size=QSize(24, 24)):
-    """Create a QIcon from SVG string with specified color"""
+def _device_pixel_ratio():
+    """Pixel ratio of the primary screen, or 1.0 before the app exists"""
+    app = QApplication.instance()
+    screen = app.primaryScreen() if app else None
+    return screen.devicePixelRatio() if screen else 1.0
+
+@functools.lru_cache(maxsize=ICON_CACHE_SIZE)
+def _render_svg_icon(svg_string, color, width, height, ratio):
+    """Rasterize one SVG at one colour, size and pixel ratio"""
     try:
         colored_svg = svg_string.replace('currentColor', color)
         renderer = QSvgRenderer(colored_svg.encode('utf-8'))
-        pixmap = QPixmap(size)
+        pixmap = QPixmap(round(width * ratio), round(height * ratio))
         pixmap.fill(Qt.GlobalColor.transparent)
         painter = QPainter(pixmap)
         renderer.render(painter)
         painter.end()
+        pixmap.setDevicePixelRatio(ratio)
         return QIcon(pixmap)
     except Exception:
         return QIcon()
 
+def create_icon_from_svg(svg_string, color="currentColor", size=QSize(24, 24)):
+    """Create a QIcon from SVG string with specified color (cached per session)"""
+    return _render_svg_icon(svg_string, color, size.width(), size.height(),
+                            _device_pixel_ratio())
+
+@functools.lru_cache(maxsize=AVATAR_CACHE_SIZE)
+def avatar_pixmap(path, size):
+    """Load, scale and round an avatar once; None if it can't be read"""
+    ratio = _device_pixel_ratio()
+    pixmap = QPixmap(path)
+    if pixmap.isNull():
+        return None
+    pixmap = make_circular_pixmap(pixmap.scaled(
+        round(size * ratio), round(size * ratio),
+        Qt.AspectRatioMode.KeepAspectRatio,
+        Qt.TransformationMode.SmoothTransformation))
+    pixmap.setDevicePixelRatio(ratio)
+    return pixmap
+
+def user_icon_pixmap(size, icon='user'):
+    """Default avatar used when a peer or group has no picture"""
+    return create_icon_from_svg(ICONS[icon], color=APP_COLORS["icon_color"],
+                                size=QSize(size, size)).pixmap(QSize(size, size))
+
 def ensure_certificates():
     """Ensure TLS certificates exist or generate new ones"""
     if os.path.exists(CERTFILE) and os.path.exists(KEYFILE):
@@ -142,9 +414,9 @@ def get_system_avatar_path():
 
 class ChatListItem(QWidget):
     """Custom widget for chat list items"""
-    def __init__(self, user_label, avatar_path=None):
+    def __init__(self, user_label, avatar_path=None, icon='user'):
         super().__init__()
-        self.setStyleSheet("background: transparent;")
+        self.setObjectName("chatListItem")  # styled by the chat list's stylesheet
         
         layout = QHBoxLayout(self)
         layout.setContentsMargins(12, 8, 12, 8)
@@ -154,20 +426,10 @@ class ChatListItem(QWidget):
         self.profile_pic_label = QLabel()
         self.profile_pic_label.setFixedSize(42, 42)
         
+        pixmap = None
         if avatar_path and os.path.exists(avatar_path):
-            try:
-                pixmap = QPixmap(avatar_path).scaled(42, 42, 
-                    Qt.AspectRatioMode.KeepAspectRatio, 
-                    Qt.TransformationMode.SmoothTransformation)
-                self.profile_pic_label.setPixmap(make_circular_pixmap(pixmap))
-            except Exception:
-                icon = create_icon_from_svg(ICONS['user'], 
-                    color=APP_COLORS["icon_color"], size=QSize(42, 42))
-                self.profile_pic_label.setPixmap(icon.pixmap(QSize(42, 42)))
-        else:
-            icon = create_icon_from_svg(ICONS['user'], 
-                color=APP_COLORS["icon_color"], size=QSize(42, 42))
-            self.profile_pic_label.setPixmap(icon.pixmap(QSize(42, 42)))
+            pixmap = avatar_pixmap(avatar_path, 42)
+        self.profile_pic_label.setPixmap(pixmap or user_icon_pixmap(42, icon))
 
         layout.addWidget(self.profile_pic_label)
 
@@ -175,9 +437,8 @@ class ChatListItem(QWidget):
         text_layout.setContentsMargins(0, 0, 0, 0)
         text_layout.setSpacing(0)
 
-        self.username_label = QLabel(user_label)
+        self.username_label = QLabel(user_label, objectName="chatListName")
         self.username_label.setFont(QFont("Segoe UI", 11, QFont.Weight.Bold))
-        self.username_label.setStyleSheet(f"color: {APP_COLORS['text_primary']};")
 
         text_layout.addWidget(self.username_label)
         layout.addLayout(text_layout, 1)
@@ -185,212 +446,3570 @@ class ChatListItem(QWidget):
         self.setMinimumHeight(68)
         self.setSizePolicy(QSizePolicy.Policy.Expanding, QSizePolicy.Policy.Fixed)
 
+# --- Message Rendering ---
+URL_PATTERN = (
+    r'(?<![\w@])'  # Not preceded by word character or @
+    r'(?:https?://)?(?:www\.)?'
+    r'(?:[a-zA-Z0-9\-]+\.)+[a-zA-Z]{2,}'  # domain
+    r'(?::\d+)?(?:/[^\s<]*)?(?:\?[^\s<]*)?'  # port/path/query
+    r'(?![\w])'  # Not followed by word character
+)
+EMOJI_PATTERN = (
+    "["
+    "\U0001F600-\U0001F64F"  # emoticons
+    "\U0001F300-\U0001F5FF"  # symbols & pictographs
+    "\U0001F680-\U0001F6FF"  # transport & map symbols
+    "\U0001F1E0-\U0001F1FF"  # flags (iOS)
+    "\U00002700-\U000027BF"  # dingbats
+    "\U0001F900-\U0001F9FF"  # supplemental symbols
+    "\U00002600-\U000026FF"  # miscellaneous symbols
+    "\U00002B50"             # star
+    "\U00002B06"             # up arrow
+    "]+"
+)
+# URLs are matched first, so emoji inside a link stay part of the link
+MESSAGE_TOKENS = re.compile(f"(?P<url>{URL_PATTERN})|(?P<emoji>{EMOJI_PATTERN})")
+
+@functools.lru_cache(maxsize=RENDER_CACHE_SIZE)
+def render_message_html(text):
+    """Rich text for a chat message: escaped text, clickable links, enlarged emoji"""
+    parts = [f"<div style='color:{APP_COLORS['text_primary']};'>"]
+    pos = 0
+    for match in MESSAGE_TOKENS.finditer(text):
+        parts.append(html.escape(text[pos:match.start()]))
+        token = match.group(0)
+        if match.lastgroup == "url":
+            url = token if token.startswith("http") else "https://" + token
+            parts.append(f"<a href='{html.escape(url)}' style='color:#2196F3;text-decoration:underline;'>"
+                         f"{html.escape(token)}</a>")
+        else:
+            parts.append(f"<span style='font-size:2em; vertical-align:middle;'>{token}</span>")
+        pos = match.end()
+    parts.append(html.escape(text[pos:]))
+    parts.append("</div>")
+    return "".join(parts)
+
+@functools.lru_cache(maxsize=None)
+def _emoji_font_family():
+    for fname in EMOJI_FONT_FAMILIES:
+        if QFont(fname).exactMatch():
+            return fname
+    return "Segoe UI"
+
+def emoji_font(point_size):
+    """A font able to show colour emoji; the family is probed once per session"""
+    font = QFont(_emoji_font_family())
+    font.setPointSize(point_size)
+    return font
+
+class HistoryStore:
+    """Chat history in SQLite (WAL mode), written by a background thread.
+
+    append() and update() only queue the write, so callers on the GUI or
+    network threads never wait for the disk. The writer commits whatever
+    has queued up, up to HISTORY_WRITE_BATCH writes, in one transaction.
+    Pages are read newest first through the (peer, timestamp) index.
+    Messages are stored under the chat's key, the peer's service name, so
+    two hosts with the same username keep separate histories.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY,
+            peer TEXT NOT NULL,
+            message_key TEXT,
+            timestamp REAL NOT NULL,
+            is_sent INTEGER NOT NULL,
+            body TEXT NOT NULL,
+            status TEXT,
+            detail TEXT
+        );
+        CREATE INDEX IF NOT EXISTS messages_peer_time ON messages (peer, timestamp);
+        CREATE INDEX IF NOT EXISTS messages_key ON messages (message_key)
+            WHERE message_key IS NOT NULL;
+        CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+            text, tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3');
+        CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages
+            WHEN json_extract(new.body, '$.type') IN ('text', 'file')
+        BEGIN
+            INSERT INTO messages_fts (rowid, text) VALUES (new.id,
+                coalesce(json_extract(new.body, '$.content'), json_extract(new.body, '$.filename')));
+        END;
+    """
+    SCHEMA_VERSION = 3
+
+    def __init__(self, path=HISTORY_DB_PATH):
+        self.path = path
+        self._queue = queue.Queue()
+        self._reader = self._connect()
+        self._reader.executescript(self.SCHEMA)
+        self._writer = threading.Thread(target=self._write_loop, name="history-writer", daemon=True)
+        self._writer.start()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def append(self, peer, msg_dict, is_sent, status=None):
+        key = msg_dict.get("id") or msg_dict.get("transfer_id")
+        self._queue.put((
+            "INSERT INTO messages (peer, message_key, timestamp, is_sent, body, status) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (peer, key, msg_dict["timestamp"], int(is_sent), json.dumps(msg_dict), status)))
+
+    def update(self, key, status, detail=None):
+        """Record a message's delivery state or a transfer's outcome"""
+        self._queue.put(("UPDATE messages SET status = ?, detail = ? WHERE message_key = ?",
+                         (status, detail, key)))
+
+    def contains(self, key):
+        """Whether a message or transfer with this key has been written"""
+        try:
+            return self._reader.execute(
+                "SELECT 1 FROM messages WHERE message_key = ? LIMIT 1", (key,)).fetchone() is not None
+        except sqlite3.Error as e:
+            print(f"Failed to read chat history: {e}")
+            return False
+
+    def _migrate(self, conn):
+        """Bring history written by older versions up to the current schema"""
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version >= self.SCHEMA_VERSION:
+            return
+        with conn:
+            if version < 1:
+                # Index messages stored before the search index existed
+                conn.execute(
+                    "INSERT INTO messages_fts (rowid, text) "
+                    "SELECT id, coalesce(json_extract(body, '$.content'), json_extract(body, '$.filename')) "
+                    "FROM messages WHERE json_extract(body, '$.type') IN ('text', 'file') "
+                    "AND id NOT IN (SELECT rowid FROM messages_fts)")
+            if version < 2:
+                # Chats used to be keyed by username; move them to that user's default service name
+                conn.execute(
+                    "UPDATE messages SET peer = peer || ? "
+                    "WHERE peer NOT LIKE '%._S.%' AND json_extract(body, '$.group') IS NULL",
+                    (f"._S.{SERVICE_TYPE}",))
+            if version < 3:
+                # Group chats used to be keyed by their display name, "#<name>"
+                conn.execute(
+                    "UPDATE messages SET peer = ? || json_extract(body, '$.group.id') "
+                    "WHERE json_extract(body, '$.group.id') IS NOT NULL",
+                    (GROUP_CHAT_PREFIX,))
+            conn.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+
+    def _write_loop(self):
+        conn = self._connect()
+        try:
+            self._migrate(conn)
+        except sqlite3.Error as e:
+            print(f"Failed to index chat history: {e}")
+        running = True
+        while running:
+            batch = [self._queue.get()]
+            while len(batch) < HISTORY_WRITE_BATCH:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch:
+                running = False
+                batch = [op for op in batch if op is not None]
+            try:
+                with conn:
+                    for statement, params in batch:
+                        conn.execute(statement, params)
+            except sqlite3.Error as e:
+                print(f"Failed to write chat history: {e}")
+        conn.close()
+
+    def load_page(self, peer, before=None, limit=HISTORY_PAGE_SIZE):
+        """Newest ``limit`` messages older than ``before`` (timestamp, row id), oldest first"""
+        columns = "SELECT id, timestamp, is_sent, body, status, detail FROM messages WHERE peer = ?"
+        try:
+            if before is None:
+                rows = self._reader.execute(
+                    f"{columns} ORDER BY timestamp DESC, id DESC LIMIT ?", (peer, limit)).fetchall()
+            else:
+                timestamp, row_id = before
+                if row_id is None:
+                    rows = self._reader.execute(
+                        f"{columns} AND timestamp < ? ORDER BY timestamp DESC, id DESC LIMIT ?",
+                        (peer, timestamp, limit)).fetchall()
+                else:
+                    rows = self._reader.execute(
+                        f"{columns} AND (timestamp < ? OR (timestamp = ? AND id < ?)) "
+                        "ORDER BY timestamp DESC, id DESC LIMIT ?",
+                        (peer, timestamp, timestamp, row_id, limit)).fetchall()
+        except sqlite3.Error as e:
+            print(f"Failed to read chat history: {e}")
+            return []
+        records = []
+        for row_id, timestamp, is_sent, body, status, detail in reversed(rows):
+            try:
+                msg_dict = json.loads(body)
+            except ValueError:
+                continue
+            records.append({"row_id": row_id, "msg": msg_dict, "is_sent": bool(is_sent),
+                            "status": status, "detail": detail})
+        return records
+
+    @staticmethod
+    def _match_expression(query):
+        """FTS5 expression matching every word of ``query`` as a prefix"""
+        return " ".join(f'"{word}"*' for word in re.findall(r"\w+", query))
+
+    def search(self, query, peers=None, limit=SEARCH_RESULT_LIMIT):
+        """Newest messages matching all words of ``query`` as prefixes.
+
+        ``peers`` limits the search to those chat keys. Each result has a
+        "snippet" of HTML with the matches in bold.
+        """
+        expression = self._match_expression(query)
+        if not expression:
+            return []
+        sql = (
+            "SELECT m.id, m.peer, m.timestamp, m.is_sent, "
+            "snippet(messages_fts, 0, char(2), char(3), '…', 16) "
+            "FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid "
+            "WHERE messages_fts MATCH ?")
+        params = [expression]
+        if peers is not None:
+            sql += f" AND m.peer IN ({','.join('?' * len(peers))})"
+            params.extend(peers)
+        sql += " ORDER BY messages_fts.rowid DESC LIMIT ?"
+        params.append(limit)
+        try:
+            rows = self._reader.execute(sql, params).fetchall()
+        except sqlite3.Error as e:
+            print(f"Chat history search failed: {e}")
+            return []
+        return [{
+            "row_id": row_id,
+            "peer": row_peer,
+            "timestamp": timestamp,
+            "is_sent": bool(is_sent),
+            "snippet": html.escape(snippet or "").replace("\x02", "<b>").replace("\x03", "</b>"),
+        } for row_id, row_peer, timestamp, is_sent, snippet in rows]
+
+    def close(self):
+        """Flush queued writes and stop the writer"""
+        self._queue.put(None)
+        self._writer.join(timeout=5)
+        self._reader.close()
+
+class ChatHistoryModel(QAbstractListModel):
+    """Messages of one chat as plain dicts, drawn by MessageDelegate.
+
+    New messages are queued and inserted together once per
+    HISTORY_FLUSH_INTERVAL. Rows with a "key" (message id or transfer id)
+    can be updated in place. Only the newest ``max_rows`` messages are kept.
+    """
+    def __init__(self, parent=None, max_rows=HISTORY_MAX_ROWS):
+        super().__init__(parent)
+        self.max_rows = max_rows
+        self._entries = deque()
+        self._pending = []
+        self._first_seq = 0    # sequence number of row 0
+        self._seq_by_key = {}
+        self._flush_timer = QTimer(self)
+        self._flush_timer.setSingleShot(True)
+        self._flush_timer.setInterval(HISTORY_FLUSH_INTERVAL)
+        self._flush_timer.timeout.connect(self.flush)
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self._entries)
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid() or role != Qt.ItemDataRole.DisplayRole:
+            return None
+        return self._entries[index.row()].get("text", "")
+
+    def entry(self, row):
+        return self._entries[row]
+
+    def queue_entry(self, entry):
+        """Add a message; it appears with the rest of the burst on the next flush"""
+        if entry.get("key"):
+            self._seq_by_key[entry["key"]] = self._first_seq + len(self._entries) + len(self._pending)
+        self._pending.append(entry)
+        if not self._flush_timer.isActive():
+            self._flush_timer.start()
+
+    def flush(self):
+        """Insert all queued messages in one batch, dropping the oldest beyond max_rows"""
+        self._flush_timer.stop()
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, []
+        overflow = len(self._entries) + len(pending) - self.max_rows
+        if overflow > 0:
+            dropped_rows = min(overflow, len(self._entries))
+            if dropped_rows:
+                self.beginRemoveRows(QModelIndex(), 0, dropped_rows - 1)
+            for _ in range(overflow):
+                dropped = self._entries.popleft() if self._entries else pending.pop(0)
+                self._first_seq += 1
+                if self._seq_by_key.get(dropped.get("key")) == self._first_seq - 1:
+                    del self._seq_by_key[dropped["key"]]
+            if dropped_rows:
+                self.endRemoveRows()
+        row = len(self._entries)
+        self.beginInsertRows(QModelIndex(), row, row + len(pending) - 1)
+        self._entries.extend(pending)
+        self.endInsertRows()
+
+    def prepend_entries(self, entries):
+        """Insert older messages, loaded from the history store, above the current ones"""
+        if not entries:
+            return
+        self.beginInsertRows(QModelIndex(), 0, len(entries) - 1)
+        self._entries.extendleft(reversed(entries))
+        self._first_seq -= len(entries)
+        for offset, entry in enumerate(entries):
+            if entry.get("key") and entry["key"] not in self._seq_by_key:
+                self._seq_by_key[entry["key"]] = self._first_seq + offset
+        self.endInsertRows()
+
+    def oldest_entry(self):
+        if self._entries:
+            return self._entries[0]
+        return self._pending[0] if self._pending else None
+
+    def update_entry(self, key, **changes):
+        """Change fields of a keyed row and repaint it; False if it is gone"""
+        seq = self._seq_by_key.get(key)
+        if seq is None:
+            return False
+        row = seq - self._first_seq
+        if row >= len(self._entries):
+            self._pending[row - len(self._entries)].update(changes)
+            return True
+        entry = self._entries[row]
+        entry.update(changes)
+        entry.pop("layout", None)
+        index = self.index(row)
+        self.dataChanged.emit(index, index)
+        return True
+
+class ChatHistoryView(QListView):
+    """Chat history list that follows new messages unless scrolled up to read.
+
+    Scrolling near the top emits older_history_requested until
+    ``history_complete`` is set.
+    """
+    older_history_requested = Signal()
+
+    def __init__(self, peer, history_model, parent=None):
+        super().__init__(parent)
+        self.peer = peer
+        self.history_complete = False
+        self.history_model = history_model
+        self.setModel(self.history_model)
+        self.setItemDelegate(MessageDelegate(self))
+        self.setSelectionMode(QListView.SelectionMode.NoSelection)
+        self.setFocusPolicy(Qt.FocusPolicy.NoFocus)
+        self.setVerticalScrollMode(QListView.ScrollMode.ScrollPerPixel)
+        self.setResizeMode(QListView.ResizeMode.Adjust)
+        self.setHorizontalScrollBarPolicy(Qt.ScrollBarPolicy.ScrollBarAlwaysOff)
+
+        self._scroll_timer = QTimer(self)
+        self._scroll_timer.setSingleShot(True)
+        self._scroll_timer.setInterval(HISTORY_SCROLL_DELAY)
+        self._scroll_timer.timeout.connect(self.scrollToBottom)
+        self._follow = True
+        self.history_model.rowsAboutToBeInserted.connect(self._remember_position)
+        self.history_model.rowsInserted.connect(self._follow_new_rows)
+        self.verticalScrollBar().valueChanged.connect(self._check_top)
+
+    def _check_top(self, value):
+        if value <= HISTORY_PREFETCH_PX and not self.history_complete:
+            self.older_history_requested.emit()
+
+    def prepend_entries(self, entries):
+        """Show older messages above the current ones without moving the visible ones"""
+        if not entries:
+            return
+        scroll_bar = self.verticalScrollBar()
+        from_bottom = scroll_bar.maximum() - scroll_bar.value()
+        self.history_model.prepend_entries(entries)
+        self.executeDelayedItemsLayout()
+        scroll_bar.setValue(scroll_bar.maximum() - from_bottom)
+
+    def _remember_position(self, *args):
+        scroll_bar = self.verticalScrollBar()
+        self._follow = (self._scroll_timer.isActive()
+                        or scroll_bar.value() >= scroll_bar.maximum() - AUTOSCROLL_SLACK)
+
+    def _follow_new_rows(self, *args):
+        if self._follow:
+            self._scroll_timer.start()
+
+    def scroll_to_latest(self):
+        """Jump to the newest message once the pending batch is shown"""
+        self._follow = True
+        self._scroll_timer.start()
+
+class MessageDelegate(QStyledItemDelegate):
+    """Paints chat bubbles; layouts are cached per message and view width"""
+    MARGIN_X, MARGIN_Y = 10, 5
+    PADDING_X, PADDING_Y = 12, 8
+    FOOTER_SPACING = 2
+    FILE_ICON_SIZE = 24
+    FILE_MIN_WIDTH = 220
+    PROGRESS_HEIGHT = 8
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.text_font = emoji_font(11)
+        self.small_font = QFont("Segoe UI", 9)
+        self.bold_font = QFont("Segoe UI", 11, QFont.Weight.Bold)
+        self.link_font = QFont(self.bold_font)
+        self.link_font.setUnderline(True)
+        self.file_icon = create_icon_from_svg(ICONS['file'], APP_COLORS['icon_color']).pixmap(
+            QSize(self.FILE_ICON_SIZE, self.FILE_ICON_SIZE))
+        # One document is reused for every text bubble that gets measured or painted
+        self._doc = QTextDocument()
+        self._doc.setDocumentMargin(0)
+        self._doc.setDefaultFont(self.text_font)
+
+    def _document(self, entry, width=-1):
+        self._doc.setHtml(entry["html"])
+        self._doc.setTextWidth(width)
+        return self._doc
+
+    def _view_width(self, option):
+        view = self.parent()
+        return view.viewport().width() if view is not None else option.rect.width()
+
+    def _file_name_rect(self, content):
+        row_height = max(self.FILE_ICON_SIZE, QFontMetrics(self.bold_font).height())
+        offset = self.FILE_ICON_SIZE + 6
+        return QRect(content.left() + offset, content.top(), content.width() - offset, row_height)
+
+    @staticmethod
+    def _ping_text(entry):
+        count = entry.get("count", 1)
+        return f"PING!!! ×{count}" if count > 1 else "PING!!!"
+
+    @staticmethod
+    def _status(entry):
+        """Status text and colour name; group messages count delivered members"""
+        if entry["status"] != "group":
+            return MESSAGE_STATUS[entry["status"]]
+        delivered, total = entry["delivered"]
+        return f"✓ {delivered}/{total}", "primary_green" if delivered >= total else "timestamp"
+
+    def _footer_width(self, entry):
+        small = QFontMetrics(self.small_font)
+        width = small.horizontalAdvance(entry["time"])
+        if entry.get("status"):
+            width += 4 + small.horizontalAdvance(self._status(entry)[0])
+        return width
+
+    def _layout(self, entry, width):
+        """Bubble geometry relative to the row's top-left corner"""
+        cached = entry.get("layout")
+        if cached and cached[0] == width:
+            return cached[1]
+
+        max_content = max(int(width * BUBBLE_MAX_WIDTH) - 2 * self.PADDING_X, 40)
+        kind = entry["kind"]
+        footer_width = footer_height = 0
+        if kind == "ping":
+            bold = QFontMetrics(self.bold_font)
+            content_width = min(bold.horizontalAdvance(self._ping_text(entry)), max_content)
+            content_height = bold.height()
+        else:
+            small = QFontMetrics(self.small_font)
+            footer_width = self._footer_width(entry)
+            footer_height = small.height() + self.FOOTER_SPACING
+            if kind == "file":
+                bold = QFontMetrics(self.bold_font)
+                name_width = bold.horizontalAdvance(entry["filename"]) + self.FILE_ICON_SIZE + 6
+                content_width = min(max(self.FILE_MIN_WIDTH, name_width), max_content)
+                content_height = (max(self.FILE_ICON_SIZE, bold.height()) + 4
+                                  + self.PROGRESS_HEIGHT + 4 + small.height())
+            else:
+                doc = self._document(entry)
+                content_width = min(int(doc.idealWidth()) + 1, max_content)
+                doc.setTextWidth(content_width)
+                content_height = int(doc.size().height()) + 1
+
+        bubble_width = max(content_width, footer_width) + 2 * self.PADDING_X
+        bubble_height = content_height + footer_height + 2 * self.PADDING_Y
+        x = width - self.MARGIN_X - bubble_width if entry["is_sent"] else self.MARGIN_X
+        layout = {
+            "bubble": QRect(x, self.MARGIN_Y, bubble_width, bubble_height),
+            "content": QRect(x + self.PADDING_X, self.MARGIN_Y + self.PADDING_Y,
+                             bubble_width - 2 * self.PADDING_X, content_height),
+            "size": QSize(width, bubble_height + 2 * self.MARGIN_Y),
+        }
+        entry["layout"] = (width, layout)
+        return layout
+
+    def sizeHint(self, option, index):
+        entry = index.model().entry(index.row())
+        return self._layout(entry, self._view_width(option))["size"]
+
+    def paint(self, painter, option, index):
+        entry = index.model().entry(index.row())
+        layout = self._layout(entry, self._view_width(option))
+        bubble, content = layout["bubble"], layout["content"]
+
+        painter.save()
+        painter.setRenderHint(QPainter.RenderHint.Antialiasing)
+        painter.translate(option.rect.topLeft())
+        if entry["kind"] != "ping":
+            painter.setPen(Qt.PenStyle.NoPen)
+            painter.setBrush(QColor(APP_COLORS["outgoing_bg"] if entry["is_sent"] else APP_COLORS["incoming_bg"]))
+            painter.drawRoundedRect(bubble, 12, 12)
+
+        if entry["kind"] == "text":
+            painter.save()
+            painter.translate(content.topLeft())
+            self._document(entry, content.width()).drawContents(painter)
+            painter.restore()
+        elif entry["kind"] == "file":
+            self._paint_file(painter, entry, content)
+        else:
+            painter.setFont(self.bold_font)
+            painter.setPen(QColor(APP_COLORS['ping_color']))
+            painter.drawText(content, Qt.AlignmentFlag.AlignLeft | Qt.AlignmentFlag.AlignVCenter,
+                             self._ping_text(entry))
+
+        if entry["kind"] != "ping":
+            small = QFontMetrics(self.small_font)
+            painter.setFont(self.small_font)
+            top = content.bottom() + 1 + self.FOOTER_SPACING
+            right = bubble.right() + 1 - self.PADDING_X
+            if entry.get("status"):
+                text, color = self._status(entry)
+                text_width = small.horizontalAdvance(text)
+                painter.setPen(QColor(APP_COLORS[color]))
+                painter.drawText(QRect(right - text_width, top, text_width, small.height()),
+                                 Qt.AlignmentFlag.AlignRight, text)
+                right -= text_width + 4
+            time_width = small.horizontalAdvance(entry["time"])
+            painter.setPen(QColor(APP_COLORS['timestamp']))
+            painter.drawText(QRect(right - time_width, top, time_width, small.height()),
+                             Qt.AlignmentFlag.AlignRight, entry["time"])
+        painter.restore()
+
+    def _paint_file(self, painter, entry, content):
+        name_rect = self._file_name_rect(content)
+        painter.drawPixmap(content.left(), content.top() + (name_rect.height() - self.FILE_ICON_SIZE) // 2,
+                           self.file_icon)
+        font = self.link_font if entry.get("url") else self.bold_font
+        painter.setFont(font)
+        painter.setPen(QColor("#2196F3" if entry.get("url") else APP_COLORS['text_primary']))
+        name = QFontMetrics(font).elidedText(entry["filename"], Qt.TextElideMode.ElideMiddle, name_rect.width())
+        painter.drawText(name_rect, Qt.AlignmentFlag.AlignLeft | Qt.AlignmentFlag.AlignVCenter, name)
+
+        bar = QRect(content.left(), name_rect.bottom() + 5, content.width(), self.PROGRESS_HEIGHT)
+        painter.setPen(Qt.PenStyle.NoPen)
+        painter.setBrush(QColor(APP_COLORS['input_border']))
+        painter.drawRoundedRect(bar, 4, 4)
+        if entry["progress"] > 0:
+            bar.setWidth(max(int(bar.width() * min(entry["progress"], 1.0)), self.PROGRESS_HEIGHT))
+            painter.setBrush(QColor(APP_COLORS['primary_green']))
+            painter.drawRoundedRect(bar, 4, 4)
+
+        painter.setFont(self.small_font)
+        painter.setPen(QColor(APP_COLORS['ping_color' if entry.get("error") else 'timestamp']))
+        painter.drawText(QRect(content.left(), bar.bottom() + 5, content.width(),
+                               QFontMetrics(self.small_font).height()),
+                         Qt.AlignmentFlag.AlignLeft, entry["detail"])
+
+    def editorEvent(self, event, model, option, index):
+        """Open links in text bubbles and received files on click"""
+        if (event.type() == QEvent.Type.MouseButtonRelease
+                and event.button() == Qt.MouseButton.LeftButton):
+            entry = model.entry(index.row())
+            content = self._layout(entry, self._view_width(option))["content"]
+            pos = event.position().toPoint() - option.rect.topLeft()
+            url = None
+            if entry["kind"] == "text" and content.contains(pos):
+                anchor = self._document(entry, content.width()).documentLayout().anchorAt(
+                    QPointF(pos - content.topLeft()))
+                url = QUrl(anchor) if anchor else None
+            elif entry["kind"] == "file" and entry.get("url") and self._file_name_rect(content).contains(pos):
+                url = QUrl(entry["url"])
+            if url is not None:
+                QDesktopServices.openUrl(url)
+                return True
+        return super().editorEvent(event, model, option, index)
+
 class ZeroconfListener:
-    """Listener for Zeroconf service discovery"""
+    """Listener for Zeroconf service discovery.
+
+    Runs on the zeroconf event loop: every discovered service is resolved in
+    its own task, so one slow responder never holds up the others.
+    """
     def __init__(self, network_manager):
         self.network_manager = network_manager
+        self._resolving = {}    # service name -> pending resolve task
+        self._stale = set()     # names updated while their resolve was running
+        self._announced = {}    # service name -> peer data last emitted
+
+    def on_service_state_change(self, zeroconf, service_type, name, state_change):
+        if state_change is ServiceStateChange.Removed:
+            self.remove_service(zeroconf, service_type, name)
+        elif name in self._resolving:
+            self._stale.add(name)
+        else:
+            self._resolving[name] = asyncio.ensure_future(
+                self._resolve(zeroconf, service_type, name))
 
     def remove_service(self, zeroconf, type, name):
+        task = self._resolving.pop(name, None)
+        if task:
+            task.cancel()
+        self._stale.discard(name)
+        self._announced.pop(name, None)
         self.network_manager.user_went_offline.emit(name)
 
-    def add_service(self, zeroconf, type, name):
+    def cancel(self):
+        """Abandon resolves still in flight; called on the event loop"""
+        for task in self._resolving.values():
+            task.cancel()
+        self._resolving.clear()
+
+    async def _resolve(self, zeroconf, type, name):
+        task = asyncio.current_task()
         try:
-            info = zeroconf.get_service_info(type, name)
-            if not info:
-                return
-                
-            my_hostname = socket.gethostname()
-            if info.server in [f"{my_hostname}.local.", f"{my_hostname}."]:
-                return
-                
-            if not info.addresses:
+            info = AsyncServiceInfo(type, name)
+            if not await info.async_request(zeroconf, DISCOVERY_RESOLVE_TIMEOUT):
                 return
-                
-            peer_data = {
-                "name": name,
-                "username": info.properties.get(b'username', b'unknown').decode('utf-8'),
-                "address": socket.inet_ntoa(info.addresses[0]),
-                "port": info.port
-            }
-            self.network_manager.user_discovered.emit(peer_data)
+            peer_data = self._peer_data(info, name)
+            # Updates that change nothing we use are not announced again
+            if peer_data and self._announced.get(name) != peer_data:
+                self._announced[name] = peer_data
+                self.network_manager.peers.add(peer_data)
+                self.network_manager.user_discovered.emit(peer_data)
+        except asyncio.CancelledError:
+            raise
         except Exception as e:
             print(f"Error processing service {name}: {e}")
+        finally:
+            if self._resolving.get(name) is task:
+                del self._resolving[name]
+                if name in self._stale:
+                    self._stale.discard(name)
+                    self._resolving[name] = asyncio.ensure_future(
+                        self._resolve(zeroconf, type, name))
 
-    def update_service(self, zeroconf, type, name):
-        self.add_service(zeroconf, type, name)
+    def _peer_data(self, info, name):
+        my_hostname = socket.gethostname()
+        if info.server in [f"{my_hostname}.local.", f"{my_hostname}."]:
+            return None
+            
+        addresses = info.parsed_scoped_addresses()
+        if not addresses:
+            return None
+        v4 = sorted(a for a in addresses if ':' not in a)
+        v6 = sorted(a for a in addresses if ':' in a)
+            
+        return {
+            "name": name,
+            "username": info.properties.get(b'username', b'unknown').decode('utf-8'),
+            "address": (v4 or v6)[0],
+            "addresses": v4 + v6,
+            "port": info.port,
+            "proto": int(info.properties.get(b'proto', b'1') or b'1')
+        }
 
-class AdvancedNetworkManager(QObject):
-    """Network manager handling discovery and communication"""
-    user_discovered = Signal(dict)
-    user_went_offline = Signal(str)
-    private_message_received = Signal(dict)
-    
+class PeerRegistry:
+    """Known peers keyed by service name, with indexes by username and address.
+
+    Shared by the discovery listener, the network layer and the GUI, so
+    every lookup is a dict access whatever the number of peers.
+    """
     def __init__(self):
-        super().__init__()
-        self.username = getpass.getuser()
-        self.my_ip = self._get_local_ip()
-        self.port = self._get_free_port()
-        self.running = True
-        self.zeroconf = Zeroconf(ip_version=socket.AF_INET)
-        self.listener = ZeroconfListener(self)
-        self.browser = None
-        
-        self.service_info = ServiceInfo(
-            SERVICE_TYPE,
-            f"{self.username}._S.{SERVICE_TYPE}",
-            addresses=[socket.inet_aton(self.my_ip)],
-            port=self.port,
-            properties={'username': self.username.encode('utf-8')}
-        )
+        self._lock = threading.Lock()
+        self._by_name = {}
+        self._by_username = {}
+        self._by_address = {}
 
-    def _get_local_ip(self):
-        """Get local IP address that can reach the internet"""
+    def _index(self, index, key, name):
+        index.setdefault(key, set()).add(name)
+
+    def _unindex(self, index, key, name):
+        names = index.get(key)
+        if names:
+            names.discard(name)
+            if not names:
+                del index[key]
+
+    def _addresses(self, peer_data):
+        return {normalize_address(a) for a in peer_data.get('addresses') or [peer_data['address']]}
+
+    def add(self, peer_data):
+        name = peer_data['name']
+        with self._lock:
+            old = self._by_name.get(name)
+            if old:
+                self._unindex(self._by_username, old['username'], name)
+                for address in self._addresses(old):
+                    self._unindex(self._by_address, address, name)
+            self._by_name[name] = peer_data
+            self._index(self._by_username, peer_data['username'], name)
+            for address in self._addresses(peer_data):
+                self._index(self._by_address, address, name)
+
+    def remove(self, name):
+        with self._lock:
+            peer_data = self._by_name.pop(name, None)
+            if peer_data:
+                self._unindex(self._by_username, peer_data['username'], name)
+                for address in self._addresses(peer_data):
+                    self._unindex(self._by_address, address, name)
+            return peer_data
+
+    def get(self, name):
+        with self._lock:
+            return self._by_name.get(name)
+
+    def resolve(self, message, address=None):
+        """The peer a message came from: its service name if it carries one,
+        otherwise the sender's username, narrowed down by source address"""
+        with self._lock:
+            peer_data = self._by_name.get(message.get("from_service"))
+            if peer_data:
+                return peer_data
+            names = self._by_username.get(message.get("from_user"), set())
+            if address is not None and len(names) > 1:
+                names = names & self._by_address.get(normalize_address(address), set()) or names
+            return self._by_name[min(names)] if names else None
+
+class PeerRoster(QObject):
+    """Turns raw discovery events into batched roster changes.
+
+    Events are collected for ROSTER_DEBOUNCE ms and compared with the roster
+    last published, so a burst of announcements becomes one roster_changed
+    with only real differences in it. A peer that disappears is kept for
+    ROSTER_OFFLINE_GRACE seconds and survives an mDNS flap unnoticed.
+    """
+    roster_changed = Signal(list, list, list)  # added peers, updated peers, removed names
+
+    def __init__(self, registry, parent=None):
+        super().__init__(parent)
+        self.registry = registry
+        self._published = {}    # service name -> peer data in the roster
+        self._seen = {}         # service name -> latest peer data not yet published
+        self._lost = {}         # service name -> monotonic time it went away
+
+        self._flush_timer = QTimer(self)
+        self._flush_timer.setSingleShot(True)
+        self._flush_timer.setInterval(ROSTER_DEBOUNCE)
+        self._flush_timer.timeout.connect(self.flush)
+        self._grace_timer = QTimer(self)
+        self._grace_timer.setSingleShot(True)
+        self._grace_timer.timeout.connect(self.flush)
+
+    def peer_seen(self, peer_data):
+        self._lost.pop(peer_data['name'], None)
+        self._seen[peer_data['name']] = peer_data
+        if not self._flush_timer.isActive():
+            self._flush_timer.start()
+
+    def peer_lost(self, name):
+        self._seen.pop(name, None)
+        if name in self._published:
+            self._lost.setdefault(name, time.monotonic())
+            if not self._grace_timer.isActive():
+                self._grace_timer.start(ROSTER_OFFLINE_GRACE * 1000)
+
+    def flush(self):
+        """Publish what changed since the last flush"""
+        added, updated, removed = [], [], []
+        for name, peer_data in self._seen.items():
+            old = self._published.get(name)
+            if old is None:
+                added.append(peer_data)
+            elif old != peer_data:
+                updated.append(peer_data)
+            self._published[name] = peer_data
+        self._seen.clear()
+
+        now = time.monotonic()
+        for name, since in list(self._lost.items()):
+            if now - since >= ROSTER_OFFLINE_GRACE:
+                del self._lost[name]
+                del self._published[name]
+                self.registry.remove(name)
+                removed.append(name)
+        if self._lost:
+            next_expiry = min(self._lost.values()) + ROSTER_OFFLINE_GRACE - now
+            self._grace_timer.start(max(0, int(next_expiry * 1000)) + 1)
+
+        if added or updated or removed:
+            self.roster_changed.emit(added, updated, removed)
+
+    def is_listed(self, name):
+        """Whether the GUI has been given this peer and so has a chat for it"""
+        return name in self._published
+
+# --- Shared TLS State ---
+_ssl_context_lock = threading.Lock()
+_server_ssl_context = None
+_client_ssl_context = None
+
+def get_server_ssl_context():
+    """Return the process-wide server SSLContext, loading the certificate once"""
+    global _server_ssl_context
+    with _ssl_context_lock:
+        if _server_ssl_context is None:
+            context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+            context.load_cert_chain(certfile=CERTFILE, keyfile=KEYFILE)
+            _server_ssl_context = context
+        return _server_ssl_context
+
+def get_client_ssl_context():
+    """Return the process-wide client SSLContext shared by every outbound connection"""
+    global _client_ssl_context
+    with _ssl_context_lock:
+        if _client_ssl_context is None:
+            context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+            _client_ssl_context = context
+        return _client_ssl_context
+
+class TLSSessionCache:
+    """Client-side TLS sessions keyed by peer, plus full/resumed handshake counters"""
+    def __init__(self):
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self.counters = {
+            "client_full": 0, "client_resumed": 0,
+            "server_full": 0, "server_resumed": 0,
+        }
+
+    def get(self, key):
+        with self._lock:
+            return self._sessions.get(key)
+
+    def store(self, key, ssock):
+        """Remember a resumable session from an established connection"""
         try:
-            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
-                s.connect(("8.8.8.8", 80))
-                return s.getsockname()[0]
-        except OSError:
-            try:
-                return socket.gethostbyname(socket.gethostname())
-            except socket.gaierror:
-                return "127.0.0.1"
+            session = ssock.session
+        except (OSError, ValueError):
+            return
+        # TLS 1.3 sessions only become resumable once the ticket has arrived
+        if session is not None and (session.has_ticket or session.id):
+            with self._lock:
+                self._sessions[key] = session
 
-    def _get_free_port(self):
-        """Find a free port to use"""
-        with socket.socket() as s:
-            s.bind(('', 0))
-            return s.getsockname()[1]
+    def forget(self, key):
+        with self._lock:
+            self._sessions.pop(key, None)
 
-    def start_discovery(self):
-        """Start service discovery"""
-        QTimer.singleShot(0, self._start_zeroconf)
+    def record_handshake(self, ssock, server_side=False):
+        """Count a completed handshake as full or resumed"""
+        side = "server" if server_side else "client"
+        kind = "resumed" if ssock.session_reused else "full"
+        with self._lock:
+            self.counters[f"{side}_{kind}"] += 1
 
-    def _start_zeroconf(self):
-        """Initialize Zeroconf service browser and registration"""
+    def stats(self):
+        with self._lock:
+            return dict(self.counters)
+
+# --- Addressing ---
+def normalize_address(address):
+    """Plain IP string: IPv4-mapped IPv6 unwrapped, scope id dropped"""
+    address = address.split('%', 1)[0]
+    if address.startswith('::ffff:') and '.' in address:
+        return address[7:]
+    return address
+
+def order_addresses(addresses, preferred=None):
+    """Connection order for a peer: the address that worked last first, then
+    IPv6 and IPv4 alternating as RFC 8305 recommends"""
+    v6 = [a for a in addresses if ':' in a and a != preferred]
+    v4 = [a for a in addresses if ':' not in a and a != preferred]
+    ordered = [preferred] if preferred in addresses else []
+    for pair in itertools.zip_longest(v6, v4):
+        ordered.extend(a for a in pair if a)
+    return ordered
+
+def local_addresses():
+    """Addresses of every usable interface, IPv4 first; loopback is skipped"""
+    v4, v6 = [], []
+    for adapter in ifaddr.get_adapters():
+        for ip in adapter.ips:
+            if isinstance(ip.ip, tuple):
+                address, _flowinfo, scope_id = ip.ip
+                if address == '::1':
+                    continue
+                v6.append(f"{address}%{scope_id}" if address.startswith('fe80') else address)
+            elif not ip.ip.startswith('127.'):
+                v4.append(ip.ip)
+    return v4 + v6
+
+def race_connect(addresses, port, timeout=CONNECT_TIMEOUT, delay=CONNECT_ATTEMPT_DELAY):
+    """Connect to whichever of a peer's addresses answers first.
+
+    Attempts start CONNECT_ATTEMPT_DELAY apart (sooner when one fails) and
+    run side by side, so an unreachable first address costs a fraction of a
+    second instead of the whole timeout. Returns (socket, address).
+    """
+    deadline = time.monotonic() + timeout
+    pending = list(addresses)
+    attempts = {}
+    error = None
+    next_start = 0
+    try:
+        while pending or attempts:
+            now = time.monotonic()
+            if now >= deadline:
+                break
+            if pending and (now >= next_start or not attempts):
+                address = pending.pop(0)
+                sock = None
+                try:
+                    family = socket.AF_INET6 if ':' in address else socket.AF_INET
+                    sockaddr = socket.getaddrinfo(address, port, family, socket.SOCK_STREAM)[0][4]
+                    sock = socket.socket(family, socket.SOCK_STREAM)
+                    sock.setblocking(False)
+                    err = sock.connect_ex(sockaddr)
+                    if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                        raise OSError(err, os.strerror(err))
+                    attempts[sock] = address
+                except OSError as e:
+                    error = e
+                    if sock:
+                        sock.close()
+                    continue
+                next_start = now + delay
+            wake = min(deadline, next_start) if pending else deadline
+            _, writable, failed = select.select(
+                [], list(attempts), list(attempts), max(0, wake - time.monotonic()))
+            for sock in set(writable) | set(failed):
+                address = attempts.pop(sock)
+                err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if err:
+                    error = OSError(err, os.strerror(err))
+                    sock.close()
+                    next_start = 0
+                    continue
+                sock.setblocking(True)
+                sock.settimeout(timeout)
+                return sock, address
+    finally:
+        for sock in attempts:
+            sock.close()
+    raise error or socket.timeout("timed out")
+
+# --- Framing ---
+def recv_exact(sock, n, deadline=None):
+    """Receive exactly n bytes from socket into one preallocated buffer.
+
+    The buffer is sized from the length prefix up front and filled in place
+    with recv_into, so a large frame costs a single allocation and no
+    per-packet copies. Returns the bytearray, or None on EOF, error or once
+    the overall deadline (default: SERVER_READ_TIMEOUT from now) passes.
+    """
+    if deadline is None:
+        deadline = time.monotonic() + SERVER_READ_TIMEOUT
+    data = bytearray(n)
+    view = memoryview(data)
+    received = 0
+    while received < n:
         try:
-            self.browser = ServiceBrowser(self.zeroconf, SERVICE_TYPE, self.listener)
-            self._register_service()
-            threading.Thread(target=self.run_tls_server, daemon=True).start()
-        except Exception as e:
-            print(f"Failed to start Zeroconf: {e}")
+            count = sock.recv_into(view[received:], n - received)
+            if not count:
+                return None
+            received += count
+        except (socket.timeout, ssl.SSLWantReadError):
+            if time.monotonic() >= deadline:
+                return None
+        except Exception:
+            return None
+    return data
 
-    def _register_service(self):
-        """Register our service with Zeroconf"""
+def encode_legacy_frame(message_dict):
+    """Encode a message in the v1 format: length prefix + JSON"""
+    message_bytes = json.dumps(message_dict).encode('utf-8')
+    # Prefix message with its length (4-byte big-endian)
+    return struct.pack('>I', len(message_bytes)) + message_bytes
+
+def encode_frame(frame_type, stream_id, payload):
+    """Encode one v2 frame"""
+    return FRAME_HEADER.pack(PROTOCOL_VERSION, frame_type, stream_id, len(payload)) + payload
+
+class ProtocolError(Exception):
+    """The peer sent something that does not fit the wire protocol"""
+
+def recv_frame(sock, idle_deadline, read_timeout=SERVER_READ_TIMEOUT):
+    """Read one v2 frame as (frame type, stream id, payload); None on a clean EOF"""
+    header = recv_exact(sock, FRAME_HEADER.size, idle_deadline)
+    if not header:
+        return None
+    version, frame_type, stream_id, length = FRAME_HEADER.unpack(header)
+    if version != PROTOCOL_VERSION or length > MAX_FRAME_SIZE:
+        raise ProtocolError(f"Invalid frame (version {version}, {length} bytes)")
+    payload = recv_exact(sock, length, time.monotonic() + read_timeout)
+    if payload is None:
+        raise ProtocolError("Slow or incomplete frame")
+    return frame_type, stream_id, payload
+
+def frame_type_for(message_dict):
+    """Pick the v2 frame type that carries a chat message"""
+    return {"text": FRAME_TEXT, "ping": FRAME_PING}.get(message_dict.get("type"), FRAME_CONTROL)
+
+def message_problem(message):
+    """Why a received chat message cannot be shown, or None if it is well formed"""
+    if not isinstance(message, dict):
+        return "not an object"
+    msg_type = message.get("type")
+    if msg_type not in ("text", "ping", "group_update"):
+        return f"unexpected type {msg_type!r}"
+    timestamp = message.get("timestamp")
+    if isinstance(timestamp, bool) or not isinstance(timestamp, (int, float)):
+        return "missing timestamp"
+    for field in ("id", "from_user", "from_service"):
+        if field in message and not isinstance(message[field], str):
+            return f"{field} is not a string"
+    if msg_type == "text" and not isinstance(message.get("content"), str):
+        return "missing content"
+    count = message.get("count", 1)
+    if msg_type == "ping" and (isinstance(count, bool) or not isinstance(count, int)):
+        return "count is not a number"
+    group = message.get("group")
+    if group is not None and not (
+            isinstance(group, dict) and isinstance(group.get("id"), str)
+            and isinstance(group.get("name", ""), str)
+            and isinstance(group.get("members"), list)
+            and all(isinstance(member, str) for member in group["members"])):
+        return "malformed group"
+    if msg_type == "group_update" and group is None:
+        return "group update without a group"
+    return None
+
+# --- Payload Codecs ---
+class JsonCodec:
+    """Text codec every peer understands; bytes travel as base64"""
+    name = "json"
+
+    @staticmethod
+    def _default(obj):
+        if isinstance(obj, (bytes, bytearray, memoryview)):
+            return {"$bytes": base64.b64encode(obj).decode('ascii')}
+        raise TypeError(f"Cannot encode {type(obj).__name__}")
+
+    @staticmethod
+    def _object_hook(obj):
+        if len(obj) == 1 and "$bytes" in obj:
+            return base64.b64decode(obj["$bytes"])
+        return obj
+
+    def encode(self, obj):
+        return json.dumps(obj, default=self._default).encode('utf-8')
+
+    def decode(self, buffer):
         try:
-            self.zeroconf.register_service(self.service_info)
-            print(f"Announcing self: {self.username} at {self.my_ip}:{self.port}")
-        except Exception as e:
-            print(f"Zeroconf register_service error: {e}")
-            if "NonUniqueNameException" in str(e):
-                unique_id = uuid.uuid4().hex[:8]
-                self.service_info.name = f"{self.username}-{unique_id}._S.{SERVICE_TYPE}"
-                try:
-                    self.zeroconf.register_service(self.service_info)
-                except Exception as e2:
-                    print(f"Failed to register service after renaming: {e2}")
+            return json.loads(bytes(buffer) if isinstance(buffer, memoryview) else buffer,
+                              object_hook=self._object_hook)
+        except RecursionError as e:
+            raise ValueError("JSON payload nested too deeply") from e
 
-    def stop(self):
-        """Clean up network resources"""
-        self.running = False
+class CompactCodec:
+    """MessagePack-compatible binary codec for the types messages use.
+
+    Byte strings are carried raw, and decoding reads straight out of the
+    receive buffer: binary values come back as memoryview slices of it
+    rather than copies, so call bytes() on them to keep them past the
+    frame's lifetime.
+    """
+    name = "compact"
+
+    def encode(self, obj):
+        out = bytearray()
+        self._encode(obj, out)
+        return bytes(out)
+
+    def _encode(self, obj, out):
+        if obj is None:
+            out.append(0xc0)
+        elif obj is True:
+            out.append(0xc3)
+        elif obj is False:
+            out.append(0xc2)
+        elif isinstance(obj, int):
+            if 0 <= obj < 0x80:
+                out.append(obj)
+            elif -32 <= obj < 0:
+                out += struct.pack('>b', obj)
+            elif -(1 << 63) <= obj < (1 << 63):
+                out.append(0xd3)
+                out += struct.pack('>q', obj)
+            elif 0 <= obj < (1 << 64):
+                out.append(0xcf)
+                out += struct.pack('>Q', obj)
+            else:
+                raise ValueError("Integer too large to encode")
+        elif isinstance(obj, float):
+            out.append(0xcb)
+            out += struct.pack('>d', obj)
+        elif isinstance(obj, str):
+            data = obj.encode('utf-8')
+            self._header(out, len(data), 0xa0, 32, 0xd9, 0xda, 0xdb)
+            out += data
+        elif isinstance(obj, (bytes, bytearray, memoryview)):
+            self._header(out, len(obj), None, 0, 0xc4, 0xc5, 0xc6)
+            out += obj
+        elif isinstance(obj, (list, tuple)):
+            self._header(out, len(obj), 0x90, 16, None, 0xdc, 0xdd)
+            for item in obj:
+                self._encode(item, out)
+        elif isinstance(obj, dict):
+            self._header(out, len(obj), 0x80, 16, None, 0xde, 0xdf)
+            for key, value in obj.items():
+                self._encode(key, out)
+                self._encode(value, out)
+        else:
+            raise TypeError(f"Cannot encode {type(obj).__name__}")
+
+    @staticmethod
+    def _header(out, length, fix_tag, fix_limit, tag8, tag16, tag32):
+        if fix_tag is not None and length < fix_limit:
+            out.append(fix_tag | length)
+        elif tag8 is not None and length < 0x100:
+            out += struct.pack('>BB', tag8, length)
+        elif length < 0x10000:
+            out += struct.pack('>BH', tag16, length)
+        else:
+            out += struct.pack('>BI', tag32, length)
+
+    def decode(self, buffer):
+        view = memoryview(buffer)
         try:
-            if self.browser:
-                self.browser.cancel()
-            self.zeroconf.unregister_service(self.service_info)
-            self.zeroconf.close()
-        except Exception as e:
-            print(f"Error while stopping Zeroconf: {e}")
+            obj, offset = self._decode(view, 0)
+        except (struct.error, IndexError, UnicodeDecodeError) as e:
+            raise ValueError(f"Malformed compact payload: {e}") from e
+        if offset != len(view):
+            raise ValueError("Trailing data after compact payload")
+        return obj
 
-        # Wake up the server socket if it's blocked on accept()
+    def _take(self, view, offset, length):
+        end = offset + length
+        if end > len(view):
+            raise ValueError("Truncated compact payload")
+        return view[offset:end], end
+
+    def _decode(self, view, offset, depth=0):
+        tag = view[offset]
+        offset += 1
+        if tag < 0x80:
+            return tag, offset
+        if tag >= 0xe0:
+            return tag - 0x100, offset
+        if 0xa0 <= tag <= 0xbf:
+            data, offset = self._take(view, offset, tag & 0x1f)
+            return str(data, 'utf-8'), offset
+        if 0x90 <= tag <= 0x9f:
+            return self._decode_list(view, offset, tag & 0x0f, depth)
+        if 0x80 <= tag <= 0x8f:
+            return self._decode_dict(view, offset, tag & 0x0f, depth)
+        if tag == 0xc0:
+            return None, offset
+        if tag == 0xc2:
+            return False, offset
+        if tag == 0xc3:
+            return True, offset
+        if tag == 0xcb:
+            return struct.unpack_from('>d', view, offset)[0], offset + 8
+        if tag == 0xd3:
+            return struct.unpack_from('>q', view, offset)[0], offset + 8
+        if tag == 0xcf:
+            return struct.unpack_from('>Q', view, offset)[0], offset + 8
+        sized = {
+            0xd9: ('>B', 'str'), 0xda: ('>H', 'str'), 0xdb: ('>I', 'str'),
+            0xc4: ('>B', 'bin'), 0xc5: ('>H', 'bin'), 0xc6: ('>I', 'bin'),
+            0xdc: ('>H', 'list'), 0xdd: ('>I', 'list'),
+            0xde: ('>H', 'dict'), 0xdf: ('>I', 'dict'),
+        }.get(tag)
+        if sized is None:
+            raise ValueError(f"Unsupported compact type 0x{tag:02x}")
+        fmt, kind = sized
+        length = struct.unpack_from(fmt, view, offset)[0]
+        offset += struct.calcsize(fmt)
+        if kind == 'list':
+            return self._decode_list(view, offset, length, depth)
+        if kind == 'dict':
+            return self._decode_dict(view, offset, length, depth)
+        data, offset = self._take(view, offset, length)
+        return (str(data, 'utf-8') if kind == 'str' else data), offset
+
+    @staticmethod
+    def _check_depth(depth):
+        if depth >= MAX_DECODE_DEPTH:
+            raise ValueError(f"Compact payload nested deeper than {MAX_DECODE_DEPTH}")
+
+    def _decode_list(self, view, offset, count, depth):
+        self._check_depth(depth)
+        items = []
+        for _ in range(count):
+            item, offset = self._decode(view, offset, depth + 1)
+            items.append(item)
+        return items, offset
+
+    def _decode_dict(self, view, offset, count, depth):
+        self._check_depth(depth)
+        result = {}
+        for _ in range(count):
+            key, offset = self._decode(view, offset, depth + 1)
+            if isinstance(key, memoryview):
+                key = bytes(key)
+            result[key], offset = self._decode(view, offset, depth + 1)
+        return result, offset
+
+CODECS = {codec.name: codec for codec in (CompactCodec(), JsonCodec())}
+
+def choose_codec(offered):
+    """Pick the first codec from a peer's preference list that we also support"""
+    for name in offered or ():
+        if name in CODECS:
+            return CODECS[name]
+    return CODECS["json"]
+
+class PooledConnection:
+    """A live TLS connection to one peer plus its bookkeeping"""
+    def __init__(self, ssock, address, port, protocol=1):
+        self.ssock = ssock
+        self.address = address
+        self.port = port
+        self.protocol = protocol
+        self.codec = CODECS["json"]
+        self.features = frozenset()
+        self.last_used = time.monotonic()
+        self.lock = threading.Lock()
+        self.inbox = bytearray()
+        self.held_acks = deque(maxlen=POOL_HELD_ACKS)  # msg_acks read by the health monitor
+
+    def is_alive(self):
+        """Check, without blocking, that the peer has not closed the connection"""
         try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                s.settimeout(1)
-                s.connect((self.my_ip, self.port))
-        except:
-            pass
+            readable, _, _ = select.select([self.ssock], [], [], 0)
+        except (OSError, ValueError):
+            return False
+        if not readable:
+            return True
+        if not self.lock.acquire(blocking=False):
+            return True  # in use right now, so not dead
 
-    def _recvall(self, sock, n):
-        """Receive exactly n bytes from socket"""
-        data = bytearray()
-        while len(data) < n:
+        # Readable on an idle client socket means EOF, a close_notify, a
+        # post-handshake TLS record such as a session ticket, or a late probe
+        # reply; data is kept in the inbox so frames stay intact.
+        self.ssock.setblocking(False)
+        try:
+            data = self.ssock.recv(65536)
+            self.inbox += data
+            return data != b''
+        except (ssl.SSLWantReadError, ssl.SSLWantWriteError, BlockingIOError):
+            return True
+        except (OSError, ssl.SSLError):
+            return False
+        finally:
             try:
-                packet = sock.recv(n - len(data))
-                if not packet:
+                self.ssock.settimeout(CONNECT_TIMEOUT)
+            except OSError:
+                pass
+            self.lock.release()
+
+    def poll_frame(self, timeout=0):
+        """Return the next v2 frame the peer sent, or None if none arrives within timeout.
+
+        Reads are non-blocking and buffered in the inbox, so a readable
+        socket that only carried TLS housekeeping never stalls the caller.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            frame = self._parse_frame()
+            if frame:
+                return frame
+            if not self.ssock.pending():
+                remaining = max(deadline - time.monotonic(), 0)
+                readable, _, _ = select.select([self.ssock], [], [], remaining)
+                if not readable:
                     return None
-                data.extend(packet)
-            except (socket.timeout, ConnectionResetError):
-                continue
-            except Exception:
-                return None
+            self.ssock.setblocking(False)
+            try:
+                data = self.ssock.recv(65536)
+                if not data:
+                    raise ProtocolError("Peer closed the connection")
+                self.inbox += data
+            except (ssl.SSLWantReadError, ssl.SSLWantWriteError, BlockingIOError):
+                pass
+            finally:
+                self.ssock.settimeout(CONNECT_TIMEOUT)
+
+    def _parse_frame(self):
+        if len(self.inbox) < FRAME_HEADER.size:
+            return None
+        version, frame_type, stream_id, length = FRAME_HEADER.unpack_from(self.inbox)
+        if version != PROTOCOL_VERSION or length > MAX_FRAME_SIZE:
+            raise ProtocolError(f"Invalid frame (version {version}, {length} bytes)")
+        end = FRAME_HEADER.size + length
+        if len(self.inbox) < end:
+            return None
+        payload = bytes(self.inbox[FRAME_HEADER.size:end])
+        del self.inbox[:end]
+        return frame_type, stream_id, payload
+
+    def close(self):
+        try:
+            self.ssock.close()
+        except OSError:
+            pass
+
+class PeerDownError(ConnectionError):
+    """The peer failed recently and has not answered a probe since"""
+
+class PeerHealth:
+    """Smoothed round-trip time and loss rate per peer.
+
+    Samples come from connection setup and from probes on pooled
+    connections; RTT and its variance are tracked as in RFC 6298 and loss
+    as an EWMA of lost vs answered probes. ``on_change(name, rtt, loss,
+    reachable)`` is called after every sample. The peer info last seen for
+    a peer is kept so the monitor can reconnect to it once it is down.
+    """
+    def __init__(self, on_change=None):
+        self.on_change = on_change
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def _entry(self, key):
+        return self._stats.setdefault(key, {
+            "srtt": None, "rttvar": 0.0, "loss": 0.0,
+            "failures": 0, "down_since": None, "peer_info": None,
+        })
+
+    def record_rtt(self, key, rtt, peer_info=None):
+        with self._lock:
+            stats = self._entry(key)
+            if stats["srtt"] is None:
+                stats["srtt"], stats["rttvar"] = rtt, rtt / 2
+            else:
+                stats["rttvar"] += HEALTH_RTTVAR_GAIN * (abs(stats["srtt"] - rtt) - stats["rttvar"])
+                stats["srtt"] += HEALTH_RTT_GAIN * (rtt - stats["srtt"])
+            stats["loss"] -= HEALTH_LOSS_GAIN * stats["loss"]
+            stats["failures"] = 0
+            stats["down_since"] = None
+            if peer_info:
+                stats["peer_info"] = peer_info
+        self._changed(key)
+
+    def record_failure(self, key, peer_info=None, down=False):
+        """A lost probe, or with down=True a failed connect, which is conclusive"""
+        with self._lock:
+            stats = self._entry(key)
+            stats["loss"] += HEALTH_LOSS_GAIN * (1 - stats["loss"])
+            stats["failures"] = max(stats["failures"] + 1, HEALTH_DOWN_AFTER if down else 0)
+            if stats["failures"] >= HEALTH_DOWN_AFTER and stats["down_since"] is None:
+                stats["down_since"] = time.monotonic()
+            if peer_info:
+                stats["peer_info"] = peer_info
+        self._changed(key)
+
+    def revive(self, key):
+        """Forget that a peer was down, e.g. because it was just rediscovered"""
+        with self._lock:
+            stats = self._stats.get(key)
+            if not stats or stats["down_since"] is None:
+                return
+            stats["failures"] = 0
+            stats["down_since"] = None
+        self._changed(key)
+
+    def is_down(self, key):
+        with self._lock:
+            stats = self._stats.get(key)
+            return bool(stats and stats["down_since"] is not None)
+
+    def connect_timeout(self, key):
+        """CONNECT_TIMEOUT for unknown peers, a few RTOs for measured ones"""
+        with self._lock:
+            stats = self._stats.get(key)
+            if not stats or stats["srtt"] is None:
+                return CONNECT_TIMEOUT
+            rto = stats["srtt"] + 4 * stats["rttvar"]
+        return min(CONNECT_TIMEOUT, max(CONNECT_MIN_TIMEOUT, 4 * rto))
+
+    def down_peers(self):
+        """Peers to probe for recovery; ones down for too long are dropped"""
+        now = time.monotonic()
+        with self._lock:
+            for key, stats in list(self._stats.items()):
+                if stats["down_since"] is not None and now - stats["down_since"] > HEALTH_FORGET_AFTER:
+                    del self._stats[key]
+            return [(key, stats["peer_info"]) for key, stats in self._stats.items()
+                    if stats["down_since"] is not None and stats["peer_info"]]
+
+    def estimate(self, key):
+        """(rtt seconds or None, loss fraction, reachable) for a peer"""
+        with self._lock:
+            stats = self._stats.get(key)
+            if not stats:
+                return None, 0.0, True
+            return stats["srtt"], stats["loss"], stats["down_since"] is None
+
+    def _changed(self, key):
+        if self.on_change:
+            self.on_change(key, *self.estimate(key))
+
+class PeerConnectionPool:
+    """Keeps one long-lived TLS connection per peer and reuses it for many frames.
+
+    Connections are keyed by the peer's service name, closed after
+    POOL_IDLE_TIMEOUT seconds without traffic and re-established
+    transparently (resuming the previous TLS session) when a send finds
+    them dead. Peers that advertise protocol v2 are greeted with a hello
+    frame; peers that do not answer it get the v1 format, one frame per
+    connection.
+    """
+    def __init__(self, context, session_cache, hello_message, health, idle_timeout=POOL_IDLE_TIMEOUT):
+        self.context = context
+        self.session_cache = session_cache
+        self.hello_message = hello_message
+        self.health = health
+        self.probe_answered = None  # called with a probe_ack's seq read while awaiting acks
+        self.idle_timeout = idle_timeout
+        self._connections = {}
+        self._protocols = {}
+        self._preferred = {}    # service name -> address that connected last
+        self._encoded = OrderedDict()  # (message id, codec) -> frame
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        threading.Thread(target=self._reap_idle, daemon=True).start()
+
+    def _addresses(self, key, peer_info):
+        return order_addresses(peer_info.get('addresses') or [peer_info['address']],
+                               self._preferred.get(key))
+
+    def _connect(self, key, peer_info):
+        """Open a new TLS connection, resuming a cached session when possible.
+
+        All of the peer's addresses are raced and the one that answers
+        first is tried first next time. Peers known to be down fail at once,
+        and the timeout follows the peer's measured RTT.
+        """
+        if self.health.is_down(key):
+            raise PeerDownError(f"{peer_info.get('username')} has not answered recently")
+        port = peer_info['port']
+        started = time.monotonic()
+        try:
+            sock, address = race_connect(self._addresses(key, peer_info), port,
+                                         self.health.connect_timeout(key))
+        except OSError:
+            self.health.record_failure(key, peer_info, down=True)
+            raise
+        self.health.record_rtt(key, time.monotonic() - started, peer_info)
+        self._preferred[key] = address
+        hostname = normalize_address(address)
+        try:
+            ssock = self.context.wrap_socket(
+                sock, server_hostname=hostname, session=self.session_cache.get(key))
+        except ssl.SSLError:
+            # A stale session can be rejected outright; retry with a full handshake
+            sock.close()
+            self.session_cache.forget(key)
+            sock, address = race_connect([address], port)
+            ssock = self.context.wrap_socket(sock, server_hostname=hostname)
+        except Exception:
+            sock.close()
+            raise
+        self.session_cache.record_handshake(ssock)
+        return PooledConnection(ssock, address, port)
+
+    def _negotiate(self, conn):
+        """Offer protocol v2 with a v1 hello frame; True if the peer accepts"""
+        try:
+            conn.ssock.sendall(encode_legacy_frame(self.hello_message))
+            deadline = time.monotonic() + HELLO_TIMEOUT
+            raw_len = recv_exact(conn.ssock, 4, deadline)
+            if not raw_len:
+                return False
+            reply_len = struct.unpack('>I', raw_len)[0]
+            if reply_len > MAX_FRAME_SIZE:
+                return False
+            reply = recv_exact(conn.ssock, reply_len, deadline)
+            if not reply:
+                return False
+            reply = json.loads(reply)
+        except (OSError, ValueError):
+            return False
+        if reply.get("type") != "hello" or int(reply.get("proto", 1)) < 2:
+            return False
+        conn.protocol = min(int(reply["proto"]), PROTOCOL_VERSION)
+        conn.codec = CODECS.get(reply.get("codec"), CODECS["json"])
+        conn.features = frozenset(reply.get("features", ()))
+        return True
+
+    def _open(self, key, peer_info):
+        """Connect to a peer and settle on the protocol version to speak"""
+        conn = self._connect(key, peer_info)
+        if self._protocols.get(key, int(peer_info.get('proto', 1))) < 2:
+            return conn
+        if self._negotiate(conn):
+            self._protocols[key] = conn.protocol
+            return conn
+
+        # An old peer took the hello as a regular frame and closes after it
+        print(f"Peer {peer_info.get('username')} does not speak protocol v2, using v1")
+        conn.close()
+        self._protocols[key] = 1
+        return self._connect(key, peer_info)
+
+    def open_dedicated(self, peer_info):
+        """Open a negotiated v2 connection that is owned by the caller, not pooled"""
+        key = peer_info.get('name')
+        conn = self._connect(key, peer_info)
+        if not self._negotiate(conn):
+            conn.close()
+            raise ProtocolError(f"Peer {peer_info.get('username')} does not support file transfers")
+        self._remember_session(key, conn)
+        return conn
+
+    def _remember_session(self, key, conn):
+        self.session_cache.store(key, conn.ssock)
+
+    def _acquire(self, peer_info):
+        """Return a usable connection for a peer, replacing dead or moved ones"""
+        key = peer_info.get('name')
+        with self._lock:
+            conn = self._connections.get(key)
+        if (conn and conn.port == peer_info['port']
+                and conn.address in (peer_info.get('addresses') or [peer_info['address']])
+                and conn.is_alive()):
+            return conn, False
+
+        if conn:
+            self.discard(key, conn)
+        conn = self._open(key, peer_info)
+        self._remember_session(key, conn)
+        with self._lock:
+            self._connections[key] = conn
+        return conn, True
+
+    def _encode(self, codec, message):
+        """A message's v2 frame; group messages are encoded once for all members"""
+        if "group" not in message:
+            return encode_frame(frame_type_for(message), CHAT_STREAM_ID, codec.encode(message))
+        key = (message["id"], codec.name)
+        with self._lock:
+            frame = self._encoded.get(key)
+        if frame is None:
+            frame = encode_frame(frame_type_for(message), CHAT_STREAM_ID, codec.encode(message))
+            with self._lock:
+                self._encoded[key] = frame
+                if len(self._encoded) > ENCODED_CACHE_SIZE:
+                    self._encoded.popitem(last=False)
+        return frame
+
+    def _write_batch(self, conn, messages):
+        """Write several v2 frames with one sendall so they share TLS records"""
+        data = b''.join(self._encode(conn.codec, m) for m in messages)
+        with conn.lock:
+            conn.ssock.sendall(data)
+            conn.last_used = time.monotonic()
+
+    def _await_acks(self, key, conn, messages):
+        """Wait until the peer has acknowledged or deferred every message in the batch.
+
+        Returns the deferred ids. Peers that do not announce acks are
+        trusted once the write succeeds. A probe_ack read here belongs to
+        the health monitor and is passed on through probe_answered; acks the
+        monitor read between our write and this call wait in conn.held_acks.
+        """
+        deferred = set()
+        if "ack" not in conn.features:
+            return deferred
+        pending = {m["id"] for m in messages if m.get("id")}
+        deadline = time.monotonic() + self.health.connect_timeout(key)
+        with conn.lock:
+            while pending:
+                if conn.held_acks:
+                    reply = conn.held_acks.popleft()
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise socket.timeout(f"{len(pending)} message(s) not acknowledged")
+                    frame = conn.poll_frame(remaining)
+                    if frame is None:
+                        continue
+                    try:
+                        reply = conn.codec.decode(frame[2])
+                    except (ValueError, TypeError):
+                        continue
+                    if not isinstance(reply, dict):
+                        continue
+                if reply.get("type") == "msg_ack":
+                    pending.difference_update(reply.get("ids", ()))
+                    deferred.update(pending.intersection(reply.get("deferred", ())))
+                    pending.difference_update(deferred)
+                elif reply.get("type") == "probe_ack" and self.probe_answered:
+                    self.probe_answered(reply.get("seq"))
+        return deferred
+
+    def _send_legacy(self, peer_info, conn, messages):
+        """v1 peers read a single frame per connection"""
+        key = peer_info.get('name')
+        for index, message in enumerate(messages):
+            if index:
+                conn, _ = self._acquire(peer_info)
+            try:
+                with conn.lock:
+                    conn.ssock.sendall(encode_legacy_frame(message))
+            finally:
+                self.discard(key, conn)
+
+    def send(self, peer_info, messages):
+        """Send a batch of messages to a peer over its pooled connection.
+
+        Returns the ids the peer deferred because it is busy. A reused
+        connection that fails mid-send is assumed to have been closed by
+        the peer and is replaced by a fresh one exactly once.
+        """
+        key = peer_info.get('name')
+        conn, fresh = self._acquire(peer_info)
+        if conn.protocol < 2:
+            self._send_legacy(peer_info, conn, messages)
+            return set()
+        try:
+            self._write_batch(conn, messages)
+            deferred = self._await_acks(key, conn, messages)
+        except (OSError, ssl.SSLError, ProtocolError):
+            self.discard(key, conn)
+            if fresh:
+                raise
+            conn, _ = self._acquire(peer_info)
+            self._write_batch(conn, messages)
+            deferred = self._await_acks(key, conn, messages)
+        self._remember_session(key, conn)
+        return deferred
+
+    def discard(self, key, conn=None):
+        """Close and forget the connection for key"""
+        with self._lock:
+            current = self._connections.get(key)
+            if conn is None or current is conn:
+                self._connections.pop(key, None)
+            target = conn or current
+        if target:
+            self._remember_session(key, target)
+            target.close()
+
+    def _reap_idle(self):
+        """Background loop closing connections that have been idle too long"""
+        while not self._closed.wait(POOL_REAP_INTERVAL):
+            now = time.monotonic()
+            with self._lock:
+                idle = [(key, conn) for key, conn in self._connections.items()
+                        if now - conn.last_used > self.idle_timeout]
+            for key, conn in idle:
+                if conn.lock.acquire(blocking=False):
+                    try:
+                        self.discard(key, conn)
+                    finally:
+                        conn.lock.release()
+
+    def probe_targets(self):
+        """Pooled connections whose peer answers probes"""
+        with self._lock:
+            return [(key, conn) for key, conn in self._connections.items()
+                    if conn.protocol >= 2 and "probe" in conn.features]
+
+    def close_all(self):
+        """Close every pooled connection and stop the idle reaper"""
+        self._closed.set()
+        with self._lock:
+            connections = list(self._connections.items())
+            self._connections.clear()
+        for _key, conn in connections:
+            conn.close()
+
+class OutboundDispatcher:
+    """Per-peer ordered send queues drained by a shared pool of background workers.
+
+    Messages to the same peer are delivered one at a time in the order they
+    were queued; different peers are served in parallel. ``send_func`` does
+    the blocking network I/O for a batch of messages and returns whether it
+    succeeded and the ids the peer deferred for later; ``on_done`` is called
+    from the worker thread for the delivered and the undelivered messages.
+    """
+    def __init__(self, send_func, on_done, max_workers=SEND_WORKERS):
+        self.send_func = send_func
+        self.on_done = on_done
+        self._queues = {}
+        self._draining = set()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers,
+                                            thread_name_prefix="send")
+
+    def enqueue(self, peer_info, message_dict):
+        """Queue a message for delivery without blocking the caller"""
+        key = peer_info.get('name')
+        with self._lock:
+            self._queues.setdefault(key, deque()).append((peer_info, message_dict))
+            if key in self._draining:
+                return
+            self._draining.add(key)
+        self._executor.submit(self._drain, key)
+
+    def _drain(self, key):
+        """Send everything queued for one peer, then release the peer slot.
+
+        Messages that pile up while a send is in flight go out together as
+        one batch on the next round.
+        """
+        while True:
+            with self._lock:
+                queue = self._queues.get(key)
+                if not queue:
+                    self._queues.pop(key, None)
+                    self._draining.discard(key)
+                    return
+                batch = [queue.popleft() for _ in range(min(len(queue), MAX_BATCH_MESSAGES))]
+            peer_info = batch[-1][0]
+            messages = [message_dict for _peer, message_dict in batch]
+            try:
+                ok, deferred = self.send_func(peer_info, messages)
+            except Exception as e:
+                print(f"Send worker error: {e}")
+                ok, deferred = False, set()
+            if deferred:
+                self.on_done(peer_info, [m for m in messages if m.get("id") in deferred], False)
+                messages = [m for m in messages if m.get("id") not in deferred]
+            if messages:
+                self.on_done(peer_info, messages, ok)
+
+    def shutdown(self):
+        """Drop queued messages and stop the workers"""
+        with self._lock:
+            self._queues.clear()
+        self._executor.shutdown(wait=False)
+
+class PeerHealthMonitor:
+    """Background prober feeding PeerHealth.
+
+    Every HEALTH_PROBE_INTERVAL a probe goes out on each pooled connection
+    and the replies are timed together, so a round costs one RTT however
+    many peers there are. Peers marked down are re-checked with a plain
+    connect until they answer again. A reply read by a sender waiting for
+    its acks on the same connection is handed over through probe_answered.
+    """
+    def __init__(self, pool, health):
+        self.pool = pool
+        self.health = health
+        self._seq = itertools.count()
+        self._answered = {}  # probe seq -> arrival time of a reply a sender read for us
+        self._answered_lock = threading.Lock()
+        pool.probe_answered = self.probe_answered
+        self._stop = threading.Event()
+        self._executor = ThreadPoolExecutor(max_workers=HEALTH_PROBE_WORKERS,
+                                            thread_name_prefix="probe")
+        self._reconnecting = set()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        while not self._stop.wait(HEALTH_PROBE_INTERVAL):
+            try:
+                self._probe_connections()
+                for key, peer_info in self.health.down_peers():
+                    if key not in self._reconnecting:
+                        self._reconnecting.add(key)
+                        self._executor.submit(self._probe_down_peer, key, peer_info)
+            except Exception as e:
+                print(f"Health monitor error: {e}")
+
+    def _probe_connections(self):
+        waiting = {}
+        for key, conn in self.pool.probe_targets():
+            if not conn.lock.acquire(blocking=False):
+                continue  # busy sending; probe it next round
+            seq = next(self._seq)
+            try:
+                conn.ssock.sendall(encode_frame(FRAME_CONTROL, CHAT_STREAM_ID,
+                                                conn.codec.encode({"type": "probe", "seq": seq})))
+                waiting[conn.ssock] = (key, conn, seq, time.monotonic())
+            except (OSError, ssl.SSLError):
+                self.pool.discard(key, conn)
+                self.health.record_failure(key)
+            finally:
+                conn.lock.release()
+
+        deadline = time.monotonic() + HEALTH_PROBE_TIMEOUT
+        busy = set()  # sockets a sender is reading; it passes our reply on
+        while waiting and not self._stop.is_set():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            # Connections a sender discarded meanwhile tell us nothing
+            for ssock in [ssock for ssock in waiting if ssock.fileno() < 0]:
+                del waiting[ssock]
+            self._collect_answered(waiting)
+            if not waiting:
+                break
+            watched = [ssock for ssock in waiting if ssock not in busy]
+            busy.clear()
+            if not watched:
+                self._stop.wait(min(remaining, HEALTH_PROBE_POLL))
+                continue
+            try:
+                readable, _, _ = select.select(watched, [], [], min(remaining, HEALTH_PROBE_POLL))
+            except (OSError, ValueError):
+                break
+            arrived = time.monotonic()
+            for ssock in readable:
+                key, conn, seq, sent = waiting[ssock]
+                answered = self._read_reply(conn, seq)
+                if answered is None:
+                    busy.add(ssock)
+                elif answered:
+                    del waiting[ssock]
+                    self.health.record_rtt(key, arrived - sent)
+        self._collect_answered(waiting)
+        for key, _conn, _seq, _sent in waiting.values():
+            self.health.record_failure(key)
+        with self._answered_lock:
+            self._answered.clear()
+
+    def probe_answered(self, seq):
+        """A sender read the probe_ack for seq while waiting for its own acks"""
+        with self._answered_lock:
+            self._answered[seq] = time.monotonic()
+
+    def _collect_answered(self, waiting):
+        """Record the probes whose replies senders read and stop waiting for them"""
+        answered = []
+        with self._answered_lock:
+            for ssock, (key, _conn, seq, sent) in list(waiting.items()):
+                arrived = self._answered.pop(seq, None)
+                if arrived is not None:
+                    del waiting[ssock]
+                    answered.append((key, arrived - sent))
+        for key, rtt in answered:
+            self.health.record_rtt(key, rtt)
+
+    def _read_reply(self, conn, seq):
+        """True once the probe_ack for seq has been read, None if a sender holds the connection.
+
+        msg_ack frames are kept in conn.held_acks for the sender that is
+        about to wait for them; anything else is dropped.
+        """
+        if not conn.lock.acquire(blocking=False):
+            return None
+        try:
+            while True:
+                frame = conn.poll_frame(0)
+                if frame is None:
+                    return False
+                try:
+                    reply = conn.codec.decode(frame[2])
+                except (ValueError, TypeError):
+                    continue
+                if not isinstance(reply, dict):
+                    continue
+                if reply.get("type") == "probe_ack" and reply.get("seq") == seq:
+                    return True
+                if reply.get("type") == "msg_ack":
+                    conn.held_acks.append(reply)
+        except (ProtocolError, OSError, ssl.SSLError):
+            return False
+        finally:
+            conn.lock.release()
+
+    def _probe_down_peer(self, key, peer_info):
+        try:
+            addresses = peer_info.get('addresses') or [peer_info['address']]
+            started = time.monotonic()
+            sock, _address = race_connect(addresses, peer_info['port'], HEALTH_PROBE_TIMEOUT)
+            sock.close()
+            self.health.record_rtt(key, time.monotonic() - started)
+        except OSError:
+            self.health.record_failure(key, peer_info)
+        finally:
+            self._reconnecting.discard(key)
+
+    def shutdown(self):
+        self._stop.set()
+        self._executor.shutdown(wait=False)
+
+class Outbox:
+    """Text messages not yet acknowledged by their peer, kept in SQLite.
+
+    Every message is stored, once per recipient, before its first send and
+    deleted once that peer acks it, so nothing is lost to a dropped
+    connection or a restart.
+    Each dispatch schedules the next attempt with exponential backoff; a
+    background thread re-sends what is due to peers that are currently
+    known, and flush() makes a peer's whole backlog due at once when it
+    reappears. Due messages for one peer go to ``enqueue`` together and
+    leave as one batch on one connection. Only due rows are read, through
+    the next_attempt index; rows of peers not currently known are put off
+    until flush() wakes them, so a large backlog costs nothing per pass.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS outbox (
+            id TEXT NOT NULL,
+            peer TEXT NOT NULL,
+            message TEXT NOT NULL,
+            created REAL NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt REAL NOT NULL,
+            PRIMARY KEY (id, peer)
+        );
+        CREATE INDEX IF NOT EXISTS outbox_peer ON outbox (peer);
+        CREATE INDEX IF NOT EXISTS outbox_due ON outbox (next_attempt);
+        CREATE INDEX IF NOT EXISTS outbox_created ON outbox (created);
+    """
+
+    def __init__(self, enqueue, lookup, on_expired, path=OUTBOX_DB_PATH):
+        self.enqueue = enqueue
+        self.lookup = lookup
+        self.on_expired = on_expired
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._migrate()
+        self._conn.executescript(self.SCHEMA)
+        self._lock = threading.Lock()
+        self._wake = threading.Condition()
+        self._closed = False
+        threading.Thread(target=self._run, name="outbox", daemon=True).start()
+
+    def _migrate(self):
+        """Outboxes from before group chat keyed rows by message id alone"""
+        row = self._conn.execute("SELECT sql FROM sqlite_master WHERE name = 'outbox'").fetchone()
+        if row and "id TEXT PRIMARY KEY" in row[0]:
+            with self._conn:
+                self._conn.execute("DROP INDEX IF EXISTS outbox_peer")
+                self._conn.execute("ALTER TABLE outbox RENAME TO outbox_old")
+                self._conn.executescript(self.SCHEMA)
+                self._conn.execute("INSERT INTO outbox SELECT * FROM outbox_old")
+                self._conn.execute("DROP TABLE outbox_old")
+
+    @staticmethod
+    def _backoff(attempts):
+        delay = min(OUTBOX_RETRY_MAX, OUTBOX_RETRY_BASE * 2 ** max(attempts - 1, 0))
+        return delay * random.uniform(0.8, 1.2)
+
+    def add(self, peer_name, message_dict):
+        """Store a message that is about to be sent for the first time"""
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO outbox (id, peer, message, created, attempts, next_attempt) "
+                "VALUES (?, ?, ?, ?, 1, ?)",
+                (message_dict["id"], peer_name, json.dumps(message_dict), now, now + self._backoff(1)))
+
+    def remove(self, peer_name, ids):
+        with self._lock, self._conn:
+            self._conn.executemany("DELETE FROM outbox WHERE id = ? AND peer = ?",
+                                   [(i, peer_name) for i in ids])
+
+    def pending(self, peer_name, ids):
+        """The ids among these that the peer has still not acked"""
+        ids = list(ids)
+        with self._lock:
+            return {row[0] for row in self._conn.execute(
+                f"SELECT id FROM outbox WHERE peer = ? AND id IN ({','.join('?' * len(ids))})",
+                [peer_name] + ids)}
+
+    def flush(self, peer_name):
+        """Make everything queued for a peer due now"""
+        with self._lock, self._conn:
+            changed = self._conn.execute(
+                "UPDATE outbox SET next_attempt = 0 WHERE peer = ?", (peer_name,)).rowcount
+        if changed:
+            with self._wake:
+                self._wake.notify()
+
+    def _run(self):
+        timeout = 0
+        while True:
+            with self._wake:
+                self._wake.wait(timeout)
+            if self._closed:
+                return
+            try:
+                timeout = self._dispatch_due()
+            except sqlite3.Error as e:
+                print(f"Outbox error: {e}")
+                timeout = OUTBOX_IDLE_CHECK
+
+    def _dispatch_due(self):
+        """Send what is due and return the seconds until the next attempt"""
+        now = time.time()
+        with self._lock, self._conn:
+            expired = self._conn.execute(
+                "SELECT peer, message FROM outbox WHERE created < ?", (now - OUTBOX_MAX_AGE,)).fetchall()
+            self._conn.execute("DELETE FROM outbox WHERE created < ?", (now - OUTBOX_MAX_AGE,))
+            rows = self._conn.execute(
+                "SELECT id, peer, message, attempts FROM ("
+                "SELECT * FROM outbox WHERE next_attempt <= ? ORDER BY next_attempt LIMIT ?"
+                ") ORDER BY created", (now, OUTBOX_DISPATCH_BATCH)).fetchall()
+            due, updates, peers = [], [], {}
+            for message_id, peer_name, message, attempts in rows:
+                if peer_name not in peers:
+                    peers[peer_name] = self.lookup(peer_name)
+                peer_info = peers[peer_name]
+                if peer_info:
+                    due.append((peer_info, json.loads(message)))
+                    updates.append((attempts + 1, now + self._backoff(attempts + 1), message_id, peer_name))
+                else:
+                    # Sent when the peer is discovered again and flush() makes it due
+                    updates.append((attempts, now + OUTBOX_MAX_AGE, message_id, peer_name))
+            self._conn.executemany("UPDATE outbox SET attempts = ?, next_attempt = ? "
+                                   "WHERE id = ? AND peer = ?", updates)
+            next_due = self._conn.execute("SELECT MIN(next_attempt) FROM outbox").fetchone()[0]
+        for peer_name, message in expired:
+            self.on_expired(peer_name, json.loads(message))
+        for peer_info, message_dict in due:
+            self.enqueue(peer_info, message_dict)
+        wake_at = now + OUTBOX_IDLE_CHECK
+        if next_due is not None:
+            wake_at = min(wake_at, next_due)
+        return max(0, wake_at - time.time())
+
+    def close(self):
+        self._closed = True
+        with self._wake:
+            self._wake.notify()
+        with self._lock:
+            self._conn.close()
+
+class TokenBucket:
+    """Allows ``rate`` events per second on average and ``burst`` at once"""
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+
+    def take(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+class InboundQueue(QObject):
+    """Bounded hand-off of received messages from the network to the GUI.
+
+    ready is emitted only when the queue stops being empty, so a flood
+    costs the GUI one wakeup per batch rather than one event per message.
+    A ping from a peer whose previous ping is still queued only raises
+    that ping's count. put() refuses messages once the queue is full.
+    """
+    ready = Signal()
+
+    def __init__(self, maxsize=INBOUND_QUEUE_SIZE, parent=None):
+        super().__init__(parent)
+        self.maxsize = maxsize
+        self._queue = deque()
+        self._pings = {}   # sender -> its ping still in the queue
+        self._lock = threading.Lock()
+
+    def put(self, message):
+        sender = message.get("from_service") or message.get("from_user")
+        with self._lock:
+            if message.get("type") == "ping" and sender in self._pings:
+                queued = self._pings[sender]
+                queued["count"] = queued.get("count", 1) + message.get("count", 1)
+                return True
+            if len(self._queue) >= self.maxsize:
+                return False
+            if message.get("type") == "ping":
+                self._pings[sender] = message
+            self._queue.append(message)
+            wake = len(self._queue) == 1
+        if wake:
+            self.ready.emit()
+        return True
+
+    def take(self, limit=INBOUND_BATCH):
+        """Up to limit messages, oldest first, and whether more are waiting"""
+        with self._lock:
+            batch = [self._queue.popleft() for _ in range(min(limit, len(self._queue)))]
+            for message in batch:
+                if message.get("type") == "ping":
+                    self._pings.pop(message.get("from_service") or message.get("from_user"), None)
+            return batch, bool(self._queue)
+
+class TransferError(Exception):
+    """A file transfer cannot continue"""
+
+class RangeCorrupted(TransferError):
+    """The receiver's checksum for a byte range did not match; resend that range"""
+
+class IncomingTransfer:
+    """Receiving side of one file: a .part file written at explicit offsets.
+
+    Progress is tracked per byte range as the highest contiguous offset
+    received, and persisted at every ack so a later connection can resume
+    from the last acknowledged position.
+    """
+    def __init__(self, state):
+        self.state = state
+        self.fd = os.open(state["part_path"], os.O_RDWR | os.O_CREAT, 0o600)
+        self.lock = threading.Lock()
+        self.unsynced = 0
+        self.hashers = {}  # range start -> running sha256 while data arrives in order
+
+    @property
+    def transfer_id(self):
+        return self.state["transfer_id"]
+
+    def received(self):
+        with self.lock:
+            return sum(end - start for start, end in self._range_progress())
+
+    def _range_progress(self):
+        """(start, received up to) of each range; call with self.lock held"""
+        return [(start, self.state["ranges"][str(start)]) for start in self._starts()]
+
+    def _starts(self):
+        return sorted(int(start) for start in self.state["ranges"])
+
+    def resume_offset(self, start):
+        with self.lock:
+            return self.state["ranges"].setdefault(str(start), start)
+
+    def write(self, start, offset, data):
+        """Write one chunk of the range beginning at start; returns bytes now unacked.
+
+        Ranges arrive on separate connections, so the positional write itself
+        happens outside the lock and different ranges land in parallel.
+        """
+        with self.lock:
+            if offset != self.state["ranges"].get(str(start)) or self.fd is None:
+                raise ProtocolError(f"Unexpected chunk offset {offset}")
+            fd = self.fd
+        written = 0
+        while written < len(data):
+            written += os.pwrite(fd, data[written:], offset + written)
+        with self.lock:
+            if offset == start:
+                self.hashers[start] = hashlib.sha256()
+            hasher = self.hashers.get(start)
+            if hasher is not None:
+                hasher.update(data)
+            self.state["ranges"][str(start)] = offset + len(data)
+            self.unsynced += len(data)
+            return self.unsynced
+
+    def range_digest(self, start, end):
+        """sha256 of a received range, re-reading the file if resumed mid-range"""
+        hasher = self.hashers.pop(start, None)
+        if hasher is not None:
+            return hasher.hexdigest()
+        hasher = hashlib.sha256()
+        offset = start
+        while offset < end:
+            block = os.pread(self.fd, min(FILE_CHUNK_MAX, end - offset), offset)
+            if not block:
+                break
+            hasher.update(block)
+            offset += len(block)
+        return hasher.hexdigest()
+
+    def reset_range(self, start):
+        """Discard a range that failed verification so it is sent again"""
+        with self.lock:
+            self.state["ranges"][str(start)] = start
+            self.hashers.pop(start, None)
+        self.checkpoint()
+
+    def checkpoint(self):
+        """Flush written data and persist progress so it can be acknowledged"""
+        with self.lock:
+            if self.fd is None:
+                return  # Already completed and moved into place
+            os.fdatasync(self.fd)
+            self.unsynced = 0
+            save_transfer_state(self.state)
+
+    def close(self):
+        with self.lock:
+            if self.fd is not None:
+                os.close(self.fd)
+                self.fd = None
+
+def transfer_state_path(transfer_id):
+    return os.path.join(TRANSFER_STATE_DIR, f"{transfer_id}.json")
+
+def save_transfer_state(state):
+    """Atomically persist a receiving transfer's metadata and progress"""
+    path = transfer_state_path(state["transfer_id"])
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path)
+
+def unique_download_path(filename):
+    """Pick a path in DOWNLOAD_DIR that does not clobber an existing file"""
+    directory = DOWNLOAD_DIR if os.path.isdir(DOWNLOAD_DIR) else os.path.join(APP_DATA_DIR, "downloads")
+    os.makedirs(directory, exist_ok=True)
+    stem, ext = os.path.splitext(filename)
+    candidate = os.path.join(directory, filename)
+    counter = 1
+    while os.path.exists(candidate):
+        candidate = os.path.join(directory, f"{stem} ({counter}){ext}")
+        counter += 1
+    return candidate
+
+# Content-defined chunking: a boundary falls after CDC_WINDOW consecutive
+# bytes that all belong to a fixed pseudo-random half of the byte values.
+# Boundaries depend only on local content, so an insertion shifts at most
+# the chunks around it, and translate()/find() keep the scan at C speed.
+_cdc_members = random.Random(0xB3).sample(range(256), 128)
+CDC_TABLE = bytes(1 if value in _cdc_members else 0 for value in range(256))
+CDC_PATTERN = b'\x01' * CDC_WINDOW
+
+def content_defined_chunks(path):
+    """Split a file into content-defined chunks: list of (offset, length, sha256 digest)"""
+    chunks = []
+    buffer = b''
+    base = 0
+    with open(path, "rb") as f:
+        while True:
+            block = f.read(CDC_READ_SIZE)
+            buffer = buffer[:] + block if block else buffer
+            view = memoryview(buffer)
+            pos = 0
+            while pos < len(buffer) and (not block or len(buffer) - pos >= CDC_MAX_SIZE):
+                end = min(pos + CDC_MAX_SIZE, len(buffer))
+                index = buffer[pos:end].translate(CDC_TABLE).find(
+                    CDC_PATTERN, CDC_MIN_SIZE - CDC_WINDOW)
+                cut = pos + index + CDC_WINDOW if index >= 0 else end
+                chunks.append((base + pos, cut - pos, hashlib.sha256(view[pos:cut]).digest()))
+                pos = cut
+            view.release()
+            buffer = buffer[pos:]
+            base += pos
+            if not block:
+                return chunks
+
+class ChunkStore:
+    """Content-addressed store of received chunks under CHUNK_STORE_DIR.
+
+    Chunks are files named by their sha256, verified on read, and evicted
+    oldest-first once the store grows past CHUNK_STORE_MAX_BYTES.
+    """
+    def __init__(self, root=CHUNK_STORE_DIR, max_bytes=CHUNK_STORE_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+        self.total_bytes = sum(entry.stat().st_size for entry in self._entries())
+
+    def _entries(self):
+        for bucket in os.scandir(self.root):
+            if bucket.is_dir():
+                yield from (entry for entry in os.scandir(bucket.path) if entry.is_file())
+
+    def _path(self, digest_hex):
+        return os.path.join(self.root, digest_hex[:2], digest_hex)
+
+    def get(self, digest_hex):
+        """Return a chunk's bytes, or None if missing or corrupted"""
+        path = self._path(digest_hex)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except OSError:
+            return None
+        if hashlib.sha256(data).hexdigest() != digest_hex:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        try:
+            os.utime(path)  # Mark as recently used for eviction
+        except OSError:
+            pass
         return data
 
-    def run_tls_server(self):
-        """Run TLS server to receive messages"""
-        if not os.path.exists(CERTFILE) or not os.path.exists(KEYFILE):
-            print("Error: Certificate or key file missing!")
-            return
+    def put(self, digest_hex, data):
+        path = self._path(digest_hex)
+        if os.path.exists(path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self.total_bytes += len(data)
+            over_limit = self.total_bytes > self.max_bytes
+        if over_limit:
+            self.prune()
+
+    def prune(self):
+        """Evict least recently used chunks until the store fits its budget"""
+        with self._lock:
+            entries = sorted(self._entries(), key=lambda entry: entry.stat().st_mtime)
+            for entry in entries:
+                if self.total_bytes <= self.max_bytes * 0.9:
+                    break
+                try:
+                    size = entry.stat().st_size
+                    os.remove(entry.path)
+                    self.total_bytes -= size
+                except OSError:
+                    pass
+
+class FileTransferEngine:
+    """Streams files to peers over dedicated v2 connections and receives them.
+
+    Files travel as raw FILE_CHUNK frames (8-byte offset + data) read into
+    one reused buffer, so memory stays constant whatever the file size.
+    Chunks grow or shrink with the observed send time. Large files are cut
+    into byte ranges sent over parallel connections; each range is checked
+    with sha256 when it finishes and only a corrupted range is resent. The
+    receiver acks its synced offset every FILE_ACK_BYTES, and after a
+    disconnect the sender reconnects and resumes from the last acknowledged
+    offset. Files above DEDUP_MIN_SIZE start with a manifest of
+    content-defined chunk hashes so only chunks missing from the
+    receiver's ChunkStore are sent.
+
+    A new file is first announced with a file_request, answered at once
+    with file_accept, file_pending while the user decides, or file_error,
+    so no server worker waits on the user; the sender hangs up and asks
+    again every FILE_OFFER_POLL. Nothing is written until the user
+    accepts, the size is within FILE_MAX_SIZE and the disk has room for
+    it. Partial downloads abandoned for TRANSFER_STATE_MAX_AGE are
+    deleted at start.
+    """
+    CHUNK_PREFIX = FRAME_HEADER.size + 8
+
+    def __init__(self, network_manager):
+        self.network_manager = network_manager
+        self._stream_ids = itertools.count(1)
+        self._incoming = {}
+        self._lock = threading.Lock()
+        self._cancelled = set()
+        self._executor = ThreadPoolExecutor(max_workers=FILE_TRANSFER_WORKERS,
+                                            thread_name_prefix="file-send")
+        self._manifests = OrderedDict()
+        self._offers = {}  # transfer id -> {"accepted": None until the user chooses, "asked": time}
+        self.chunk_store = ChunkStore()
+        os.makedirs(TRANSFER_STATE_DIR, exist_ok=True)
+        self._expire_stale_transfers()
+
+    # --- Sending ---
+    def send_file(self, peer_info, path, streams=None):
+        """Start sending a file in the background; returns the transfer id.
+
+        Large files are split into ``streams`` byte ranges (default
+        FILE_PARALLEL_STREAMS) that travel over parallel TLS connections,
+        so encryption runs on several cores at once.
+        """
+        transfer_id = uuid.uuid4().hex
+        self._executor.submit(self._run_send, transfer_id, peer_info, path,
+                              streams or FILE_PARALLEL_STREAMS)
+        return transfer_id
+
+    def cancel(self, transfer_id):
+        self._cancelled.add(transfer_id)
+
+    @staticmethod
+    def _plan_lanes(ranges, streams):
+        """Spread byte ranges over at most ``streams`` connections of similar size.
+
+        Returns one list of ranges per connection, splitting ranges where a
+        connection's share fills up.
+        """
+        total = sum(end - start for start, end in ranges)
+        if total == 0:
+            return [[list(byte_range) for byte_range in ranges]] if ranges else []
+        count = max(1, min(streams, total // FILE_PARALLEL_MIN_RANGE))
+        share = -(-total // count)
+        lanes = [[]]
+        room = share
+        for start, end in ranges:
+            while start < end:
+                if room == 0:
+                    lanes.append([])
+                    room = share
+                piece_end = min(end, start + room)
+                lanes[-1].append([start, piece_end])
+                room -= piece_end - start
+                start = piece_end
+        return lanes
+
+    def _manifest(self, path, size):
+        """Chunk manifest for a file, cached while the file is unchanged"""
+        stat = os.stat(path)
+        key = (os.path.abspath(path), size, stat.st_mtime_ns)
+        with self._lock:
+            if key in self._manifests:
+                self._manifests.move_to_end(key)
+                return self._manifests[key]
+        manifest = [[length, digest] for _offset, length, digest in content_defined_chunks(path)]
+        with self._lock:
+            self._manifests[key] = manifest
+            while len(self._manifests) > MANIFEST_CACHE_SIZE:
+                self._manifests.popitem(last=False)
+        return manifest
+
+    def _request_consent(self, transfer_id, peer_info, path, size):
+        """Ask the receiver to take the file, asking again while its user decides"""
+        request = {
+            "type": "file_request",
+            "transfer_id": transfer_id,
+            "filename": os.path.basename(path),
+            "size": size,
+            "from_user": self.network_manager.username,
+            "from_service": self.network_manager.service_info.name,
+        }
+        deadline = time.monotonic() + FILE_OFFER_TIMEOUT
+        while True:
+            conn = self.network_manager.connection_pool.open_dedicated(peer_info)
+            try:
+                stream_id = next(self._stream_ids) & 0xFFFFFFFF
+                conn.ssock.sendall(encode_frame(FRAME_CONTROL, stream_id, conn.codec.encode(request)))
+                reply = self._wait_control(conn, stream_id, time.monotonic() + FILE_DONE_TIMEOUT)
+            finally:
+                conn.close()
+            if reply.get("type") == "file_accept":
+                return
+            if reply.get("type") != "file_pending":
+                raise TransferError(reply.get("reason", "Transfer rejected"))
+            if (time.monotonic() + FILE_OFFER_POLL > deadline or transfer_id in self._cancelled
+                    or not self.network_manager.running):
+                raise TransferError("The file was not accepted")
+            time.sleep(FILE_OFFER_POLL)
+
+    def _request_needed_ranges(self, transfer_id, peer_info, path, size):
+        """Send the chunk manifest; the receiver answers with the byte ranges it lacks"""
+        message = {
+            "type": "file_manifest",
+            "transfer_id": transfer_id,
+            "filename": os.path.basename(path),
+            "size": size,
+            "from_user": self.network_manager.username,
+            "from_service": self.network_manager.service_info.name,
+            "chunks": self._manifest(path, size),
+        }
+        conn = self.network_manager.connection_pool.open_dedicated(peer_info)
+        try:
+            payload = conn.codec.encode(message)
+            if len(payload) > MAX_FRAME_SIZE:
+                return [[0, size]]  # Manifest too large for one frame: send the whole file
+            stream_id = next(self._stream_ids) & 0xFFFFFFFF
+            conn.ssock.sendall(encode_frame(FRAME_CONTROL, stream_id, payload))
+            reply = self._wait_control(conn, stream_id, time.monotonic() + FILE_DONE_TIMEOUT)
+        finally:
+            conn.close()
+        if reply.get("type") != "file_needs":
+            raise TransferError(reply.get("reason", "Transfer rejected"))
+        return [[int(start), int(end)] for start, end in reply.get("ranges", [])]
+
+    def _run_send(self, transfer_id, peer_info, path, streams):
+        manager = self.network_manager
+        try:
+            size = os.path.getsize(path)
+            self._request_consent(transfer_id, peer_info, path, size)
+            needed = [[0, size]]
+            if size >= DEDUP_MIN_SIZE:
+                needed = self._request_needed_ranges(transfer_id, peer_info, path, size)
+        except (OSError, ProtocolError, TransferError) as e:
+            print(f"File transfer {transfer_id} failed: {e}")
+            manager.transfer_finished.emit(transfer_id, False, str(e))
+            return
+
+        lanes = self._plan_lanes(needed, streams)
+        known = size - sum(end - start for start, end in needed)
+        if known:
+            print(f"File transfer {transfer_id}: receiver already has {known} of {size} bytes")
+        progress = {"lock": threading.Lock(), "last": 0.0, "size": size,
+                    "sent": {start: 0 for lane in lanes for start, _end in lane}}
+        progress["sent"][None] = known
+        offer_template = {
+            "type": "file_offer",
+            "transfer_id": transfer_id,
+            "filename": os.path.basename(path),
+            "size": size,
+            "from_user": manager.username,
+            "from_service": manager.service_info.name,
+        }
+
+        error = None
+        with ThreadPoolExecutor(max_workers=max(len(lanes), 1),
+                                thread_name_prefix="file-range") as range_pool:
+            futures = [range_pool.submit(self._send_lane_with_retry, peer_info, path,
+                                         [dict(offer_template, range=byte_range) for byte_range in lane],
+                                         progress)
+                       for lane in lanes]
+            for future in futures:
+                try:
+                    future.result()
+                except (OSError, ProtocolError, TransferError) as e:
+                    if error is None:
+                        error = e
+                        self._cancelled.add(transfer_id)  # Stop the sibling ranges
+        self._cancelled.discard(transfer_id)
+
+        if error is None:
+            self._report_progress(transfer_id, progress, force=True)
+            manager.transfer_finished.emit(transfer_id, True, path)
+        else:
+            print(f"File transfer {transfer_id} failed: {error}")
+            manager.transfer_finished.emit(transfer_id, False, str(error))
+
+    def _send_lane_with_retry(self, peer_info, path, offers, progress):
+        """Send a connection's ranges, reconnecting and resuming after interruptions"""
+        attempt = 0
+        while offers:
+            transfer_id = offers[0]["transfer_id"]
+            try:
+                conn = self.network_manager.connection_pool.open_dedicated(peer_info)
+                try:
+                    while offers:
+                        self._send_range(conn, path, offers[0], progress)
+                        offers.pop(0)
+                finally:
+                    conn.close()
+            except (OSError, ProtocolError, TransferError) as e:
+                attempt += 1
+                if (transfer_id in self._cancelled or not self.network_manager.running
+                        or attempt > FILE_RETRY_LIMIT
+                        or (isinstance(e, TransferError) and not isinstance(e, RangeCorrupted))):
+                    raise
+                delay = 0 if isinstance(e, RangeCorrupted) else min(2 ** attempt, 30)
+                print(f"File transfer {transfer_id} range {offers[0]['range']} interrupted ({e}); "
+                      f"resuming in {delay}s")
+                time.sleep(delay)
+
+    def _send_range(self, conn, path, offer, progress):
+        """Offer one byte range on its own stream and send it from the acked offset"""
+        stream_id = next(self._stream_ids) & 0xFFFFFFFF
+        codec = conn.codec
+        conn.ssock.sendall(encode_frame(FRAME_CONTROL, stream_id, codec.encode(offer)))
+        reply = self._wait_control(conn, stream_id, time.monotonic() + FILE_DONE_TIMEOUT)
+        if reply.get("type") != "file_accept":
+            raise TransferError(reply.get("reason", "Transfer rejected"))
+        start, end = offer["range"]
+        offset = int(reply.get("offset", start))
+        if not start <= offset <= end:
+            raise ProtocolError("Receiver asked to resume outside the range")
+        hasher = self._hash_prefix(path, start, offset)
+        self._stream_file(conn, stream_id, offer, path, offset, end, hasher, progress)
+        conn.ssock.sendall(encode_frame(FRAME_CONTROL, stream_id, codec.encode({
+            "type": "file_done", "transfer_id": offer["transfer_id"],
+            "range": offer["range"], "sha256": hasher.hexdigest()})))
+        self._wait_control(conn, stream_id, time.monotonic() + FILE_DONE_TIMEOUT,
+                           until_offset=end)
+
+    @staticmethod
+    def _hash_prefix(path, start, offset):
+        """Start a range hash, covering the part the receiver already has"""
+        hasher = hashlib.sha256()
+        with open(path, "rb") as f:
+            f.seek(start)
+            remaining = offset - start
+            while remaining > 0:
+                block = f.read(min(FILE_CHUNK_MAX, remaining))
+                if not block:
+                    break
+                hasher.update(block)
+                remaining -= len(block)
+        return hasher
+
+    def _stream_file(self, conn, stream_id, offer, path, offset, end, hasher, progress):
+        """Send [offset, end) of the file as raw chunks from one reused buffer"""
+        transfer_id = offer["transfer_id"]
+        start = offer["range"][0]
+        buffer = bytearray(self.CHUNK_PREFIX + FILE_CHUNK_MAX)
+        view = memoryview(buffer)
+        chunk_size = FILE_CHUNK_MIN
+        with progress["lock"]:
+            progress["sent"][start] = offset - start
+        with open(path, "rb", buffering=0) as f:
+            f.seek(offset)
+            while offset < end:
+                if transfer_id in self._cancelled:
+                    raise TransferError("Cancelled")
+                want = min(chunk_size, end - offset)
+                count = f.readinto(view[self.CHUNK_PREFIX:self.CHUNK_PREFIX + want])
+                if not count:
+                    raise TransferError("File changed while sending")
+                FRAME_HEADER.pack_into(buffer, 0, PROTOCOL_VERSION, FRAME_FILE_CHUNK,
+                                       stream_id, 8 + count)
+                struct.pack_into('>Q', buffer, FRAME_HEADER.size, offset)
+                hasher.update(view[self.CHUNK_PREFIX:self.CHUNK_PREFIX + count])
+
+                started = time.monotonic()
+                conn.ssock.sendall(view[:self.CHUNK_PREFIX + count])
+                elapsed = time.monotonic() - started
+                if elapsed < FILE_CHUNK_FAST:
+                    chunk_size = min(chunk_size * 2, FILE_CHUNK_MAX)
+                elif elapsed > FILE_CHUNK_SLOW:
+                    chunk_size = max(chunk_size // 2, FILE_CHUNK_MIN)
+                offset += count
+
+                self._poll_replies(conn, stream_id)
+                with progress["lock"]:
+                    progress["sent"][start] = offset - start
+                self._report_progress(transfer_id, progress)
+
+    def _report_progress(self, transfer_id, progress, force=False):
+        """Emit the combined progress of every range, at most every PROGRESS_INTERVAL"""
+        now = time.monotonic()
+        with progress["lock"]:
+            if not force and now - progress["last"] < PROGRESS_INTERVAL:
+                return
+            progress["last"] = now
+            done = sum(progress["sent"].values())
+        self.network_manager.transfer_progress.emit(transfer_id, done, progress["size"])
+
+    def _poll_replies(self, conn, stream_id):
+        """Consume acks that have already arrived without blocking the stream"""
+        while self._read_reply(conn, stream_id, 0):
+            pass
+
+    def _read_reply(self, conn, stream_id, timeout):
+        """Next (frame type, message) from the receiver on this stream, or None"""
+        while True:
+            frame = conn.poll_frame(timeout)
+            if frame is None:
+                return None
+            frame_type, reply_stream, payload = frame
+            if reply_stream != stream_id:
+                continue
+            message = conn.codec.decode(payload)
+            if message.get("type") == "file_error":
+                raise TransferError(message.get("reason", "Receiver rejected the file"))
+            if message.get("type") == "range_retry":
+                raise RangeCorrupted(message.get("reason", "Range failed verification"))
+            return frame_type, message
+
+    def _wait_control(self, conn, stream_id, deadline, until_offset=None):
+        """Block for the receiver's reply; with until_offset, wait for the final ack"""
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise ProtocolError("Timed out waiting for the receiver")
+            reply = self._read_reply(conn, stream_id, remaining)
+            if reply is None:
+                continue
+            frame_type, message = reply
+            if until_offset is None and frame_type == FRAME_CONTROL:
+                return message
+            if (until_offset is not None and frame_type == FRAME_ACK
+                    and message.get("complete") and message.get("offset") == until_offset):
+                return message
+
+    # --- Receiving ---
+    def handle_control(self, ssock, codec, stream_id, message, streams):
+        """Handle file_offer / file_done on a server connection.
+
+        streams maps each stream id on the connection to its
+        (transfer, range start, range end). Returns False for control
+        messages that are not about files.
+        """
+        msg_type = message.get("type")
+        transfer_id = str(message.get("transfer_id", ""))
+        try:
+            if msg_type == "file_request":
+                reply = {"type": "file_accept" if self._consent(message) else "file_pending",
+                         "transfer_id": transfer_id}
+            elif msg_type == "file_offer":
+                transfer = self._accept_offer(message)
+                start, end = (int(value) for value in message["range"])
+                if not 0 <= start <= end <= transfer.state["size"]:
+                    raise ProtocolError("Invalid byte range")
+                streams[stream_id] = (transfer, start, end)
+                reply = {"type": "file_accept", "transfer_id": transfer_id,
+                         "offset": transfer.resume_offset(start)}
+            elif msg_type == "file_manifest":
+                transfer = self._accept_offer(message)
+                needs = self._apply_manifest(transfer, message["chunks"])
+                if not needs:
+                    self._maybe_complete(transfer)
+                reply = {"type": "file_needs", "transfer_id": transfer_id, "ranges": needs}
+            elif msg_type == "file_done":
+                transfer, start, end = streams[stream_id]
+                transfer.checkpoint()
+                if transfer.state["ranges"].get(str(start)) != end:
+                    raise ProtocolError("Range finished early")
+                if transfer.range_digest(start, end) != message.get("sha256"):
+                    print(f"File transfer {transfer_id}: range {start}-{end} corrupted, requesting resend")
+                    transfer.reset_range(start)
+                    reply = {"type": "range_retry", "transfer_id": transfer_id,
+                             "reason": "Checksum mismatch"}
+                    ssock.sendall(encode_frame(FRAME_CONTROL, stream_id, codec.encode(reply)))
+                    return True
+                self._maybe_complete(transfer)
+                self._send_ack(ssock, codec, stream_id, transfer_id, end, complete=True)
+                return True
+            else:
+                return False
+        except (KeyError, ValueError, TypeError, OSError, ProtocolError) as e:
+            print(f"File transfer {transfer_id} error: {e}")
+            reply = {"type": "file_error", "transfer_id": transfer_id, "reason": str(e)}
+        ssock.sendall(encode_frame(FRAME_CONTROL, stream_id, codec.encode(reply)))
+        return True
+
+    def handle_chunk(self, ssock, codec, stream_id, payload, streams):
+        """Write a FILE_CHUNK frame straight from the receive buffer"""
+        entry = streams.get(stream_id)
+        if entry is None:
+            raise ProtocolError(f"File chunk for unknown stream {stream_id}")
+        transfer, start, end = entry
+        view = memoryview(payload)
+        offset = struct.unpack_from('>Q', view)[0]
+        if offset + len(view) - 8 > end:
+            raise ProtocolError("Chunk runs past the end of its range")
+        unacked = transfer.write(start, offset, view[8:])
+        if unacked >= FILE_ACK_BYTES:
+            transfer.checkpoint()
+            self._send_ack(ssock, codec, stream_id, transfer.transfer_id,
+                           transfer.state["ranges"][str(start)])
+            self.network_manager.transfer_progress.emit(
+                transfer.transfer_id, transfer.received(), transfer.state["size"])
+
+    def release_streams(self, streams):
+        """A connection ended: keep partial transfers on disk for resumption"""
+        for transfer, _start, _end in streams.values():
+            try:
+                transfer.checkpoint()
+            except OSError:
+                pass
+        streams.clear()
+
+    def _send_ack(self, ssock, codec, stream_id, transfer_id, offset, complete=False):
+        ack = {"transfer_id": transfer_id, "offset": offset, "complete": complete}
+        ssock.sendall(encode_frame(FRAME_ACK, stream_id, codec.encode(ack)))
+
+    @staticmethod
+    def _offered(offer):
+        """Transfer id and size of an offer, checked against FILE_MAX_SIZE"""
+        transfer_id = str(offer["transfer_id"])
+        if not re.fullmatch(r"[0-9a-f]{32}", transfer_id):
+            raise ProtocolError("Invalid transfer id")
+        size = int(offer["size"])
+        if not 0 <= size <= FILE_MAX_SIZE:
+            raise ProtocolError("File is too large")
+        return transfer_id, size
+
+    @staticmethod
+    def _saved_state(transfer_id, size):
+        """Progress kept on disk for a transfer of this size, if any"""
+        try:
+            with open(transfer_state_path(transfer_id)) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return state if isinstance(state, dict) and state.get("size") == size else None
+
+    def _consent(self, request):
+        """Whether the user accepted a requested file; False while they decide.
+
+        The first request for a file emits transfer_offered; files we are
+        already receiving, or have partly on disk, were accepted before.
+        Raises ProtocolError for a declined file or one we have no room for.
+        """
+        transfer_id, size = self._offered(request)
+        with self._lock:
+            if transfer_id in self._incoming:
+                return True
+        if self._saved_state(transfer_id, size):
+            return True
+        now = time.monotonic()
+        with self._lock:
+            for stale in [key for key, pending in self._offers.items()
+                          if now - pending["asked"] > 2 * FILE_OFFER_TIMEOUT]:
+                del self._offers[stale]
+            pending = self._offers.get(transfer_id)
+        if pending is None:
+            if shutil.disk_usage(TRANSFER_STATE_DIR).free < size + FILE_FREE_SPACE_MARGIN:
+                raise ProtocolError("Not enough disk space")
+            with self._lock:
+                pending = self._offers.get(transfer_id)
+                first = pending is None
+                if first:
+                    pending = self._offers[transfer_id] = {"accepted": None, "asked": now}
+            if first:
+                self.network_manager.transfer_offered.emit({
+                    "transfer_id": transfer_id,
+                    "filename": os.path.basename(str(request.get("filename", ""))).strip() or "file",
+                    "size": size,
+                    "from_user": request.get("from_user"),
+                    "from_service": request.get("from_service"),
+                })
+        if pending["accepted"] is None:
+            return False
+        if not pending["accepted"]:
+            raise ProtocolError("File declined")
+        return True
+
+    def respond_offer(self, transfer_id, accept):
+        """The user's answer to transfer_offered; safe to call from any thread"""
+        with self._lock:
+            pending = self._offers.get(transfer_id)
+            if pending:
+                pending["accepted"] = bool(accept)
+
+    def _accept_offer(self, offer):
+        """Find or create the receiving state for an offered transfer.
+
+        Only files the user accepted through a file_request get new state;
+        resumed transfers were accepted before.
+        """
+        transfer_id, size = self._offered(offer)
+        with self._lock:
+            transfer = self._incoming.get(transfer_id)
+            if transfer:
+                return transfer
+        state = self._saved_state(transfer_id, size)
+        resumed = state is not None
+        if not resumed:
+            with self._lock:
+                pending = self._offers.get(transfer_id)
+            if not (pending and pending["accepted"]):
+                raise ProtocolError("File was not accepted")
+            filename = os.path.basename(str(offer.get("filename", ""))).strip() or "file"
+            state = {
+                "transfer_id": transfer_id,
+                "filename": filename,
+                "size": size,
+                "from_user": offer.get("from_user"),
+                "from_service": offer.get("from_service"),
+                "part_path": transfer_state_path(transfer_id)[:-len(".json")] + ".part",
+                "ranges": {},
+            }
+        with self._lock:
+            transfer = self._incoming.get(transfer_id)
+            if transfer:
+                return transfer  # Another range of the same file got here first
+            if not resumed and shutil.disk_usage(TRANSFER_STATE_DIR).free < size + FILE_FREE_SPACE_MARGIN:
+                raise ProtocolError("Not enough disk space")
+            transfer = IncomingTransfer(state)
+            if not resumed:
+                os.ftruncate(transfer.fd, size)
+                save_transfer_state(state)
+            self._incoming[transfer_id] = transfer
+            self._offers.pop(transfer_id, None)
+        self.network_manager.transfer_started.emit({
+            "transfer_id": transfer_id,
+            "filename": state["filename"],
+            "size": size,
+            "from_user": state.get("from_user"),
+            "from_service": state.get("from_service"),
+            "direction": "in",
+        })
+        return transfer
+
+    @staticmethod
+    def _expire_stale_transfers():
+        """Delete partial downloads whose files were all untouched for TRANSFER_STATE_MAX_AGE"""
+        cutoff = time.time() - TRANSFER_STATE_MAX_AGE
+        transfers = {}  # transfer id -> (newest mtime, paths)
+        try:
+            entries = list(os.scandir(TRANSFER_STATE_DIR))
+        except OSError:
+            return
+        for entry in entries:
+            transfer_id = entry.name.split(".", 1)[0]
+            if not re.fullmatch(r"[0-9a-f]{32}", transfer_id):
+                continue
+            try:
+                mtime = entry.stat().st_mtime
+            except OSError:
+                continue
+            newest, paths = transfers.get(transfer_id, (0, []))
+            transfers[transfer_id] = (max(newest, mtime), paths + [entry.path])
+        for newest, paths in transfers.values():
+            if newest < cutoff:
+                for path in paths:
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+
+    def _apply_manifest(self, transfer, chunks):
+        """Fill in chunks we already hold and return the byte ranges still needed"""
+        state = transfer.state
+        if "needs" in state:
+            return state["needs"]  # Resumed transfer: the plan was made before
+
+        known, needs, missing = [], [], []
+        offset = 0
+        for length, digest in chunks:
+            length = int(length)
+            digest_hex = bytes(digest).hex()
+            if length <= 0 or len(digest_hex) != 64:
+                raise ProtocolError("Invalid chunk manifest")
+            data = self.chunk_store.get(digest_hex)
+            if data is not None and len(data) == length:
+                os.pwrite(transfer.fd, data, offset)
+                regions = known
+            else:
+                missing.append([offset, length, digest_hex])
+                regions = needs
+            if regions and regions[-1][1] == offset:
+                regions[-1][1] = offset + length
+            else:
+                regions.append([offset, offset + length])
+            offset += length
+        if offset != state["size"]:
+            raise ProtocolError("Chunk manifest does not cover the file")
+
+        with transfer.lock:
+            for start, end in known:
+                state["ranges"][str(start)] = end
+            state["needs"] = needs
+            state["new_chunks"] = missing
+        transfer.checkpoint()
+        return needs
+
+    def _store_new_chunks(self, transfer):
+        """Add the chunks that came over the wire to the local chunk store"""
+        for offset, length, digest_hex in transfer.state.get("new_chunks", []):
+            data = os.pread(transfer.fd, length, offset)
+            if hashlib.sha256(data).hexdigest() == digest_hex:
+                try:
+                    self.chunk_store.put(digest_hex, data)
+                except OSError as e:
+                    print(f"Failed to store chunk {digest_hex}: {e}")
+                    return
+
+    def _maybe_complete(self, transfer):
+        """Move a fully received file into place once every byte has arrived"""
+        with self._lock:
+            if transfer.transfer_id not in self._incoming:
+                return True
+            if transfer.received() < transfer.state["size"]:
+                return False
+            del self._incoming[transfer.transfer_id]
+        self._store_new_chunks(transfer)
+        transfer.close()
+        final_path = unique_download_path(transfer.state["filename"])
+        os.replace(transfer.state["part_path"], final_path)
+        try:
+            os.remove(transfer_state_path(transfer.transfer_id))
+        except OSError:
+            pass
+        self.network_manager.transfer_progress.emit(
+            transfer.transfer_id, transfer.state["size"], transfer.state["size"])
+        self.network_manager.transfer_finished.emit(transfer.transfer_id, True, final_path)
+        return True
+
+    def shutdown(self):
+        """Stop outgoing transfers; partial incoming files stay resumable"""
+        with self._lock:
+            incoming = list(self._incoming.values())
+            self._incoming.clear()
+        for transfer in incoming:
+            transfer.close()
+        self._executor.shutdown(wait=False)
+
+class AdvancedNetworkManager(QObject):
+    """Network manager handling discovery and communication"""
+    user_discovered = Signal(dict)
+    user_went_offline = Signal(str)
+    message_sent = Signal(str, str)       # service name, message id
+    message_failed = Signal(str, str)     # service name, message id
+    message_queued = Signal(str, str)     # service name, message id kept for a retry
+    transfer_offered = Signal(dict)       # incoming file waiting for the user to accept it
+    transfer_started = Signal(dict)       # incoming file offer details
+    transfer_progress = Signal(str, int, int)  # transfer id, bytes done, total
+    transfer_finished = Signal(str, bool, str)  # transfer id, ok, file path or error
+    peer_health_changed = Signal(str, float, float, bool)  # service name, rtt ms (-1 unknown), loss, reachable
+    
+    def __init__(self, backlog=SERVER_BACKLOG, max_workers=SERVER_MAX_WORKERS,
+                 read_timeout=SERVER_READ_TIMEOUT):
+        super().__init__()
+        self.username = getpass.getuser()
+        self.my_addresses = local_addresses()
+        self.my_ip = self._get_local_ip()
+        self.backlog = backlog
+        self.server_socket = self._bind_server()
+        self.port = self.server_socket.getsockname()[1]
+        self.running = True
+        self.max_workers = max_workers
+        self.read_timeout = read_timeout
+
+        self.session_cache = TLSSessionCache()
+        self.health = PeerHealth(self._on_health_changed)
+        self.connection_pool = PeerConnectionPool(
+            get_client_ssl_context(), self.session_cache, self._hello_message(), self.health)
+        self.health_monitor = PeerHealthMonitor(self.connection_pool, self.health)
+        self.dispatcher = OutboundDispatcher(self.send_messages, self._on_send_done)
+        self.file_transfers = FileTransferEngine(self)
+        try:
+            self.zeroconf = Zeroconf(ip_version=IPVersion.All)
+        except OSError:
+            self.zeroconf = Zeroconf(ip_version=IPVersion.V4Only)
+        self.peers = PeerRegistry()
+        self.roster = PeerRoster(self.peers, self)
+        self.user_discovered.connect(self.roster.peer_seen)
+        self.user_went_offline.connect(self.roster.peer_lost)
+        self.listener = ZeroconfListener(self)
+        self.browser = None
+        self.outbox = Outbox(self.dispatcher.enqueue, self.peers.get, self._on_outbox_expired)
+        self.user_discovered.connect(self._flush_outbox)
+        self.inbox = InboundQueue(parent=self)  # received messages for the GUI
+        self._rate_limits = OrderedDict()  # (peer, "ping" or "message") -> TokenBucket, LRU order
+        self._unreachable = set()   # guarded by _group_lock
+        self._group_deliveries = OrderedDict()  # group message id -> members that acked it
+        self._relayed = set()   # (message id, member) already handed to a relay
+        self._relay_waiting = {}  # group message id -> members waiting for someone to relay through
+        self._group_lock = threading.Lock()
+        self._forwarding = set()  # (message id, member) we forward for others; not reported to the GUI
+        self._groups = {}         # group id -> group as the GUI knows it, guarded by _group_lock
+        self._received_ids = OrderedDict()
+        self._received_lock = threading.Lock()
+        
+        self.service_info = ServiceInfo(
+            SERVICE_TYPE,
+            f"{self.username}._S.{SERVICE_TYPE}",
+            parsed_addresses=[normalize_address(a) for a in self.my_addresses or [self.my_ip]],
+            port=self.port,
+            properties={
+                'username': self.username.encode('utf-8'),
+                'proto': str(PROTOCOL_VERSION).encode('utf-8'),
+            }
+        )
+
+    def _get_local_ip(self):
+        """Primary local address: the one with the default route, else the first interface"""
+        try:
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+                s.connect(("8.8.8.8", 80))
+                return s.getsockname()[0]
+        except OSError:
+            return self.my_addresses[0] if self.my_addresses else "127.0.0.1"
+
+    def _bind_server(self):
+        """Listening socket on a free port of every interface, served by run_tls_server.
+
+        Bound here rather than probed, so the port we announce is the one
+        we listen on, for IPv4 and IPv6 alike.
+        """
+        if socket.has_dualstack_ipv6():
+            return socket.create_server(("::", 0), family=socket.AF_INET6,
+                                        backlog=self.backlog, dualstack_ipv6=True)
+        return socket.create_server(("", 0), backlog=self.backlog)
+
+    def start_discovery(self):
+        """Start service discovery"""
+        QTimer.singleShot(0, self._start_zeroconf)
+
+    def _start_zeroconf(self):
+        """Initialize Zeroconf service browser and registration"""
+        try:
+            self.browser = asyncio.run_coroutine_threadsafe(
+                self._async_browse(), self.zeroconf.loop).result()
+            self._register_service()
+            threading.Thread(target=self.run_tls_server, daemon=True).start()
+        except Exception as e:
+            print(f"Failed to start Zeroconf: {e}")
+
+    async def _async_browse(self):
+        """Start the browser on the zeroconf event loop, where it must live"""
+        return AsyncServiceBrowser(self.zeroconf, SERVICE_TYPE,
+                                   handlers=[self.listener.on_service_state_change])
+
+    async def _async_stop_browse(self):
+        await self.browser.async_cancel()
+        self.listener.cancel()
+
+    def _register_service(self):
+        """Register our service with Zeroconf"""
+        try:
+            self.zeroconf.register_service(self.service_info)
+            print(f"Announcing self: {self.username} at {', '.join(self.my_addresses) or self.my_ip} port {self.port}")
+        except Exception as e:
+            print(f"Zeroconf register_service error: {e}")
+            if "NonUniqueNameException" in str(e):
+                unique_id = uuid.uuid4().hex[:8]
+                self.service_info.name = f"{self.username}-{unique_id}._S.{SERVICE_TYPE}"
+                try:
+                    self.zeroconf.register_service(self.service_info)
+                except Exception as e2:
+                    print(f"Failed to register service after renaming: {e2}")
+
+    def stop(self):
+        """Clean up network resources"""
+        self.running = False
+        self.dispatcher.shutdown()
+        self.outbox.close()
+        self.health_monitor.shutdown()
+        self.file_transfers.shutdown()
+        self.connection_pool.close_all()
+        print(f"TLS handshakes (full/resumed): {self.tls_stats()}")
+        try:
+            if self.browser:
+                asyncio.run_coroutine_threadsafe(
+                    self._async_stop_browse(), self.zeroconf.loop).result(1)
+            self.zeroconf.unregister_service(self.service_info)
+            self.zeroconf.close()
+        except Exception as e:
+            print(f"Error while stopping Zeroconf: {e}")
+
+        # Wake up the server socket if it's blocked on accept()
+        try:
+            with socket.create_connection(("127.0.0.1", self.port), timeout=1):
+                pass
+        except:
+            pass
+
+    def run_tls_server(self):
+        """Run TLS server to receive messages.
+
+        The accept loop only hands sockets off; the TLS handshake and frame
+        reads run on a bounded worker pool so that a slow or stalled peer
+        only occupies its own worker.
+        """
+        sock = self.server_socket
+        if not os.path.exists(CERTFILE) or not os.path.exists(KEYFILE):
+            print("Error: Certificate or key file missing!")
+            sock.close()
+            return
+
+        print(f"Starting TLS server on port {self.port}")
+        
+        try:
+            context = get_server_ssl_context()
+        except Exception as e:
+            print(f"Failed to load certificate: {e}")
+            sock.close()
+            return
+
+        # Limits in-flight connections; excess peers wait in the listen backlog
+        slots = threading.BoundedSemaphore(self.max_workers)
+
+        def release_slot(_future):
+            slots.release()
+
+        with sock, ThreadPoolExecutor(max_workers=self.max_workers,
+                                      thread_name_prefix="tls-conn") as pool:
+            sock.settimeout(1.0)
+
+            while self.running:
+                if not slots.acquire(timeout=1.0):
+                    continue
+                try:
+                    newsocket, fromaddr = sock.accept()
+                except socket.timeout:
+                    slots.release()
+                    continue
+                except Exception as e:
+                    slots.release()
+                    if self.running:
+                        print(f"TLS server error: {e}")
+                    continue
+
+                if not self.running:
+                    newsocket.close()
+                    slots.release()
+                    break
+
+                future = pool.submit(self._handle_connection, context, newsocket, fromaddr)
+                future.add_done_callback(release_slot)
+
+    def _hello_message(self, codec=None):
+        """Hello frame: offers our codecs, or names the chosen one in a reply"""
+        hello = {"type": "hello", "proto": PROTOCOL_VERSION, "from_user": self.username,
+                 "features": list(PROTOCOL_FEATURES)}
+        if codec:
+            hello["codec"] = codec.name
+        else:
+            hello["codecs"] = list(CODEC_PREFERENCE)
+        return hello
+
+    def _handle_connection(self, context, newsocket, fromaddr):
+        """Handshake with one peer and read its frames until it disconnects.
+
+        The first frame is always v1. A hello offering v2 is answered and
+        the connection switches to v2 frames; anything else is a v1 peer
+        whose frames are read in the old format. Each frame must arrive
+        within the read deadline once it starts, and the connection is
+        dropped after SERVER_IDLE_TIMEOUT of silence.
+        """
+        try:
+            newsocket.settimeout(self.read_timeout)
+            with context.wrap_socket(newsocket, server_side=True) as ssock:
+                self.session_cache.record_handshake(ssock, server_side=True)
+                # Short socket timeout so deadlines are checked regularly
+                ssock.settimeout(1.0)
+
+                message = self._read_legacy_message(ssock, fromaddr)
+                if message and message.get("type") == "hello" and int(message.get("proto", 1)) >= 2:
+                    codec = choose_codec(message.get("codecs"))
+                    ssock.sendall(encode_legacy_frame(self._hello_message(codec)))
+                    self._serve_v2(ssock, fromaddr, codec)
+                    return
+
+                while message is not None and self.running:
+                    if message:
+                        self._emit_message(message, fromaddr, retry=False)
+                    message = self._read_legacy_message(ssock, fromaddr)
+        except socket.timeout:
+            print(f"TLS handshake with {fromaddr[0]} timed out")
+        except ssl.SSLError as e:
+            print(f"SSL error: {e}")
+        except Exception as e:
+            if self.running:
+                print(f"TLS connection error from {fromaddr[0]}: {e}")
+        finally:
+            newsocket.close()
+
+    def _read_legacy_message(self, ssock, fromaddr):
+        """Read one v1 frame; None ends the connection, {} is an undecodable frame"""
+        # Get message length (first 4 bytes)
+        idle_deadline = time.monotonic() + SERVER_IDLE_TIMEOUT
+        raw_msglen = recv_exact(ssock, 4, idle_deadline)
+        if not raw_msglen:
+            return None
+            
+        msglen = struct.unpack('>I', raw_msglen)[0]
+        if msglen > MAX_FRAME_SIZE:
+            return None
+            
+        # Get the actual message data
+        deadline = time.monotonic() + self.read_timeout
+        full_data = recv_exact(ssock, msglen, deadline)
+        if not full_data:
+            print(f"Dropped slow or incomplete frame from {fromaddr[0]}")
+            return None
+            
+        try:
+            return json.loads(full_data)
+        except (json.JSONDecodeError, UnicodeDecodeError, RecursionError) as e:
+            print(f"Failed to decode message: {e}")
+            return {}
+
+    def _serve_v2(self, ssock, fromaddr, codec):
+        """Read v2 frames from a negotiated connection and dispatch them by type"""
+        streams = {}
+        acks = {"ids": [], "deferred": []}
+        try:
+            while self.running:
+                # Ack everything received so far once the sender's burst is read
+                if ((acks["ids"] or acks["deferred"]) and not ssock.pending()
+                        and not select.select([ssock], [], [], 0)[0]):
+                    ssock.sendall(encode_frame(FRAME_CONTROL, CHAT_STREAM_ID,
+                                               codec.encode(dict(acks, type="msg_ack"))))
+                    acks = {"ids": [], "deferred": []}
+                idle_deadline = time.monotonic() + SERVER_IDLE_TIMEOUT
+                frame = recv_frame(ssock, idle_deadline, self.read_timeout)
+                if frame is None:
+                    return
+                frame_type, stream_id, payload = frame
+                if not self._dispatch_frame(ssock, fromaddr, codec, frame_type, stream_id, payload,
+                                            streams, acks):
+                    return
+        except ProtocolError as e:
+            print(f"Closing connection from {fromaddr[0]}: {e}")
+        finally:
+            self.file_transfers.release_streams(streams)
+
+    def _within_rate(self, peer, message):
+        """Take a token from the peer's bucket for this kind of message.
+
+        Called under _received_lock. Only the RATE_LIMIT_CACHE most recently
+        seen buckets are kept; a peer quiet long enough to be evicted would
+        have refilled its bucket anyway.
+        """
+        if message.get("type") == "ping":
+            key, rate, burst = (peer, "ping"), INBOUND_PING_RATE, INBOUND_PING_BURST
+        else:
+            key, rate, burst = (peer, "message"), INBOUND_MESSAGE_RATE, INBOUND_MESSAGE_BURST
+        bucket = self._rate_limits.get(key)
+        if bucket is None:
+            bucket = self._rate_limits[key] = TokenBucket(rate, burst)
+            while len(self._rate_limits) > RATE_LIMIT_CACHE:
+                self._rate_limits.popitem(last=False)
+        else:
+            self._rate_limits.move_to_end(key)
+        return bucket.take()
+
+    def _emit_message(self, message, fromaddr, retry=True):
+        """Hand a received message to the GUI, tagged with the sender's service name.
+
+        Returns False when the sender should offer the message again
+        later: its peer is over the rate limit, the inbox is full, or a
+        text message comes from a peer the chat list does not show yet,
+        as when a peer flushes its outbox the moment it discovers us.
+        Retried messages the GUI already has are dropped by id, and so are
+        pings over the limit, since a ping is not worth a retry. Senders
+        that cannot retry (``retry=False``) always get their text through.
+        Malformed messages are acked and dropped here, before the GUI sees them.
+        """
+        problem = message_problem(message)
+        if problem:
+            print(f"Dropped message from {fromaddr[0]}: {problem}")
+            return True
+        message_id = message.get("id")
+        peer_data = self.peers.resolve(message, fromaddr[0])
+        if peer_data:
+            message["from_service"] = peer_data['name']
+        if (retry and message.get("type") == "text" and not message.get("group")
+                and not (peer_data and self.roster.is_listed(peer_data['name']))):
+            print(f"Message from {fromaddr[0]} arrived before its sender was listed; deferring it")
+            return False
+        group = message.get("group")
+        if group and message.get("type") != "ping":
+            known = self._known_group(group["id"])
+            if not peer_data or (known is None and message.get("type") == "text"):
+                # Sender not discovered yet, or the group's invite is still on its way
+                if retry:
+                    print(f"Group message from {fromaddr[0]} arrived before its sender or group; deferring it")
+                    return False
+                return True
+            if peer_data['name'] not in (known or group)["members"]:
+                print(f"Dropped group message from {fromaddr[0]}: not a member of the group")
+                return True
+        with self._received_lock:
+            if message_id in self._received_ids:
+                return True
+            if (not self._within_rate(peer_data['name'] if peer_data else fromaddr[0], message)
+                    or not self.inbox.put(message)):
+                print(f"Busy: {message.get('type', 'message')} from {fromaddr[0]} not accepted")
+                return message.get("type") == "ping"
+            if message_id:
+                self._received_ids[message_id] = True
+                if len(self._received_ids) > RECEIVED_ID_CACHE:
+                    self._received_ids.popitem(last=False)
+        return True
+
+    def _dispatch_frame(self, ssock, fromaddr, codec, frame_type, stream_id, payload, streams, acks):
+        """Handle one v2 frame; returns False when the connection should close.
+
+        Ids of chat messages are added to acks for the sender, under
+        "deferred" when the sender should offer them again later.
+        """
+        if frame_type in (FRAME_TEXT, FRAME_PING) and len(payload) > MAX_MESSAGE_SIZE:
+            print(f"Dropped oversized message ({len(payload)} bytes) from {fromaddr[0]}")
+        elif frame_type in (FRAME_TEXT, FRAME_PING, FRAME_CONTROL):
+            try:
+                message = codec.decode(payload)
+            except (ValueError, TypeError) as e:
+                print(f"Failed to decode message: {e}")
+                return True
+            if not isinstance(message, dict):
+                print(f"Dropped message from {fromaddr[0]}: not an object")
+                return True
+            if frame_type == FRAME_CONTROL:
+                if message.get("type") == "bye":
+                    return False
+                if message.get("type") == "probe":
+                    ssock.sendall(encode_frame(FRAME_CONTROL, stream_id, codec.encode(
+                        {"type": "probe_ack", "seq": message.get("seq")})))
+                    return True
+                if message.get("type") == "relay":
+                    self._forward_relayed(message, fromaddr)
+                    acks["ids"].append(message.get("id"))
+                    return True
+                if self.file_transfers.handle_control(ssock, codec, stream_id, message, streams):
+                    return True
+            accepted = self._emit_message(message, fromaddr)
+            if message.get("id"):
+                acks["ids" if accepted else "deferred"].append(message["id"])
+        elif frame_type == FRAME_FILE_CHUNK:
+            self.file_transfers.handle_chunk(ssock, codec, stream_id, payload, streams)
+        elif frame_type == FRAME_ACK:
+            pass  # Acks are read by the sender on its own connection
+        else:
+            print(f"Ignoring unknown frame type {frame_type}")
+        return True
+
+    def tls_stats(self):
+        """Full vs resumed TLS handshake counts for client and server side"""
+        return self.session_cache.stats()
+
+    def send_file(self, peer_info, path):
+        """Stream a file to a peer in the background; returns the transfer id"""
+        return self.file_transfers.send_file(peer_info, path)
+
+    def respond_file_offer(self, transfer_id, accept):
+        """Accept or decline a file announced by transfer_offered"""
+        self.file_transfers.respond_offer(transfer_id, accept)
+
+    def queue_message(self, peer_info, message_dict):
+        """Queue a message for background delivery and return its id.
+
+        Safe to call from the GUI thread: the network I/O happens on the
+        dispatcher's workers and the outcome is reported through the
+        message_sent / message_failed signals.
+        """
+        message_dict.setdefault("id", uuid.uuid4().hex)
+        message_dict.setdefault("from_service", self.service_info.name)
+        if message_dict.get("type") == "text":
+            self.outbox.add(peer_info.get('name'), message_dict)
+        self.dispatcher.enqueue(peer_info, message_dict)
+        return message_dict["id"]
+
+    def send_group(self, group, message_dict):
+        """Queue one message for every other member of a group.
+
+        The message is stored in the outbox per member and handed to the
+        dispatcher for the members that are online, so the fan-out runs on
+        the send workers in parallel, one pooled connection per member.
+        Returns the message id and the members it is addressed to.
+        """
+        message_dict.setdefault("id", uuid.uuid4().hex)
+        message_dict.setdefault("from_service", self.service_info.name)
+        message_dict["group"] = {"id": group["id"], "name": group["name"],
+                                 "members": list(group["members"])}
+        members = [m for m in group["members"] if m != self.service_info.name]
+        for member in members:
+            self.outbox.add(member, message_dict)
+            peer_info = self.peers.get(member)
+            if peer_info:
+                self.dispatcher.enqueue(peer_info, message_dict)
+        return message_dict["id"], members
+
+    def send_group_update(self, group):
+        """Tell the other members a group's name and members, inviting those new to it"""
+        return self.send_group(group, {"type": "group_update", "timestamp": time.time()})
+
+    def set_group(self, group):
+        """Record a group the user has; relays and group messages are checked against it"""
+        with self._group_lock:
+            self._groups[group["id"]] = {"id": group["id"], "name": group["name"],
+                                         "members": list(group["members"])}
+
+    def _known_group(self, group_id):
+        with self._group_lock:
+            return self._groups.get(group_id)
+
+    def _relay_group_message(self, name, message_dict):
+        """Ask a member that already has the message to forward it to one we cannot reach"""
+        message_id = message_dict["id"]
+        with self._group_lock:
+            if (message_id, name) in self._relayed:
+                return
+            best = None
+            for member in self._group_deliveries.get(message_id, ()):
+                rtt, _loss, reachable = self.health.estimate(member)
+                peer_info = self.peers.get(member)
+                if peer_info and reachable and (best is None or (rtt or 0) < best[0]):
+                    best = (rtt or 0, peer_info)
+            if not best:
+                # Relayed as soon as any member has the message
+                self._relay_waiting.setdefault(message_id, {})[name] = message_dict
+                return
+            self._relayed.add((message_id, name))
+        print(f"Relaying group message to {name} via {best[1].get('username')}")
+        self.dispatcher.enqueue(best[1], {"type": "relay", "id": uuid.uuid4().hex,
+                                          "from_service": self.service_info.name,
+                                          "to": name, "message": message_dict})
+
+    def _forward_relayed(self, request, fromaddr):
+        """Deliver a group message another member could not.
 
-        print(f"Starting TLS server on {self.my_ip}:{self.port}")
-        
-        context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
-        try:
-            context.load_cert_chain(certfile=CERTFILE, keyfile=KEYFILE)
-        except Exception as e:
-            print(f"Failed to load certificate: {e}")
+        Only done for a group we have ourselves, when the member asking,
+        the message's author and its target all belong to it as we know it;
+        what the request says about the group is not trusted.
+        """
+        inner = request.get("message")
+        target = request.get("to")
+        if not GROUP_RELAY or message_problem(inner) or not inner.get("id") or not isinstance(target, str):
+            return
+        group = self._known_group((inner.get("group") or {}).get("id"))
+        relayer = self.peers.resolve(request, fromaddr[0])
+        if (not group or not relayer or target == self.service_info.name
+                or not {self.service_info.name, target, relayer['name'],
+                        inner.get("from_service")} <= set(group["members"])):
+            print(f"Ignoring relay request from {fromaddr[0]}: not between members of a group we have")
             return
+        with self._group_lock:
+            self._forwarding.add((inner["id"], target))
+        self.outbox.add(target, inner)
+        peer_info = self.peers.get(target)
+        if peer_info:
+            self.dispatcher.enqueue(peer_info, inner)
 
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            sock.settimeout(1.0)
-            
-            try:
-                sock.bind((self.my_ip, self.port))
-                sock.listen(5)
-            except OSError as e:
-                print(f"Failed to bind to port {self.port}: {e}")
-                return
+    def _on_health_changed(self, name, rtt, loss, reachable):
+        """Called from probe, sender and server threads alike"""
+        with self._group_lock:
+            recovered = reachable and name in self._unreachable
+            if reachable:
+                self._unreachable.discard(name)
+            else:
+                self._unreachable.add(name)
+        if recovered:
+            self.outbox.flush(name)
+        self.peer_health_changed.emit(name, rtt * 1000 if rtt is not None else -1.0, loss, reachable)
 
-            while self.running:
-                try:
-                    newsocket, fromaddr = sock.accept()
-                    with context.wrap_socket(newsocket, server_side=True) as ssock:
-                        # Get message length (first 4 bytes)
-                        raw_msglen = self._recvall(ssock, 4)
-                        if not raw_msglen:
-                            continue
-                            
-                        msglen = struct.unpack('>I', raw_msglen)[0]
-                        if msglen > 10 * 1024 * 1024:  # 10MB limit
-                            continue
-                            
-                        # Get the actual message data
-                        full_data = self._recvall(ssock, msglen)
-                        if not full_data:
-                            continue
-                            
-                        try:
-                            message = json.loads(full_data.decode('utf-8'))
-                            self.private_message_received.emit(message)
-                        except (json.JSONDecodeError, UnicodeDecodeError) as e:
-                            print(f"Failed to decode message: {e}")
-                except socket.timeout:
-                    continue
-                except ssl.SSLError as e:
-                    print(f"SSL error: {e}")
-                except Exception as e:
-                    if self.running:
-                        print(f"TLS server error: {e}")
+    def _flush_outbox(self, peer_data):
+        """A peer (re)appeared: deliver its backlog now"""
+        self.health.revive(peer_data['name'])
+        self.outbox.flush(peer_data['name'])
+
+    def _on_outbox_expired(self, name, message_dict):
+        key = (message_dict.get("id", ""), name)
+        with self._group_lock:
+            forwarded = key in self._forwarding
+            self._forwarding.discard(key)
+        if not forwarded:
+            self.message_failed.emit(name, message_dict.get("id", ""))
+
+    def _on_send_done(self, peer_info, messages, ok):
+        name = peer_info.get('name', '')
+        for relay in (m for m in messages if m.get("type") == "relay" and not ok):
+            with self._group_lock:
+                self._relayed.discard((relay["message"].get("id"), relay.get("to")))  # try again later
+        messages = [m for m in messages if m.get("type") != "relay"]
+        ids = [message_dict.get("id", "") for message_dict in messages]
+        if ok:
+            self.outbox.remove(name, ids)
+        queued = set() if ok else self.outbox.pending(name, ids)
+        for message_dict in messages:
+            message_id = message_dict.get("id", "")
+            if "group" in message_dict:
+                if ok:
+                    with self._group_lock:
+                        self._group_deliveries.setdefault(message_id, set()).add(name)
+                        self._group_deliveries.move_to_end(message_id)
+                        if len(self._group_deliveries) > ENCODED_CACHE_SIZE:
+                            self._relay_waiting.pop(self._group_deliveries.popitem(last=False)[0], None)
+                        waiting = self._relay_waiting.pop(message_id, {})
+                    for target, relayed in waiting.items():
+                        self._relay_group_message(target, relayed)
+                elif GROUP_RELAY and message_id in queued and self.health.is_down(name):
+                    self._relay_group_message(name, message_dict)
+            with self._group_lock:
+                forwarded = (message_id, name) in self._forwarding
+                if ok:
+                    self._forwarding.discard((message_id, name))
+            if forwarded:
+                continue
+            if ok:
+                signal = self.message_sent
+            else:
+                signal = self.message_queued if message_id in queued else self.message_failed
+            signal.emit(name, message_id)
 
     def send_tcp_message(self, peer_info, message_dict):
-        """Send a TCP message to a peer"""
+        """Send a TCP message to a peer, blocking until done; returns True on success"""
+        ok, deferred = self.send_messages(peer_info, [message_dict])
+        return ok and not deferred
+
+    def send_messages(self, peer_info, messages):
+        """Send a batch of messages to one peer, blocking until done.
+
+        Returns whether the send succeeded and the ids the peer deferred.
+        """
         if not peer_info or 'address' not in peer_info or 'port' not in peer_info:
             print(f"Invalid peer_info: {peer_info}")
-            return
+            return False, set()
 
-        print(f"Attempting to connect to {peer_info.get('username')} at {peer_info.get('address')}:{peer_info.get('port')}")
-        
-        context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
-        context.check_hostname = False
-        context.verify_mode = ssl.CERT_NONE
+        print(f"Sending {len(messages)} message(s) to {peer_info.get('username')} at {peer_info.get('address')}:{peer_info.get('port')}")
         
         try:
             address = peer_info.get('address')
@@ -398,31 +4017,22 @@ class AdvancedNetworkManager(QObject):
             
             if not address or not port:
                 print(f"Invalid peer info: {peer_info}")
-                return
+                return False, set()
                 
-            with socket.create_connection((address, port), timeout=5) as sock:
-                with context.wrap_socket(sock, server_hostname=address) as ssock:
-                    message_bytes = json.dumps(message_dict).encode('utf-8')
-                    # Prefix message with its length (4-byte big-endian)
-                    ssock.sendall(struct.pack('>I', len(message_bytes)))
-                    ssock.sendall(message_bytes)
+            return True, self.connection_pool.send(peer_info, messages)
+        except PeerDownError:
+            print(f"Peer {peer_info['username']} is unreachable; waiting for it to answer a probe")
         except ConnectionRefusedError:
+            # Only a health signal: the pool marked the peer down and probes it
+            # until it answers; the chat list follows zeroconf alone
             print(f"Peer {peer_info['username']} is offline or firewall is blocking port {peer_info['port']}")
-            self.user_went_offline.emit(peer_info['name'])
         except socket.timeout:
             print(f"Peer {peer_info['username']} is not responding (timeout)")
         except OSError as e:
             print(f"Failed to send message to {peer_info.get('username')}: {e}")
         except Exception as e:
             print(f"Unexpected error sending to {peer_info.get('username')}: {e}")
-
-    def is_peer_reachable(self, address, port):
-        """Check if a peer is reachable"""
-        try:
-            with socket.create_connection((address, port), timeout=2):
-                return True
-        except:
-            return False
+        return False, set()
 
 class EmojiDialog(QDialog):
     """Dialog for emoji selection"""
@@ -476,17 +4086,7 @@ class EmojiDialog(QDialog):
                 btn = QPushButton(emoji)
                 btn.setFixedSize(32, 32)
                 
-                # Find best emoji font
-                emoji_font = QFont()
-                for fname in ["Segoe UI Emoji", "Noto Color Emoji", "Apple Color Emoji"]:
-                    emoji_font.setFamily(fname)
-                    if QFont(fname).exactMatch():
-                        break
-                else:
-                    emoji_font.setFamily("Segoe UI")
-                
-                emoji_font.setPointSize(18)
-                btn.setFont(emoji_font)
+                btn.setFont(emoji_font(18))
                 btn.setStyleSheet("font-size:20px; border:none; background:transparent;")
                 btn.clicked.connect(lambda checked=False, e=emoji: self._emoji_selected(e))
                 grid.addWidget(btn, idx // cols, idx % cols)
@@ -502,6 +4102,60 @@ class EmojiDialog(QDialog):
         self.parent().insert_emoji(emoji)
         self.accept()
 
+def load_groups():
+    """Group chats created here or joined by receiving their messages"""
+    try:
+        with open(GROUPS_PATH) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return []
+
+def save_groups(groups):
+    """Atomically persist the known group chats"""
+    tmp_path = GROUPS_PATH + ".tmp"
+    try:
+        with open(tmp_path, "w") as f:
+            json.dump(groups, f)
+        os.replace(tmp_path, GROUPS_PATH)
+    except OSError as e:
+        print(f"Failed to save groups: {e}")
+
+class NewGroupDialog(QDialog):
+    """Pick a name and online users for a new group chat"""
+    def __init__(self, peers, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("New Group")
+        self.setMinimumWidth(320)
+        
+        layout = QVBoxLayout(self)
+        self.name_field = QLineEdit(placeholderText="Group name")
+        self.member_list = QListWidget()
+        for peer_data in peers:
+            item = QListWidgetItem(peer_data['username'])
+            item.setData(Qt.ItemDataRole.UserRole, peer_data['name'])
+            item.setFlags(item.flags() | Qt.ItemFlag.ItemIsUserCheckable)
+            item.setCheckState(Qt.CheckState.Unchecked)
+            self.member_list.addItem(item)
+            
+        buttons = QDialogButtonBox(QDialogButtonBox.StandardButton.Ok
+                                   | QDialogButtonBox.StandardButton.Cancel)
+        buttons.accepted.connect(self.accept)
+        buttons.rejected.connect(self.reject)
+        
+        layout.addWidget(self.name_field)
+        layout.addWidget(QLabel("Members"))
+        layout.addWidget(self.member_list)
+        layout.addWidget(buttons)
+        
+    def group_name(self):
+        return self.name_field.text().strip()
+        
+    def members(self):
+        """Service names of the checked users"""
+        items = (self.member_list.item(row) for row in range(self.member_list.count()))
+        return [item.data(Qt.ItemDataRole.UserRole) for item in items
+                if item.checkState() == Qt.CheckState.Checked]
+
 class MainWindow(QMainWindow):
     """Main application window"""
     def __init__(self):
@@ -509,11 +4163,20 @@ class MainWindow(QMainWindow):
         self._setup_resources()
         self._setup_ui()
         self._setup_network()
+        for group in load_groups():
+            self.add_group(group)
         
         # Animation timers
         self.shake_timer = QTimer(self)
         self.shake_timer.timeout.connect(self._shake_step)
         self.shake_counter = 0
+        self.ping_sound = None
+        self.ping_bursts = {}  # chat -> the ping bubble repeated pings are counted in
+        
+        # Drop chat pages nobody has looked at for a while
+        self.page_evict_timer = QTimer(self)
+        self.page_evict_timer.timeout.connect(self._evict_chat_pages)
+        self.page_evict_timer.start(CHAT_PAGE_EVICT_INTERVAL)
         
     def _setup_resources(self):
         """Setup application resources"""
@@ -553,7 +4216,12 @@ class MainWindow(QMainWindow):
         
         # Initialize chat data structures
         self.chat_widgets = {}
+        self.open_pages = OrderedDict()  # service name -> last use, least recent first
         self.active_transfers = {}
+        self.message_models = {}  # message id -> history model of a pending sent message
+        self.group_deliveries = {}  # group message id -> model, members delivered to, member count
+        self.groups = {}  # group id -> group
+        self.history_store = HistoryStore()
         
     def _setup_ui(self):
         """Setup the main UI"""
@@ -602,6 +4270,12 @@ class MainWindow(QMainWindow):
                 border-radius: 8px;
                 padding: 8px;
             }}
+            QWidget#chatListItem, QWidget#chatListItem QLabel {{
+                background: transparent;
+            }}
+            QLabel#chatListName {{
+                color: {APP_COLORS['text_primary']};
+            }}
             QScrollBar:vertical {{
                 width: 7px;
                 background: {APP_COLORS['sidebar_bg']};
@@ -627,7 +4301,58 @@ class MainWindow(QMainWindow):
         self.chat_list_widget.setHorizontalScrollBarPolicy(Qt.ScrollBarPolicy.ScrollBarAlwaysOff)
         self.chat_list_widget.itemClicked.connect(self.on_chat_selected)
         
+        # History search: results replace the chat list while there is a query
+        self.search_field = QLineEdit(placeholderText="Search messages (@user to filter)")
+        self.search_field.setClearButtonEnabled(True)
+        self.search_field.setStyleSheet(f"""
+            QLineEdit {{
+                background-color: {APP_COLORS['incoming_bg']};
+                border: 1px solid {APP_COLORS['input_border']};
+                border-radius: 16px;
+                padding: 8px 14px;
+                margin: 8px;
+                color: {APP_COLORS['text_primary']};
+                font-size: 14px;
+            }}
+        """)
+        self.search_timer = QTimer(self)
+        self.search_timer.setSingleShot(True)
+        self.search_timer.setInterval(SEARCH_DEBOUNCE)
+        self.search_timer.timeout.connect(self._run_search)
+        self.search_field.textChanged.connect(self.search_timer.start)
+        
+        self.search_results = QListWidget()
+        self.search_results.setStyleSheet(f"""
+            QListWidget {{
+                border: none;
+                background: {APP_COLORS['sidebar_bg']};
+            }}
+            QListWidget::item:hover {{
+                background-color: {APP_COLORS['active_chat']};
+            }}
+        """)
+        self.search_results.setHorizontalScrollBarPolicy(Qt.ScrollBarPolicy.ScrollBarAlwaysOff)
+        self.search_results.itemClicked.connect(self._open_search_result)
+        self.search_results.hide()
+        
+        new_group_button = QPushButton()
+        new_group_button.setIcon(create_icon_from_svg(ICONS['group'], APP_COLORS['icon_color']))
+        new_group_button.setIconSize(QSize(22, 22))
+        new_group_button.setFixedSize(40, 40)
+        new_group_button.setCursor(Qt.CursorShape.PointingHandCursor)
+        new_group_button.setToolTip("New Group")
+        new_group_button.setStyleSheet("QPushButton { border: none; border-radius: 20px; }"
+                                       f"QPushButton:hover {{ background-color: {APP_COLORS['active_chat']}; }}")
+        new_group_button.clicked.connect(self.create_group)
+        
+        search_layout = QHBoxLayout()
+        search_layout.setContentsMargins(0, 0, 8, 0)
+        search_layout.addWidget(self.search_field, 1)
+        search_layout.addWidget(new_group_button)
+        
+        left_layout.addLayout(search_layout)
         left_layout.addWidget(self.chat_list_widget)
+        left_layout.addWidget(self.search_results)
         main_layout.addWidget(self.left_panel)
         
     def _setup_right_panel(self, main_layout):
@@ -639,6 +4364,7 @@ class MainWindow(QMainWindow):
         right_layout.setContentsMargins(0, 0, 0, 0)
         
         self.chat_area = QStackedWidget()
+        self.chat_area.setStyleSheet(CHAT_PAGE_STYLESHEET)
         self.placeholder_widget = QLabel(
             f"""<div style='text-align:center;color:{APP_COLORS['timestamp']};'>
                 <h2 style='color:{APP_COLORS['text_primary']};'>B-Messenger</h2>
@@ -658,183 +4384,99 @@ class MainWindow(QMainWindow):
         self.network_manager.moveToThread(self.network_thread)
         
         # Connect signals
-        self.network_manager.user_discovered.connect(self.add_user)
-        self.network_manager.user_went_offline.connect(self.remove_user)
-        self.network_manager.private_message_received.connect(self.handle_incoming_message)
+        self.network_manager.roster.roster_changed.connect(self.apply_roster_changes)
+        self.network_manager.peer_health_changed.connect(self._show_peer_health)
+        self.network_manager.inbox.ready.connect(self._drain_inbox)
+        self.network_manager.message_sent.connect(self._on_message_sent)
+        self.network_manager.message_failed.connect(self._on_message_failed)
+        self.network_manager.message_queued.connect(self._on_message_queued)
+        self.network_manager.transfer_offered.connect(self._on_transfer_offered)
+        self.network_manager.transfer_started.connect(self._on_transfer_started)
+        self.network_manager.transfer_progress.connect(self._on_transfer_progress)
+        self.network_manager.transfer_finished.connect(self._on_transfer_finished)
         
         self.network_thread.started.connect(self.network_manager.start_discovery)
         self.network_thread.start()
         
-    def _create_chat_page(self, username, service_name):
-        """Create a chat page for a user"""
+    def _create_chat_page(self, username, service_name, history_model):
+        """Create a chat page for a user (styled by CHAT_PAGE_STYLESHEET).
+
+        username is only the title; history is stored under service_name.
+        """
         page = QWidget()
         layout = QVBoxLayout(page)
         layout.setContentsMargins(0, 0, 0, 0)
         layout.setSpacing(0)
         
         # Header
-        header_widget = QWidget()
+        header_widget = QWidget(objectName="chatHeader")
+        header_widget.setAttribute(Qt.WidgetAttribute.WA_StyledBackground)
         header_widget.setFixedHeight(60)
-        header_widget.setStyleSheet(
-            f"background-color: {APP_COLORS['header_bg']}; "
-            f"border-bottom: 1px solid {APP_COLORS['input_border']}; "
-            "padding: 0 10px;"
-        )
         
         header_layout = QHBoxLayout(header_widget)
         header_layout.setContentsMargins(0, 0, 0, 0)
         
-        header_label = QLabel(username)
+        header_label = QLabel(username, objectName="chatTitle")
         header_label.setFont(QFont("Segoe UI", 12, QFont.Weight.Bold))
-        header_label.setStyleSheet(f"color: {APP_COLORS['text_primary']};")
         
-        ping_button = QPushButton()
+        ping_button = QPushButton(objectName="pingButton")
         ping_button.setIcon(create_icon_from_svg(ICONS['ping'], APP_COLORS['icon_color']))
         ping_button.setIconSize(QSize(24, 24))
         ping_button.setFixedSize(40, 40)
         ping_button.setCursor(Qt.CursorShape.PointingHandCursor)
         ping_button.setToolTip("Send a Ping!")
-        ping_button.setStyleSheet("""
-            QPushButton { 
-                background-color: transparent; 
-                border-radius: 20px; 
-                border: none; 
-            } 
-            QPushButton:hover { 
-                background-color: #E0E0E0; 
-            }
-        """)
         ping_button.clicked.connect(lambda: self.send_ping(service_name))
         
         header_layout.addWidget(header_label)
         header_layout.addStretch()
         header_layout.addWidget(ping_button)
+        is_group = service_name.startswith(GROUP_CHAT_PREFIX)
+        ping_button.setVisible(not is_group)
         
-        # Chat area
-        scroll_area = QScrollArea()
-        scroll_area.setWidgetResizable(True)
-        scroll_area.setStyleSheet(f"""
-            QScrollArea {{
-                border: none;
-                background-color: {APP_COLORS['chat_bg']};
-            }}
-            QScrollBar:vertical {{
-                width: 8px;
-                background: #F0F2F5;
-                margin: 0px;
-                border-radius: 4px;
-            }}
-            QScrollBar::handle:vertical {{
-                background: #d1d7db;
-                min-height: 24px;
-                border-radius: 4px;
-            }}
-            QScrollBar::add-line:vertical, QScrollBar::sub-line:vertical {{
-                height: 0px;
-                background: none;
-                border: none;
-            }}
-            QScrollBar::add-page:vertical, QScrollBar::sub-page:vertical {{
-                background: none;
-            }}
-        """)
-        scroll_area.setHorizontalScrollBarPolicy(Qt.ScrollBarPolicy.ScrollBarAlwaysOff)
-        
-        scroll_content_widget = QWidget()
-        scroll_area.setWidget(scroll_content_widget)
-        
-        scroll_layout = QVBoxLayout(scroll_content_widget)
-        scroll_layout.addStretch()
+        # Chat area: only visible messages are painted, by MessageDelegate
+        history_view = ChatHistoryView(service_name, history_model)
+        history_view.setObjectName("chatHistory")
+        history_view.older_history_requested.connect(lambda: self._load_history_page(history_view))
         
         # Input toolbar
-        input_toolbar = QWidget()
+        input_toolbar = QWidget(objectName="inputToolbar")
+        input_toolbar.setAttribute(Qt.WidgetAttribute.WA_StyledBackground)
         input_toolbar.setMinimumHeight(62)
-        input_toolbar.setStyleSheet(f"""
-            QWidget {{
-                background-color: {APP_COLORS['header_bg']};
-                border-top: 1px solid {APP_COLORS['input_border']};
-                padding: 0px 16px;
-            }}
-        """)
         
         it_layout = QHBoxLayout(input_toolbar)
         it_layout.setSpacing(15)
         it_layout.setContentsMargins(0, 0, 0, 0)
         
         # Emoji button
-        emoji_button = QPushButton("😊")
+        emoji_button = QPushButton("😊", objectName="emojiButton")
         emoji_button.setFixedSize(48, 48)
         emoji_button.setCursor(Qt.CursorShape.PointingHandCursor)
         emoji_button.setToolTip("Insert Emoji")
-        
-        emoji_font = QFont()
-        for fname in ["Segoe UI Emoji", "Noto Color Emoji", "Apple Color Emoji"]:
-            emoji_font.setFamily(fname)
-            if QFont(fname).exactMatch():
-                break
-        else:
-            emoji_font.setFamily("Segoe UI")
-            
-        emoji_font.setPointSize(28)
-        emoji_button.setFont(emoji_font)
-        emoji_button.setStyleSheet("""
-            QPushButton {
-                background-color: transparent; 
-                border-radius: 24px; 
-                border: none; 
-                font-size: 28px; 
-                padding: 2px;
-            }
-            QPushButton:hover {
-                background-color: #E9EDEF;
-            }
-        """)
+        emoji_button.setFont(emoji_font(28))
         emoji_button.clicked.connect(self._show_emoji_dialog)
         
+        # Attach file button
+        attach_button = QPushButton(objectName="attachButton")
+        attach_button.setIcon(create_icon_from_svg(ICONS['attach'], APP_COLORS['icon_color']))
+        attach_button.setIconSize(QSize(24, 24))
+        attach_button.setFixedSize(40, 40)
+        attach_button.setCursor(Qt.CursorShape.PointingHandCursor)
+        attach_button.setToolTip("Send File")
+        attach_button.clicked.connect(lambda: self.send_file(service_name))
+        attach_button.setVisible(not is_group)  # Files go to one user at a time
+        
         # Input field
-        input_field = QLineEdit(placeholderText="Type a message...")
-        input_field.setFont(emoji_font)
-        input_field.setStyleSheet(f"""
-            QLineEdit {{
-                background-color: {APP_COLORS['incoming_bg']};
-                border: 1.5px solid {APP_COLORS['input_border']};
-                border-radius: 24px;
-                padding-left: 20px;
-                padding-right: 20px;
-                padding-top: 14px;
-                padding-bottom: 14px;
-                color: {APP_COLORS['text_primary']};
-                font-size: 15px;
-                box-shadow: 0 2px 8px rgba(0,0,0,0.07);
-                transition: border-color 0.2s;
-            }}
-            QLineEdit:focus {{
-                border: 1.5px solid {APP_COLORS['primary_green']};
-                background-color: #fff;
-                outline: none;
-            }}
-            QLineEdit:hover {{
-                border: 1.5px solid {APP_COLORS['secondary_green']};
-            }}
-        """)
+        input_field = QLineEdit(placeholderText="Type a message...", objectName="messageInput")
+        input_field.setFont(emoji_font(28))
         
         # Send button
-        send_button = QPushButton()
-        send_button.setIcon(create_icon_from_svg(ICONS['send'], APP_COLORS['icon_color']))
+        send_button = QPushButton(objectName="sendButton")
+        send_button.setIcon(create_icon_from_svg(ICONS['send'], APP_COLORS['icon_color'],
+                                                 size=QSize(28, 28)))
         send_button.setIconSize(QSize(28, 28))
         send_button.setFixedSize(40, 40)
         send_button.setCursor(Qt.CursorShape.PointingHandCursor)
         send_button.setToolTip("Send Message")
-        send_button.setStyleSheet("""
-            QPushButton {
-                background-color: #e8f5e9; 
-                border-radius: 20px; 
-                border: none;
-            }
-            QPushButton:hover {
-                background-color: #c8e6c9;
-            }
-        """)
         
         # Connect send functionality
         send_button.clicked.connect(lambda: self.send_private_message(service_name))
@@ -842,17 +4484,17 @@ class MainWindow(QMainWindow):
         
         # Add widgets to layout
         it_layout.addWidget(emoji_button)
+        it_layout.addWidget(attach_button)
         it_layout.addWidget(input_field, 1)
         it_layout.addWidget(send_button)
         
         # Add all to main layout
         layout.addWidget(header_widget)
-        layout.addWidget(scroll_area, 1)
+        layout.addWidget(history_view, 1)
         layout.addWidget(input_toolbar)
         
         return page, {
-            "scroll_area": scroll_area,
-            "scroll_layout": scroll_layout,
+            "history_view": history_view,
             "input_field": input_field,
             "send_button": send_button
         }
@@ -878,154 +4520,159 @@ class MainWindow(QMainWindow):
         if input_field:
             input_field.insert(emoji)
             
-    def add_message_to_history(self, scroll_area, scroll_layout, msg_dict, is_sent):
-        """Add a message to chat history"""
-        stretch_item = scroll_layout.takeAt(scroll_layout.count() - 1)
+    def _history_entry(self, msg_dict, is_sent):
+        """Display fields of a message for ChatHistoryModel; None if it is not shown"""
         msg_type = msg_dict.get("type", "text")
-        is_event = msg_type == "ping"
-        
-        content_widget = None
+        entry = {
+            "kind": msg_type,
+            "is_sent": is_sent,
+            "timestamp": msg_dict['timestamp'],
+            "time": datetime.fromtimestamp(msg_dict['timestamp']).strftime('%H:%M'),
+        }
         
         if msg_type == "text":
             text = msg_dict['content']
+            entry["text"] = text
+            entry["html"] = render_message_html(text)
+            if msg_dict.get("group") and not is_sent:
+                sender = html.escape(msg_dict.get("from_user", ""))
+                entry["html"] = (f"<div style='color:{APP_COLORS['primary_green_dark']};"
+                                 f"font-weight:bold;'>{sender}</div>" + entry["html"])
             
-            # URL detection pattern
-            url_pattern = re.compile(
-                r'(?<![\w@])'  # Not preceded by word character or @
-                r'(?:https?://)?(?:www\.)?'
-                r'(?:[a-zA-Z0-9\-]+\.)+[a-zA-Z]{2,}'  # domain
-                r'(?::\d+)?(?:/[^\s<]*)?(?:\?[^\s<]*)?'  # port/path/query
-                r'(?![\w])'  # Not followed by word character
+        elif msg_type == "file":
+            entry.update(
+                text=msg_dict['filename'],
+                key=msg_dict['transfer_id'],
+                filename=msg_dict['filename'],
+                progress=0.0,
+                detail=self._format_size(msg_dict['size']),
             )
             
-            # Make URLs clickable
-            def linkify(match):
-                url = match.group(0)
-                if not url.startswith("http"):
-                    url = "https://" + url
-                return f"<a href='{url}' style='color:#2196F3;text-decoration:underline;'>{html.escape(match.group(0))}</a>"
-                
-            linked_text = url_pattern.sub(linkify, text)
-            
-            # Emoji pattern
-            emoji_pattern = re.compile(
-                "["
-                "\U0001F600-\U0001F64F"  # emoticons
-                "\U0001F300-\U0001F5FF"  # symbols & pictographs
-                "\U0001F680-\U0001F6FF"  # transport & map symbols
-                "\U0001F1E0-\U0001F1FF"  # flags (iOS)
-                "\U00002700-\U000027BF"  # dingbats
-                "\U0001F900-\U0001F9FF"  # supplemental symbols
-                "\U00002600-\U000026FF"  # miscellaneous symbols
-                "\U00002B50"             # star
-                "\U00002B06"             # up arrow
-                "]+", flags=re.UNICODE)
-            
-            # Don't modify emojis inside links
-            def repl(m):
-                before = linked_text[max(0, m.start()-10):m.start()]
-                after = linked_text[m.end():m.end()+10]
-                if '<a' in before and '</a>' in after:
-                    return m.group(0)
-                return f"<span style='font-size:2em; vertical-align:middle;'>{m.group(0)}</span>"
-                
-            html_text = emoji_pattern.sub(repl, linked_text)
-            display_text = f"<div style='color:{APP_COLORS['text_primary']};'>{html_text}</div>"
-            
-            content_widget = QLabel(display_text)
-            content_widget.setWordWrap(True)
-            
-            emoji_font = QFont()
-            for fname in ["Segoe UI Emoji", "Noto Color Emoji", "Apple Color Emoji"]:
-                emoji_font.setFamily(fname)
-                if QFont(fname).exactMatch():
-                    break
-            else:
-                emoji_font.setFamily("Segoe UI")
-                
-            emoji_font.setPointSize(11)
-            content_widget.setFont(emoji_font)
-            content_widget.setTextFormat(Qt.TextFormat.RichText)
-            content_widget.setOpenExternalLinks(True)
-            
-        elif is_event:
-            from_user = msg_dict.get("from_user")
-            text = "PING!!! sent" if is_sent else f"PING!!! from {from_user}"
-            content_widget = QLabel(f"<span style='color:{APP_COLORS['ping_color']}; font-weight:bold;'>PING!!!</span>")
-            content_widget.setWordWrap(True)
-            content_widget.setFont(QFont("Segoe UI", 11, QFont.Weight.Bold))
-            
-        if not content_widget:
-            scroll_layout.addStretch()
-            return
-            
-        # Create message bubble
-        bubble_widget = QWidget()
-        bubble_layout = QVBoxLayout(bubble_widget)
-        bubble_layout.setContentsMargins(12, 8, 12, 8)
-        bubble_layout.addWidget(content_widget)
-        
-        if not is_event:
-            ts_label = QLabel(datetime.fromtimestamp(msg_dict['timestamp']).strftime('%H:%M'))
-            ts_label.setFont(QFont("Segoe UI", 9))
-            ts_label.setStyleSheet(f"color: {APP_COLORS['timestamp']}; background: transparent;")
-            bubble_layout.addWidget(ts_label, 0, Qt.AlignmentFlag.AlignRight)
+        elif msg_type == "ping":
+            entry["text"] = "PING!!! sent" if is_sent else f"PING!!! from {msg_dict.get('from_user')}"
+            entry["count"] = msg_dict.get("count", 1)
+            if msg_dict.get("id"):
+                entry["key"] = msg_dict["id"]
             
-        bg_color = APP_COLORS["outgoing_bg"] if is_sent else APP_COLORS["incoming_bg"]
-        bubble_widget.setStyleSheet(f"background-color: {'transparent' if is_event else bg_color}; border-radius: 12px;")
-        
-        # Container for proper alignment
-        container_widget = QWidget()
-        container_layout = QHBoxLayout(container_widget)
-        container_layout.setContentsMargins(10, 5, 10, 5)
-        bubble_widget.setSizePolicy(QSizePolicy.Policy.Maximum, QSizePolicy.Policy.Preferred)
-        
-        if is_event:
-            if is_sent:
-                container_layout.addStretch()
-                container_layout.addWidget(bubble_widget)
-            else:
-                container_layout.addWidget(bubble_widget)
-                container_layout.addStretch()
-        elif is_sent:
-            container_layout.addStretch()
-            container_layout.addWidget(bubble_widget)
         else:
-            container_layout.addWidget(bubble_widget)
-            container_layout.addStretch()
+            return None
+        return entry
+        
+    def add_message_to_history(self, data, msg_dict, is_sent):
+        """Add a message to a chat's history; kept in its model until the page is built"""
+        entry = self._history_entry(msg_dict, is_sent)
+        if entry is None:
+            return
             
-        scroll_layout.addWidget(container_widget)
-        scroll_layout.addStretch()
+        history_model = data['model']
+        if entry["kind"] == "file":
+            self.active_transfers[msg_dict['transfer_id']] = {
+                "model": history_model,
+                "filename": msg_dict['filename'],
+                "size": msg_dict['size'],
+            }
+        elif entry["kind"] == "text" and is_sent and msg_dict.get("id") and msg_dict.get("group"):
+            total = len(self._group_recipients(msg_dict["group"]))
+            entry.update(key=msg_dict["id"], status="group", delivered=(0, total))
+            self.group_deliveries[msg_dict["id"]] = {"model": history_model, "done": set(),
+                                                     "base": 0, "total": total}
+        elif entry["kind"] == "text" and is_sent and msg_dict.get("id"):
+            entry["key"] = msg_dict["id"]
+            entry["status"] = "pending"
+            self.message_models[msg_dict["id"]] = history_model
+        history_model.queue_entry(entry)
+        self.history_store.append(data['peer_data']['name'], msg_dict, is_sent, entry.get("status"))
+        if is_sent and data['widgets']:
+            data['widgets']['history_view'].scroll_to_latest()
         
-        # Auto-scroll to bottom
-        def safe_scroll():
+    def _load_history_page(self, history_view):
+        """Show the page of stored messages just before the oldest one in the view"""
+        oldest = history_view.history_model.oldest_entry()
+        before = (oldest["timestamp"], oldest.get("row_id")) if oldest else None
+        records = self.history_store.load_page(history_view.peer, before)
+        if len(records) < HISTORY_PAGE_SIZE:
+            history_view.history_complete = True
+            
+        entries = []
+        for record in records:
             try:
-                if scroll_area and scroll_area.verticalScrollBar():
-                    scroll_area.verticalScrollBar().setValue(
-                        scroll_area.verticalScrollBar().maximum()
-                    )
-            except RuntimeError:
-                pass  # Widget already deleted
-                
-        QTimer.singleShot(50, safe_scroll)
+                entry = self._history_entry(record["msg"], record["is_sent"])
+            except (KeyError, TypeError, ValueError, OSError):
+                continue  # Malformed stored message
+            if entry is None:
+                continue
+            entry["row_id"] = record["row_id"]
+            status, detail = record["status"], record["detail"]
+            if entry["kind"] == "text" and status == "group":
+                entry["key"] = key = record["msg"].get("id")
+                delivered = self.group_deliveries.get(key)
+                if delivered:
+                    delivered["model"] = history_view.history_model
+                    entry["delivered"] = (delivered["base"] + len(delivered["done"]), delivered["total"])
+                else:
+                    done, _, total = (detail or "").partition("/")
+                    try:
+                        entry["delivered"] = (int(done), int(total))
+                    except ValueError:
+                        entry["delivered"] = (0, len(self._group_recipients(record["msg"]["group"])))
+                    if entry["delivered"][0] < entry["delivered"][1]:
+                        # Members still in the outbox, possibly from an earlier session
+                        self.group_deliveries[key] = {"model": history_view.history_model, "done": set(),
+                                                      "base": entry["delivered"][0],
+                                                      "total": entry["delivered"][1]}
+                entry["status"] = status
+            elif entry["kind"] == "text" and status:
+                entry["key"] = key = record["msg"].get("id")
+                if key in self.message_models or status in ("pending", "queued"):
+                    # Still in the outbox, possibly from an earlier session
+                    self.message_models[key] = history_view.history_model
+                entry["status"] = status
+            elif entry["kind"] == "ping" and detail and detail.isdigit():
+                entry["count"] = int(detail)
+            elif entry["kind"] == "file":
+                transfer = self.active_transfers.get(entry["key"])
+                if transfer:
+                    transfer["model"] = history_view.history_model
+                elif status == "done":
+                    entry["progress"] = 1.0
+                    if detail and os.path.exists(detail):
+                        entry["url"] = QUrl.fromLocalFile(detail).toString()
+                elif status == "failed":
+                    entry.update(detail=f"✗ {detail}", error=True)
+            entries.append(entry)
+        history_view.prepend_entries(entries)
+        
+    def apply_roster_changes(self, added, updated, removed):
+        """Apply one batch of roster changes to the chat list"""
+        self.chat_list_widget.setUpdatesEnabled(False)
+        try:
+            for service_name in removed:
+                self.remove_user(service_name)
+            for peer_data in added:
+                self.add_user(peer_data)
+            for peer_data in updated:
+                self.update_user(peer_data)
+        finally:
+            self.chat_list_widget.setUpdatesEnabled(True)
+            
+    def _user_label(self, peer_data):
+        """Text shown for a peer in the chat list"""
+        username = peer_data['username']
+        if username == getpass.getuser():
+            host = socket.gethostname()
+        else:
+            host = peer_data.get('address', '')
+        return f"{username}@{host}"
         
     def add_user(self, peer_data):
         """Add a discovered user to the chat list"""
         service_name = peer_data['name']
         if service_name in self.chat_widgets:
+            self.update_user(peer_data)
             return
             
         username = peer_data['username']
-        try:
-            local_hostname = socket.gethostname()
-            if username == getpass.getuser():
-                host = local_hostname
-            else:
-                host = peer_data.get('address', '')
-        except Exception:
-            host = peer_data.get('address', '')
-            
-        user_label = f"{username}@{host}"
+        user_label = self._user_label(peer_data)
         
         # Select avatar based on username hash
         avatar_path = None
@@ -1033,11 +4680,7 @@ class MainWindow(QMainWindow):
             idx = abs(hash(username)) % len(self.avatar_files)
             avatar_path = self.avatar_files[idx]
             
-        # Create chat page
-        page, widgets = self._create_chat_page(username, service_name)
-        self.chat_area.addWidget(page)
-        
-        # Create list item
+        # Create list item; the chat page itself is built when first opened
         item = QListWidgetItem()
         item_widget = ChatListItem(user_label, avatar_path)
         item.setSizeHint(item_widget.sizeHint())
@@ -1046,15 +4689,12 @@ class MainWindow(QMainWindow):
         self.chat_list_widget.addItem(item)
         self.chat_list_widget.setItemWidget(item, item_widget)
         
-        # Connect send functionality
-        widgets["send_button"].clicked.connect(lambda _, s=service_name: self.send_private_message(s))
-        widgets["input_field"].returnPressed.connect(lambda s=service_name: self.send_private_message(s))
-        
         # Store widget references
         self.chat_widgets[service_name] = {
-            "page": page,
+            "page": None,
             "item": item,
-            "widgets": widgets,
+            "widgets": None,
+            "model": ChatHistoryModel(self),
             "peer_data": peer_data
         }
         
@@ -1063,26 +4703,214 @@ class MainWindow(QMainWindow):
             self.chat_list_widget.setCurrentItem(item)
             self.on_chat_selected(item)
             
+    def _group_recipients(self, group):
+        """Members a group message goes to: everyone but us"""
+        me = self.network_manager.service_info.name
+        return [member for member in group["members"] if member != me]
+        
+    def add_group(self, group):
+        """Add a group chat to the chat list; a known group only has its details refreshed"""
+        group = {"id": group["id"], "name": group["name"], "members": list(group["members"])}
+        service_name = GROUP_CHAT_PREFIX + group["id"]
+        peer_data = {"name": service_name, "username": f"#{group['name']}", "group": group}
+        self.groups[group["id"]] = group
+        self.network_manager.set_group(group)
+        data = self.chat_widgets.get(service_name)
+        if data:
+            data['peer_data'] = peer_data
+            data['item'].setData(Qt.ItemDataRole.UserRole, peer_data)
+            item_widget = self.chat_list_widget.itemWidget(data['item'])
+            if item_widget:
+                item_widget.username_label.setText(f"{group['name']} ({len(group['members'])})")
+            return data
+
+        item = QListWidgetItem()
+        item_widget = ChatListItem(f"{group['name']} ({len(group['members'])})", icon='group')
+        item.setSizeHint(item_widget.sizeHint())
+        item.setData(Qt.ItemDataRole.UserRole, peer_data)
+        item.setToolTip("Group")
+        self.chat_list_widget.insertItem(0, item)
+        self.chat_list_widget.setItemWidget(item, item_widget)
+        
+        self.chat_widgets[service_name] = data = {
+            "page": None,
+            "item": item,
+            "widgets": None,
+            "model": ChatHistoryModel(self),
+            "peer_data": peer_data
+        }
+        return data
+        
+    def create_group(self):
+        """Ask for a name and members, then open the new group chat"""
+        peers = [data['peer_data'] for data in self.chat_widgets.values()
+                 if 'group' not in data['peer_data']]
+        if not peers:
+            QMessageBox.information(self, "B Messenger", "Nobody is online to start a group with.")
+            return
+        dialog = NewGroupDialog(peers, self)
+        if dialog.exec() != QDialog.DialogCode.Accepted or not dialog.members():
+            return
+        data = self.add_group({
+            "id": uuid.uuid4().hex,
+            "name": dialog.group_name() or "Group",
+            "members": [self.network_manager.service_info.name] + dialog.members(),
+        })
+        save_groups(list(self.groups.values()))
+        self.network_manager.send_group_update(data['peer_data']['group'])
+        self.chat_list_widget.setCurrentItem(data['item'])
+        self.on_chat_selected(data['item'])
+        
+    def _history_key(self, msg):
+        """Key a received message's chat is stored under: the sender's service name"""
+        return msg.get("from_service") or f"{msg.get('from_user', '')}._S.{SERVICE_TYPE}"
+        
+    def _history_label(self, key):
+        """Name shown for a stored chat, also when that peer is offline"""
+        data = self.chat_widgets.get(key)
+        if data:
+            return data['peer_data']['username']
+        group = self.groups.get(key[len(GROUP_CHAT_PREFIX):]) if key.startswith(GROUP_CHAT_PREFIX) else None
+        return f"#{group['name']}" if group else key.partition("._S.")[0]
+        
+    def _history_keys(self, username):
+        """Keys of every chat with a user of this name, for "@user" searches"""
+        keys = {name for name, data in self.chat_widgets.items()
+                if data['peer_data']['username'] == username}
+        keys.add(f"{username}._S.{SERVICE_TYPE}")
+        return sorted(keys)
+        
+    def _run_search(self):
+        """Search stored history for the query in the search field"""
+        query = self.search_field.text().strip()
+        peer = None
+        if query.startswith("@"):
+            peer, _, query = query[1:].partition(" ")
+        self.search_results.clear()
+        if not query and not peer:
+            self.search_results.hide()
+            self.chat_list_widget.show()
+            return
+            
+        self.chat_list_widget.hide()
+        self.search_results.show()
+        width = self.search_results.viewport().width()
+        for result in self.history_store.search(query, self._history_keys(peer) if peer else None):
+            when = datetime.fromtimestamp(result['timestamp']).strftime('%d %b %H:%M')
+            name = self._history_label(result['peer'])
+            label = QLabel(
+                f"<span style='color:{APP_COLORS['text_primary']};'><b>{html.escape(name)}</b></span> "
+                f"<span style='color:{APP_COLORS['timestamp']};'>{when}</span><br/>"
+                f"<span style='color:{APP_COLORS['text_primary']};'>{result['snippet']}</span>")
+            label.setTextFormat(Qt.TextFormat.RichText)
+            label.setWordWrap(True)
+            label.setContentsMargins(12, 6, 12, 6)
+            label.setStyleSheet("background: transparent;")
+            item = QListWidgetItem()
+            item.setData(Qt.ItemDataRole.UserRole, result['peer'])
+            item.setSizeHint(QSize(width, label.heightForWidth(width)))
+            self.search_results.addItem(item)
+            self.search_results.setItemWidget(item, label)
+        
+    def _open_search_result(self, item):
+        """Open the chat a search result belongs to, if that user is online"""
+        data = self.chat_widgets.get(item.data(Qt.ItemDataRole.UserRole))
+        if data:
+            self.search_field.clear()
+            self._run_search()
+            self.chat_list_widget.setCurrentItem(data['item'])
+            self.on_chat_selected(data['item'])
+        
     def on_chat_selected(self, item):
         """Handle chat selection from list"""
         peer_data = item.data(Qt.ItemDataRole.UserRole)
         if peer_data and peer_data['name'] in self.chat_widgets:
-            self.chat_area.setCurrentWidget(self.chat_widgets[peer_data['name']]["page"])
+            data = self._open_chat_page(peer_data['name'])
+            self.chat_area.setCurrentWidget(data['page'])
+            self._evict_chat_pages()
+            
+    def _open_chat_page(self, service_name):
+        """Build a chat's page on first use and mark it as recently used"""
+        data = self.chat_widgets[service_name]
+        if data['page'] is None:
+            page, widgets = self._create_chat_page(
+                data['peer_data']['username'], service_name, data['model'])
+            self.chat_area.addWidget(page)
+            data['page'], data['widgets'] = page, widgets
+            self._load_history_page(widgets['history_view'])
+        self.open_pages[service_name] = time.monotonic()
+        self.open_pages.move_to_end(service_name)
+        return data
+        
+    def _chat_busy(self, data):
+        """Whether a chat still shows a pending message or a running transfer"""
+        model = data['model']
+        return (any(m is model for m in self.message_models.values())
+                or any(d['model'] is model for d in self.group_deliveries.values())
+                or any(t['model'] is model for t in self.active_transfers.values()))
+        
+    def _evict_chat_pages(self):
+        """Drop pages beyond MAX_CHAT_PAGES and pages unused for CHAT_PAGE_IDLE_TIMEOUT"""
+        now = time.monotonic()
+        current = self.chat_area.currentWidget()
+        for service_name, last_used in list(self.open_pages.items()):
+            if len(self.open_pages) <= MAX_CHAT_PAGES and now - last_used < CHAT_PAGE_IDLE_TIMEOUT:
+                break  # The rest were used more recently
+            data = self.chat_widgets[service_name]
+            if data['page'] is current or self._chat_busy(data):
+                continue
+            self._close_chat_page(data)
+            # History is reloaded from the store when the chat is opened again
+            data['model'].deleteLater()
+            data['model'] = ChatHistoryModel(self)
+            
+    def _close_chat_page(self, data):
+        service_name = data['peer_data']['name']
+        self.open_pages.pop(service_name, None)
+        if data['page'] is None:
+            return
+        if self.chat_area.currentWidget() is data['page']:
+            self.chat_area.setCurrentWidget(self.placeholder_widget)
+        self.chat_area.removeWidget(data['page'])
+        data['page'].deleteLater()
+        data['page'] = data['widgets'] = None
+            
+    def _show_peer_health(self, service_name, rtt_ms, loss, reachable):
+        """Latency and loss as the chat list tooltip"""
+        data = self.chat_widgets.get(service_name)
+        if not data:
+            return
+        if not reachable:
+            tip = "Unreachable"
+        elif rtt_ms < 0:
+            tip = "Online"
+        else:
+            tip = f"Online · {rtt_ms:.0f} ms · {loss:.0%} loss"
+        data['item'].setToolTip(tip)
+            
+    def update_user(self, peer_data):
+        """Refresh a listed user whose address or details changed"""
+        data = self.chat_widgets.get(peer_data['name'])
+        if not data:
+            return
+        data['peer_data'] = peer_data
+        data['item'].setData(Qt.ItemDataRole.UserRole, peer_data)
+        item_widget = self.chat_list_widget.itemWidget(data['item'])
+        if item_widget:
+            item_widget.username_label.setText(self._user_label(peer_data))
             
     def remove_user(self, service_name):
         """Remove a user who went offline"""
         if service_name in self.chat_widgets:
-            if self.chat_area.currentWidget() == self.chat_widgets[service_name]['page']:
-                self.chat_area.setCurrentWidget(self.placeholder_widget)
-                
             data = self.chat_widgets.pop(service_name)
+            self._close_chat_page(data)
             self.chat_list_widget.takeItem(self.chat_list_widget.row(data['item']))
-            data['page'].deleteLater()
+            data['model'].deleteLater()
             
     def send_private_message(self, target_service_name):
         """Send a private message to a user"""
         data = self.chat_widgets.get(target_service_name)
-        if not data:
+        if not data or not data['widgets']:
             return
             
         widgets = data['widgets']
@@ -1100,40 +4928,203 @@ class MainWindow(QMainWindow):
             "from_user": self.network_manager.username
         }
         
-        self.network_manager.send_tcp_message(data['peer_data'], msg_dict)
-        self.add_message_to_history(
-            widgets['scroll_area'],
-            widgets['scroll_layout'],
-            msg_dict,
-            True
-        )
+        if 'group' in data['peer_data']:
+            self.network_manager.send_group(data['peer_data']['group'], msg_dict)
+        else:
+            self.network_manager.queue_message(data['peer_data'], msg_dict)
+        self.add_message_to_history(data, msg_dict, True)
         input_field.clear()
+
+    def _update_message_status(self, message_id, status):
+        """Record the delivery state of a sent message and show it in its bubble"""
+        self.history_store.update(message_id, status)
+        if status == "queued":
+            history_model = self.message_models.get(message_id)
+        else:
+            history_model = self.message_models.pop(message_id, None)
+        if history_model is None:
+            return
+        try:
+            history_model.update_entry(message_id, status=status)
+        except RuntimeError:
+            pass  # Chat page already deleted
+
+    def _update_group_delivery(self, service_name, message_id):
+        """Count one more member who has a group message"""
+        delivered = self.group_deliveries[message_id]
+        delivered["done"].add(service_name)
+        done = min(delivered["base"] + len(delivered["done"]), delivered["total"])
+        self.history_store.update(message_id, "group", f"{done}/{delivered['total']}")
+        if done >= delivered["total"]:
+            del self.group_deliveries[message_id]
+        try:
+            delivered["model"].update_entry(message_id, delivered=(done, delivered["total"]))
+        except RuntimeError:
+            self.group_deliveries.pop(message_id, None)  # Chat page already deleted
+
+    def _on_message_sent(self, service_name, message_id):
+        if message_id in self.group_deliveries:
+            self._update_group_delivery(service_name, message_id)
+            return
+        self._update_message_status(message_id, "sent")
+
+    def _on_message_failed(self, service_name, message_id):
+        if message_id in self.group_deliveries:
+            return  # The count shows who is missing
+        self._update_message_status(message_id, "failed")
+
+    def _on_message_queued(self, service_name, message_id):
+        if message_id in self.group_deliveries:
+            return
+        self._update_message_status(message_id, "queued")
+
+    @staticmethod
+    def _format_size(num_bytes):
+        for unit in ("B", "KB", "MB", "GB"):
+            if num_bytes < 1024 or unit == "GB":
+                return f"{num_bytes:.0f} {unit}" if unit == "B" else f"{num_bytes:.1f} {unit}"
+            num_bytes /= 1024
+
+    def send_file(self, target_service_name):
+        """Pick a file and stream it to a user in the background"""
+        data = self.chat_widgets.get(target_service_name)
+        if not data:
+            return
+            
+        path, _ = QFileDialog.getOpenFileName(self, "Send File", HOME_DIR)
+        if not path:
+            return
+            
+        try:
+            size = os.path.getsize(path)
+        except OSError as e:
+            QMessageBox.warning(self, "B Messenger", f"Cannot read file: {e}")
+            return
+            
+        transfer_id = self.network_manager.send_file(data['peer_data'], path)
+        msg_dict = {
+            "type": "file",
+            "transfer_id": transfer_id,
+            "filename": os.path.basename(path),
+            "size": size,
+            "timestamp": time.time(),
+            "from_user": self.network_manager.username
+        }
+        self.add_message_to_history(data, msg_dict, True)
+
+    def _on_transfer_offered(self, info):
+        """Ask whether to accept an incoming file; the sender waits for the answer"""
+        transfer_id = info['transfer_id']
+        sender = info.get('from_user') or "Someone"
+        box = QMessageBox(QMessageBox.Question, "B Messenger",
+                          f"{sender} wants to send you {info['filename']} "
+                          f"({self._format_size(info['size'])}). Accept it?",
+                          QMessageBox.Yes | QMessageBox.No, self)
+        box.setAttribute(Qt.WA_DeleteOnClose)
+        box.finished.connect(lambda result: self.network_manager.respond_file_offer(
+            transfer_id, box.standardButton(box.clickedButton()) == QMessageBox.Yes))
+        box.open()
+
+    def _on_transfer_started(self, info):
+        """Show an incoming file in the sender's chat"""
+        if info['transfer_id'] in self.active_transfers:
+            return
+        data = self._chat_for_message(info)
+        if data:
+            msg_dict = dict(info, type="file", timestamp=time.time())
+            self.add_message_to_history(data, msg_dict, False)
+
+    def _on_transfer_progress(self, transfer_id, done, total):
+        transfer = self.active_transfers.get(transfer_id)
+        if not transfer:
+            return
+        try:
+            transfer['model'].update_entry(
+                transfer_id,
+                progress=done / total if total else 1.0,
+                detail=f"{self._format_size(done)} / {self._format_size(total)}")
+        except RuntimeError:
+            self.active_transfers.pop(transfer_id, None)  # Chat page already deleted
+
+    def _on_transfer_finished(self, transfer_id, ok, detail):
+        transfer = self.active_transfers.pop(transfer_id, None)
+        if not transfer:
+            return
+        self.history_store.update(transfer_id, "done" if ok else "failed", detail)
+        try:
+            if ok:
+                url = QUrl.fromLocalFile(detail).toString() if os.path.exists(detail) else None
+                transfer['model'].update_entry(
+                    transfer_id, progress=1.0, detail=self._format_size(transfer['size']), url=url)
+            else:
+                transfer['model'].update_entry(transfer_id, detail=f"✗ {detail}", error=True)
+        except RuntimeError:
+            pass  # Chat page already deleted
+        
+    def _chat_for_message(self, msg):
+        """Chat of the peer a message came from, looked up in the shared peer registry.
+
+        Group messages go to their group's chat if we have that group;
+        what a message says about the group's name or members is ignored.
+        """
+        group = msg.get("group")
+        if group:
+            return self.chat_widgets.get(GROUP_CHAT_PREFIX + group["id"])
+        peer_data = self.network_manager.peers.resolve(msg)
+        return self.chat_widgets.get(peer_data['name']) if peer_data else None
         
+    def _drain_inbox(self):
+        """Handle one batch of received messages and come back for the rest"""
+        messages, more = self.network_manager.inbox.take()
+        if more:
+            QTimer.singleShot(0, self._drain_inbox)
+        for msg in messages:
+            try:
+                self.handle_incoming_message(msg)
+            except Exception as e:
+                # Already acked to the sender; losing one message beats stalling the inbox
+                print(f"Failed to show message from {msg.get('from_user')}: {e!r}")
+            
     def handle_incoming_message(self, msg):
-        """Handle incoming message from network"""
+        """Handle incoming message from network.
+
+        The network layer drops redeliveries it has seen this session; a
+        text message already in the history is one whose ack was lost
+        before we last quit, and is dropped here.
+        """
         msg_type = msg.get("type")
-        from_user = msg.get("from_user")
-        
-        # Find target chat
-        target_widget_info = None
-        for service_name, data in self.chat_widgets.items():
-            if data['peer_data']['username'] == from_user:
-                target_widget_info = data
-                break
+        if msg_type == "text" and msg.get("id") and self.history_store.contains(msg["id"]):
+            return
+        if msg_type == "group_update":
+            self._apply_group_update(msg)
+            return
+        target_widget_info = self._chat_for_message(msg)
                 
         if not target_widget_info and msg_type != 'ping':
+            if msg_type == "text" and not msg.get("group"):
+                # Sender left the chat list meanwhile; keep the message for when it is back
+                self.history_store.append(self._history_key(msg), msg, False)
             return
             
         if msg_type == "ping":
             self.handle_incoming_ping(msg)
         elif target_widget_info:
-            self.add_message_to_history(
-                target_widget_info['widgets']['scroll_area'],
-                target_widget_info['widgets']['scroll_layout'],
-                msg,
-                False
-            )
+            self.add_message_to_history(target_widget_info, msg, False)
             
+    def _apply_group_update(self, msg):
+        """Join or refresh a group as a current member described it.
+
+        The network layer has checked that the sender is a member, of the
+        group as we know it or, for an invite, of the group it describes.
+        """
+        group = msg["group"]
+        if self.network_manager.service_info.name not in group["members"]:
+            return  # Not addressed to us
+        known = self.groups.get(group["id"])
+        self.add_group(group)
+        if known != self.groups[group["id"]]:
+            save_groups(list(self.groups.values()))
+
     def send_ping(self, target_service_name):
         """Send a ping notification to a user"""
         data = self.chat_widgets.get(target_service_name)
@@ -1147,17 +5138,30 @@ class MainWindow(QMainWindow):
             "from_user": self.network_manager.username
         }
         
-        self.network_manager.send_tcp_message(data['peer_data'], msg_dict)
-        self.add_message_to_history(
-            data['widgets']['scroll_area'],
-            data['widgets']['scroll_layout'],
-            msg_dict,
-            True
-        )
+        self.network_manager.queue_message(data['peer_data'], msg_dict)
+        self.add_message_to_history(data, msg_dict, True)
         
     def handle_incoming_ping(self, msg):
-        """Handle incoming ping notification"""
+        """Handle incoming ping notification.
+
+        Pings from a peer within PING_COALESCE_WINDOW of its last one only
+        raise the counter on that ping's bubble.
+        """
         from_user = msg.get("from_user")
+        msg.setdefault("id", uuid.uuid4().hex)
+        data = self._chat_for_message(msg)
+        sender = data['peer_data']['name'] if data else from_user
+        now = time.monotonic()
+        burst = self.ping_bursts.get(sender)
+        if burst and now - burst["last"] < PING_COALESCE_WINDOW:
+            burst["last"] = now
+            burst["count"] += msg.get("count", 1)
+            self.history_store.update(burst["key"], None, str(burst["count"]))
+            try:
+                burst["model"].update_entry(burst["key"], count=burst["count"])
+            except RuntimeError:
+                self.ping_bursts.pop(sender, None)  # Chat page already deleted
+            return
         print(f"PING!!! received from {from_user}")
         
         # Visual and sound effects
@@ -1172,20 +5176,15 @@ class MainWindow(QMainWindow):
                                 QSystemTrayIcon.MessageIcon.Information, 2500)
                                 
         # Find and highlight the sender's chat
-        for service_name, data in self.chat_widgets.items():
-            if data['peer_data']['username'] == from_user:
-                widgets = data['widgets']
-                self.add_message_to_history(
-                    widgets['scroll_area'],
-                    widgets['scroll_layout'],
-                    msg,
-                    False
-                )
-                
-                # Blink the chat list item
-                item = data['item']
-                self._blink_chat_item(item)
-                break
+        if data:
+            self.add_message_to_history(data, msg, False)
+            self.ping_bursts[sender] = {"key": msg["id"], "model": data['model'], "last": now,
+                                        "count": msg.get("count", 1)}
+            if msg.get("count", 1) > 1:
+                self.history_store.update(msg["id"], None, str(msg["count"]))
+            
+            # Blink the chat list item
+            self._blink_chat_item(data['item'])
                 
     def _blink_chat_item(self, item, blink_count=6, interval=180):
         """Blink a chat list item to draw attention"""
@@ -1214,9 +5213,10 @@ class MainWindow(QMainWindow):
         """Play ping notification sound"""
         if os.path.exists(PING_SOUND_FILE):
             try:
-                self.ping_sound = QSoundEffect()
-                self.ping_sound.setSource(QUrl.fromLocalFile(PING_SOUND_FILE))
-                self.ping_sound.setVolume(1.0)
+                if self.ping_sound is None:
+                    self.ping_sound = QSoundEffect(self)
+                    self.ping_sound.setSource(QUrl.fromLocalFile(PING_SOUND_FILE))
+                    self.ping_sound.setVolume(1.0)
                 self.ping_sound.play()
             except Exception as e:
                 print(f"Failed to play ping sound: {e}")
@@ -1270,6 +5270,7 @@ class MainWindow(QMainWindow):
         self.network_manager.stop()
         self.network_thread.quit()
         self.network_thread.wait(2000)
+        self.history_store.close()
         
         if hasattr(self, 'tray'):
             self.tray.hide()